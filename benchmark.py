@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for fitchasmain
+Starts a local stand-in Szurubooru server, generates a synthetic gallery-dl download tree and measures
+collect_files_to_upload, upload_file and upload_all_files without any live server or booru
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import fitchasmain
+
+# (size in bytes, share of files) of the synthetic media files
+FILE_SIZES = [(32 * 1024, 0.6), (256 * 1024, 0.3), (2 * 1024 * 1024, 0.1)]
+BENCHMARKS = ["collect", "upload_file", "upload_all_files"]
+BOORU_TAGS = ["sky", "cloud", "cat_ears", "solo", "scenery", "night", "smile", "long_hair", "red_eyes", "outdoors"]
+
+class FakeSzurubooru:
+    """Stand-in Szurubooru API with configurable latency, error rate and 429 injection"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "uploads": 0, "posts": 0, "errors": 0, "throttled": 0, "bytes": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSzurubooruHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counts[key] += amount
+
+    def injected_status(self):
+        """Return 429/503 for a request that should fail, or None"""
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeSzurubooruHandler(BaseHTTPRequestHandler):
+    """Implements just enough of /api for the uploader"""
+    protocol_version = "HTTP/1.1"  # Keep-alive, like a real deployment behind a proxy
+    # Headers and body go out in separate writes; without TCP_NODELAY delayed ACKs add ~40ms per request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        remaining = int(self.headers.get("Content-Length") or 0)
+        body = bytearray() if remaining < 1024 * 1024 else None
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 256 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            self.server.fake.count("bytes", len(chunk))
+            if body is not None:
+                body.extend(chunk)
+        return bytes(body or b'')
+
+    def _reply(self, status, data, headers=None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method):
+        fake = self.server.fake
+        fake.count("requests")
+        body = self._read_body()
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        status = fake.injected_status()
+        if status == 429:
+            fake.count("throttled")
+            return self._reply(429, {"name": "TooManyRequests"}, {"Retry-After": str(fake.retry_after)})
+        if status is not None:
+            fake.count("errors")
+            return self._reply(status, {"name": "ServiceUnavailable"})
+
+        path = self.path.split('?')[0]
+        if method == "POST" and path == "/api/uploads":
+            fake.count("uploads")
+            return self._reply(200, {"token": uuid.uuid4().hex})
+        if method == "POST" and path == "/api/posts":
+            fake.count("posts")
+            data = json.loads(body or b'{}')
+            return self._reply(200, {"id": fake.counts["posts"], "version": 1, "checksum": uuid.uuid4().hex,
+                                     "tags": [{"names": [tag]} for tag in data.get("tags", [])]})
+        if method == "GET" and path == "/api/tag-categories":
+            return self._reply(200, {"results": [{"name": "default", "default": True}, {"name": "artist"},
+                                                 {"name": "character"}, {"name": "copyright"}]})
+        if method == "GET" and path in ("/api/posts/", "/api/tags/"):
+            return self._reply(200, {"results": [], "total": 0})
+        if method in ("POST", "PUT") and path.startswith(("/api/tags", "/api/tag/", "/api/post/")):
+            return self._reply(200, {"version": 2})
+        return self._reply(404, {"name": "NotFound"})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+def make_tree(root, files, twitter_share=0.2, seed=None):
+    """Write a gallery-dl style tree of media files with booru and Twitter .json sidecars
+
+    Returns the total media size in bytes.
+    """
+    rng = random.Random(seed)
+    sizes, weights = zip(*FILE_SIZES)
+    total = 0
+    for i in range(files):
+        size = rng.choices(sizes, weights)[0]
+        # Random data framed like a JPEG, so it passes the uploader's media validation
+        content = b"\xff\xd8\xff\xe0" + rng.randbytes(size - 6) + b"\xff\xd9"
+        total += size
+        if rng.random() < twitter_share:
+            user = f"artist{i % 7}"
+            directory = Path(root) / "twitter" / user
+            name = f"{1700000000000 + i}_1.jpg"
+            metadata = {"category": "twitter", "subcategory": "tweets", "tweet_id": 1700000000000 + i,
+                        "author": {"name": user},
+                        "content": "new drawing " + " ".join(f"#{tag}" for tag in rng.sample(BOORU_TAGS, 3))}
+        else:
+            directory = Path(root) / "rule34" / f"query{i % 5}"
+            name = f"rule34_{100000 + i}_{uuid.UUID(int=rng.getrandbits(128)).hex}.jpg"
+            tags = rng.sample(BOORU_TAGS, 5)
+            metadata = {"category": "rule34", "id": 100000 + i, "tags": " ".join(tags),
+                        "tags_artist": tags[0], "rating": rng.choice("sqe"),
+                        "file_url": f"https://example.invalid/{name}"}
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / name).write_bytes(content)
+        with open(directory / f"{name}.json", 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+    return total
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1048576 if sys.platform == "darwin" else 1024)
+
+def _bench_collect(tree, repeat, **_):
+    latencies = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        files = fitchasmain.collect_files_to_upload(tree)
+        latencies.append(time.monotonic() - start)
+    return len(files) * repeat, 0, sum(latencies), latencies
+
+def _bench_upload_file(tree, **_):
+    files = fitchasmain.collect_files_to_upload(tree)
+    latencies = []
+    size = 0
+    start = time.monotonic()
+    for filepath, metadata_path, is_twitter in files:
+        file_start = time.monotonic()
+        fitchasmain.upload_file(filepath, metadata_path, silent=True, is_twitter=is_twitter)
+        latencies.append(time.monotonic() - file_start)
+        size += filepath.stat().st_size
+    return len(files), size, time.monotonic() - start, latencies
+
+def _bench_upload_all_files(tree, workers, **_):
+    report = Path(tempfile.mkdtemp(prefix="fitchas-bench-")) / "report.jsonl"
+    fitchasmain.run_metrics.open_report(report)
+    start = time.monotonic()
+    fitchasmain.upload_all_files(tree, delay=0, workers=workers, use_index=False)
+    elapsed = time.monotonic() - start
+    fitchasmain.run_metrics.close_report()
+    latencies = []
+    with open(report, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("event") == "file" and "seconds" in record:
+                latencies.append(record["seconds"])
+    shutil.rmtree(report.parent, ignore_errors=True)
+    with fitchasmain.stats_lock:
+        size = fitchasmain.upload_stats['bytes']
+    return len(latencies), size, elapsed, latencies
+
+def run_benchmark(name, tree, url, workers, repeat, results):
+    """Run one benchmark (in its own process, so peak RSS is its own) and put its result in a queue"""
+    fitchasmain.configure(szuru_url=url, szuru_user="bench", szuru_token="bench")
+    fitchasmain.reset_upload_stats()
+    function = {"collect": _bench_collect, "upload_file": _bench_upload_file,
+                "upload_all_files": _bench_upload_all_files}[name]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        files, size, elapsed, latencies = function(tree=tree, workers=workers, repeat=repeat)
+    with fitchasmain.stats_lock:
+        stats = dict(fitchasmain.upload_stats)
+    results.put({
+        "benchmark": name,
+        "files": files,
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(files / elapsed, 2) if elapsed else None,
+        "mb_per_s": round(size / 1048576 / elapsed, 2) if elapsed and size else None,
+        "p50": round(percentile(latencies, 0.5), 4) if latencies else None,
+        "p99": round(percentile(latencies, 0.99), 4) if latencies else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "uploaded": stats['uploaded'],
+        "failed": stats['failed'],
+        "retried": stats['retried']
+    })
+
+def print_results(results, server_counts):
+    """Print a results table"""
+    print(f"\n{'benchmark':<18}{'files':>7}{'files/s':>10}{'MB/s':>9}{'p50 s':>9}{'p99 s':>9}"
+          f"{'RSS MB':>9}{'failed':>8}{'retried':>9}")
+    for r in results:
+        print(f"{r['benchmark']:<18}{r['files']:>7}{r['files_per_s'] or 0:>10.1f}{r['mb_per_s'] or 0:>9.1f}"
+              f"{r['p50'] or 0:>9.4f}{r['p99'] or 0:>9.4f}{r['peak_rss_mb']:>9.1f}{r['failed']:>8}"
+              f"{r['retried']:>9}")
+    print(f"\nServer: {server_counts['requests']} requests, {server_counts['throttled']} throttled, "
+          f"{server_counts['errors']} errors, {server_counts['bytes'] / 1048576:.1f} MB received")
+
+def build_arg_parser():
+    """Build the command line parser"""
+    parser = argparse.ArgumentParser(description="Offline throughput benchmarks against a fake Szurubooru server")
+    parser.add_argument("--files", type=int, default=200, help="files in the synthetic tree (default: 200)")
+    parser.add_argument("--twitter-share", type=float, default=0.2,
+                        help="share of files with Twitter sidecars (default: 0.2)")
+    parser.add_argument("--tree", help="use (and keep) this directory for the synthetic tree")
+    parser.add_argument("--only", action="append", choices=BENCHMARKS, help="run only this benchmark (repeatable)")
+    parser.add_argument("--workers", type=int, default=fitchasmain.DEFAULT_UPLOAD_WORKERS,
+                        help="workers for upload_all_files")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of collect_files_to_upload (default: 3)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the server waits per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the tree and error injection")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    tree = Path(args.tree) if args.tree else Path(tempfile.mkdtemp(prefix="fitchas-bench-")) / "downloads"
+    if not tree.exists() or not any(tree.iterdir()):
+        print(f"Generating {args.files} files in {tree}...", file=sys.stderr)
+        size = make_tree(tree, args.files, args.twitter_share, args.seed)
+        print(f"  {size / 1048576:.1f} MB", file=sys.stderr)
+
+    server = FakeSzurubooru(args.latency, args.error_rate, args.throttle_rate, args.retry_after, args.seed).start()
+    # A fresh interpreter per benchmark keeps peak RSS and module state separate
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for name in args.only or BENCHMARKS:
+            queue = context.Queue()
+            process = context.Process(target=run_benchmark,
+                                      args=(name, str(tree), server.url, args.workers, args.repeat, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"Benchmark {name} failed (exit code {process.exitcode})", file=sys.stderr)
+                continue
+            results.append(queue.get())
+    finally:
+        server.stop()
+        if not args.tree:
+            shutil.rmtree(tree.parent, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"results": results, "server": server.counts}, indent=2))
+    else:
+        print_results(results, server.counts)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,46 +8,968 @@ import json
 import os
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ConnectTimeoutError
 from pathlib import Path
+from urllib.parse import urlparse, quote
 import time
 import base64
 import sys
 import re
+import threading
+import sqlite3
+import hashlib
+import io
+import random
+import email.utils
+import tempfile
+import uuid
+import mimetypes
+import queue
+import argparse
+import array
+import bisect
+import contextlib
+import functools
+import inspect
+import collections
+import socket
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+
+# Optional: much faster JSON parsing of metadata sidecars
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: run gallery-dl inside this process instead of starting it for every query
+try:
+    from gallery_dl import config as gdl_config, exception as gdl_exception, extractor as gdl_extractor, \
+        job as gdl_job, option as gdl_option
+except ImportError:
+    gdl_job = None
+
+# Optional: perceptual hashes for the near-duplicate filter
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Only used for reflinks (copy-on-write clones) on Linux
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Configuration (Placeholders - **USER MUST CONFIGURE**)
 SZURU_URL = "https://your-szurubooru-url.com"  # Replace with your Szurubooru URL
 SZURU_USER = "your_username"  # Replace with your Szurubooru username
 SZURU_TOKEN = "your-api-token"  # Replace with your Szurubooru API Token
 DOWNLOAD_DIR = "./booru_downloads"
+DEFAULT_UPLOAD_WORKERS = 4  # Number of parallel upload threads
+SIDECAR_WAIT = 10  # Seconds to wait for a .json sidecar when uploading while downloading
+STAGING_STORE = False  # Keep each uploaded file once by content, hardlinked into the query directories
+DOWNLOAD_ARCHIVE = False  # Record downloads in <dir>.archive.sqlite3 so deleted files aren't fetched again
+UPLOAD_CHUNK_SIZE = 256 * 1024  # Bytes read from disk at a time while streaming an upload
+UPLOAD_TOKEN_TTL = 6 * 3600  # Don't reuse upload tokens older than this when resuming
+BATCH_DOWNLOADS = 4  # Max gallery-dl processes running at once in batch mode
+BATCH_PER_SITE = 2  # Max gallery-dl processes per site in batch mode
+SYNC_ABORT_AFTER = 3  # Sync mode: stop a query after this many already-downloaded files in a row
+DAEMON_ADDRESS = "127.0.0.1:8399"  # Daemon control endpoint: host:port, or a path for a Unix socket
+DAEMON_KEEP_JOBS = 1000  # Finished jobs the daemon remembers for GET /jobs
+DAEMON_RATE_WINDOW = 60  # Seconds over which the daemon's recent throughput is measured
+GALLERY_DL_IN_PROCESS = True  # Run gallery-dl through its Python API when it's importable
+
+# Szurubooru HTTP client settings
+HTTP_POOL_SIZE = 16  # Max keep-alive connections kept open to SZURU_URL
+HTTP_RETRIES = 3  # Retries of connections that couldn't be made (adaptive_request retries the rest)
+HTTP_BACKOFF = 0.5  # Backoff factor between retries (0.5s, 1s, 2s, ...)
+# Adaptive upload control: AIMD on concurrency and start rate, driven by server responses
+ADAPTIVE_GROWTH = 2  # Concurrency may grow up to this multiple of the configured workers
+ADAPTIVE_RATE_STEP = 0.1  # Uploads/s added to the start rate per fast response
+ADAPTIVE_MAX_RATE = 20.0  # Uploads/s the start rate may grow to (a higher --delay rate is kept as is)
+ADAPTIVE_LATENCY_FACTOR = 3.0  # Back off when a response is this much slower than the best seen
+ADAPTIVE_COOLDOWN = 1.0  # Seconds between two multiplicative decreases
+TRANSIENT_RETRIES = 4  # Retries of API requests that got 429/5xx or a connection error
+TRANSIENT_BACKOFF = 1.0  # Base of the jittered exponential backoff between those retries
+# Upper bounds (seconds) of the phase latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# (connect, read) timeouts in seconds per API endpoint
+API_TIMEOUTS = {
+    "uploads": (10, 60),
+    "posts": (10, 30),
+    "default": (10, 30)
+}
+
+# Tag handling
+TAG_CACHE_TTL = 3600  # Seconds before the tag cache is reloaded from the server
+TAG_CREATE_WORKERS = 4  # Parallel requests when creating missing tags
+CHECKSUM_BATCH = 50  # Checksums per server existence query
+SERVER_CHECK_WINDOW = 0.05  # Seconds a streamed file waits for others to share its existence query
+METADATA_WORKERS = 2  # Threads parsing metadata sidecars ahead of the uploads
+NEAR_DUPLICATES = False  # Skip files that look like an existing post (needs numpy and Pillow)
+PHASH_DISTANCE = 6  # Max differing bits (of 64) in each of aHash/dHash/pHash for a near-duplicate
+PHASH_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))  # Processes computing perceptual hashes
+VALIDATE_MEDIA = True  # Check magic bytes, size and container integrity before uploading
+VALIDATE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))  # Processes validating batches of files
+MAX_UPLOAD_SIZE = 0  # Bytes; larger files are quarantined (0 = no limit, e.g. match the proxy's body limit)
+UPLOAD_ORDER = "walk"  # Order of uploads from a finished download: walk, smallest, largest or interleave
+QUEUE_LEASE = 300  # Seconds a queue worker holds a file without heartbeating before others may take it
+QUEUE_POLL = 5  # Seconds an idle queue worker waits before looking for released files again
+QUEUE_MAX_ATTEMPTS = 3  # Leases of a file that ran out (worker died) before it is marked failed
+# Booru tag category -> Szurubooru tag category (only used if it exists on the server)
+TAG_CATEGORY_MAP = {
+    "artist": "artist",
+    "character": "character",
+    "copyright": "copyright",
+    "species": "species",
+    "meta": "meta",
+    "metadata": "meta"
+}
 
 # Rule34 API credentials (Placeholders - **USER MUST CONFIGURE**)
 RULE34_API_KEY = "your-rule34-api-key"  # Replace with your Rule34 API Key
 RULE34_USER_ID = "your-rule34-user-id"  # Replace with your Rule34 User ID
+TWITTER_COOKIES = ""  # Optional: cookies.txt path or browser name (chrome, firefox, ...) for Twitter
+
+# Default config file, overridden by --config or the FITCHAS_CONFIG environment variable
+CONFIG_FILE = Path.home() / ".config" / "fitchas" / "config.json"
+# Settings that can come from the config file (lowercase keys) or the environment
+CONFIG_KEYS = ["SZURU_URL", "SZURU_USER", "SZURU_TOKEN", "DOWNLOAD_DIR",
+               "RULE34_API_KEY", "RULE34_USER_ID", "DEFAULT_UPLOAD_WORKERS", "STAGING_STORE",
+               "TWITTER_COOKIES", "GALLERY_DL_IN_PROCESS", "NEAR_DUPLICATES", "PHASH_DISTANCE",
+               "VALIDATE_MEDIA", "MAX_UPLOAD_SIZE", "QUEUE_LEASE",
+               "UPLOAD_ORDER", "DOWNLOAD_ARCHIVE", "ADAPTIVE_MAX_RATE"]
+
+def build_auth_headers(user, token):
+    """Build the Szurubooru API headers for a user and API token"""
+    auth_string = f"{user}:{token}"
+    try:
+        auth_token = base64.b64encode(auth_string.encode()).decode('ascii')
+    except:
+        # Fallback for empty/invalid config during initial setup
+        auth_token = "placeholder"
+    return {
+        "Authorization": f"Token {auth_token}",
+        "Accept": "application/json"
+    }
 
 # Szurubooru API headers setup
-auth_string = f"{SZURU_USER}:{SZURU_TOKEN}"
-try:
-    auth_token = base64.b64encode(auth_string.encode()).decode('ascii')
-except:
-    # Fallback for empty/invalid config during initial setup
-    auth_token = "placeholder" 
-
-headers = {
-    "Authorization": f"Token {auth_token}",
-    "Accept": "application/json"
-}
+headers = build_auth_headers(SZURU_USER, SZURU_TOKEN)
+
+# Track upload stats (shared by all upload threads, guarded by stats_lock)
+upload_stats = {"uploaded": 0, "failed": 0, "skipped": 0, "quarantined": 0, "total": 0, "merged": 0,
+                "retried": 0, "bytes": 0, "upload_seconds": 0.0, "upload_requests": 0}
+stats_lock = threading.Lock()
+
+def state_db_path(download_dir):
+    """Path of the local state database kept next to the download directory"""
+    path = Path(download_dir).resolve()
+    return path.parent / f"{path.name}.fitchas.sqlite"
+
+def connect_state_db(db_path):
+    """Open the state database so several threads/connections can share it"""
+    conn = sqlite3.connect(str(db_path), timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def file_checksums(filepath, chunk_size=1024 * 1024):
+    """Return (sha1, md5) hex digests of a file, matching Szurubooru's checksums"""
+    sha1 = hashlib.sha1()
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+            md5.update(chunk)
+    return sha1.hexdigest(), md5.hexdigest()
+
+class UploadIndex:
+    """SQLite index of content already on Szurubooru, keyed by SHA1 checksum"""
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self.conn = connect_state_db(self.db_path)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "checksum TEXT PRIMARY KEY, checksum_md5 TEXT, path TEXT, "
+                "post_id INTEGER, uploaded_at REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS uploads_md5 ON uploads (checksum_md5)")
+            # Hashes of local files, so unchanged files are not re-read on every run
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, checksum TEXT, checksum_md5 TEXT)"
+            )
+            # What is left of media deleted by compaction
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS compacted ("
+                "path TEXT PRIMARY KEY, checksum TEXT, post_id INTEGER, size INTEGER, "
+                "metadata TEXT, compacted_at REAL)"
+            )
+
+    def checksums(self, filepath):
+        """Return (sha1, md5) of a file, using the cached value if it didn't change"""
+        path = str(Path(filepath).resolve())
+        st = os.stat(path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime, checksum, checksum_md5 FROM file_hashes WHERE path = ?", (path,)
+            ).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2], row[3]
+        with run_metrics.timed('hash'):
+            sha1, md5 = file_checksums(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime, sha1, md5)
+            )
+        return sha1, md5
+
+    def lookup(self, checksum):
+        """Return the post ID stored for a checksum (0 if unknown ID), or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT post_id FROM uploads WHERE checksum = ?", (checksum,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0] or 0
+
+    def lookup_md5(self, checksum_md5):
+        """Return the post ID stored for an MD5 checksum (0 if unknown ID), or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT post_id FROM uploads WHERE checksum_md5 = ?", (checksum_md5,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0] or 0
+
+    def add(self, checksum, checksum_md5=None, path=None, post_id=None):
+        """Record content as present on the server"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                (checksum, checksum_md5, str(path) if path else None, post_id, time.time())
+            )
+
+    def add_many(self, rows):
+        """Record many (checksum, checksum_md5, post_id) rows at once"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO uploads VALUES (?, ?, NULL, ?, ?)",
+                [(checksum, md5, post_id, now) for checksum, md5, post_id in rows]
+            )
+
+    def confirmed(self, checksum):
+        """Return (post_id, uploaded_at) for content known to be on the server, or None"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT post_id, uploaded_at FROM uploads WHERE checksum = ?", (checksum,)
+            ).fetchone()
+
+    def add_compacted(self, path, checksum, post_id, size, post_metadata):
+        """Keep a compact record of a media file that is being deleted"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO compacted VALUES (?, ?, ?, ?, ?, ?)",
+                (str(path), checksum, post_id, size, json.dumps(post_metadata), time.time())
+            )
+
+    def was_compacted(self, path):
+        """Whether compaction deleted the file at path (its content is on the server)"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM compacted WHERE path = ?", (os.path.abspath(path),)
+            ).fetchone() is not None
+
+    def count(self):
+        """Number of checksums known to be on the server"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def journal_path(download_dir):
+    """Path of the job journal kept next to the download directory"""
+    path = Path(download_dir).resolve()
+    return path.parent / f"{path.name}.journal.jsonl"
+
+class JobJournal:
+    """Append-only JSONL log of a job and its per-file upload progress"""
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.job = None
+        self.files = {}  # file -> last state record
+        self.tokens = {}  # file -> (token, time obtained)
+        if resume:
+            self._load()
+        self.handle = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        """Replay the journal, keeping the state of the last job only"""
+        if not self.path.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last line after a crash
+                    continue
+                event = record.get('event')
+                if event == 'job':
+                    self.job = record
+                    self.files = {}
+                    self.tokens = {}
+                elif event == 'download_done' and self.job is not None:
+                    self.job['download_done'] = True
+                elif 'file' in record:
+                    self._apply(record)
+
+    def _apply(self, record):
+        self.files[record['file']] = record
+        if record['event'] == 'token':
+            self.tokens[record['file']] = (record['token'], record['time'])
+        elif record['event'] == 'posted':
+            self.tokens.pop(record['file'], None)
+
+    def write(self, event, **fields):
+        """Append a record and flush it to disk"""
+        record = {"event": event, "time": time.time()}
+        record.update(fields)
+        with self.lock:
+            if 'file' in record:
+                self._apply(record)
+            self.handle.write(json.dumps(record) + "\n")
+            self.handle.flush()
+
+    def start_job(self, **params):
+        """Record the parameters of a new job"""
+        self.write('job', **params)
+        self.job = dict(params)
+
+    def record(self, filepath, state, **fields):
+        """Record the state of a file: 'token', 'posted' or 'failed'"""
+        self.write(state, file=str(Path(filepath).resolve()), **fields)
+
+    def state(self, filepath):
+        """Return the last recorded state of a file, or None"""
+        with self.lock:
+            record = self.files.get(str(Path(filepath).resolve()))
+        return record['event'] if record else None
+
+    def usable_token(self, filepath):
+        """Return an upload token obtained earlier that hasn't expired yet"""
+        with self.lock:
+            entry = self.tokens.get(str(Path(filepath).resolve()))
+        if entry and time.time() - entry[1] < UPLOAD_TOKEN_TTL:
+            return entry[0]
+        return None
+
+    def summary(self):
+        """Count files per state"""
+        counts = {}
+        with self.lock:
+            for record in self.files.values():
+                counts[record['event']] = counts.get(record['event'], 0) + 1
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
+
+def archive_path(download_dir):
+    """Path of the gallery-dl download archive used by sync mode, the staging store and compaction"""
+    path = Path(download_dir).resolve()
+    return path.parent / f"{path.name}.archive.sqlite3"
+
+def download_archive_enabled():
+    """Whether every download is recorded in the archive (files may be deleted after upload)"""
+    return DOWNLOAD_ARCHIVE or STAGING_STORE
+
+# Post/tweet ID at the start of gallery-dl's default file names:
+# '{category}_{id}_{md5}.{ext}' for boorus, '{tweet_id}_{num}.{ext}' for Twitter
+FILENAME_ID_RE = re.compile(r'^(?:[a-z][a-z0-9]*_)?(\d+)')
+
+def post_id_from_file(filepath, metadata_path=None):
+    """Return the post/tweet ID of a downloaded file, from its sidecar or file name"""
+    if metadata_path is not None and metadata_path.exists():
+        try:
+            with open(metadata_path, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            for key in ('tweet_id', 'id'):
+                if str(metadata.get(key, '')).isdigit():
+                    return int(metadata[key])
+        except Exception:
+            pass
+    match = FILENAME_ID_RE.match(Path(filepath).name)
+    return int(match.group(1)) if match else None
+
+class SyncState:
+    """Newest post/tweet ID seen per query, kept in the state database
+
+    A query whose last run stopped at its limit also has a cursor: the lowest
+    ID that run reached (the next run continues below it) and the newest ID
+    seen since the mark was last raised.
+    """
+
+    def __init__(self, db_path):
+        self.conn = connect_state_db(db_path)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sync_state ("
+                "url TEXT PRIMARY KEY, high_water INTEGER, updated_at REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sync_cursor ("
+                "url TEXT PRIMARY KEY, below INTEGER, newest INTEGER, updated_at REAL)"
+            )
+
+    def high_water(self, url):
+        """Return the newest ID seen for a query, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT high_water FROM sync_state WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, url, high_water):
+        """Raise the high-water mark of a query (it never goes down)"""
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT high_water FROM sync_state WHERE url = ?", (url,)).fetchone()
+            if row and row[0] is not None and row[0] >= high_water:
+                return
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)", (url, high_water, time.time())
+            )
+
+    def cursor(self, url):
+        """Return (below, newest) of a query whose last run stopped at its limit, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT below, newest FROM sync_cursor WHERE url = ?", (url,)).fetchone()
+        return tuple(row) if row else None
+
+    def set_cursor(self, url, below, newest):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO sync_cursor VALUES (?, ?, ?, ?)",
+                              (url, below, newest, time.time()))
+
+    def clear_cursor(self, url):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM sync_cursor WHERE url = ?", (url,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class SyncTracker:
+    """gallery-dl options and high-water bookkeeping for one incremental run of a query
+
+    limit is the run's --limit. A run that returns that many files may have
+    stopped above posts newer than the stored mark: it leaves the mark alone
+    and stores a cursor at the lowest ID it reached, so the next run fetches
+    the posts between the mark and the cursor. The mark is raised to the
+    newest ID seen once a run gets through that gap.
+    """
+
+    def __init__(self, state, url, download_dir, limit=None):
+        self.state = state
+        self.url = url
+        self.download_dir = download_dir
+        self.limit = limit
+        self.previous = state.high_water(url)
+        self.cursor = state.cursor(url)
+        self.files = []
+        self.ids = []
+        self.lock = threading.Lock()
+
+    def gallery_dl_args(self):
+        """Options that make gallery-dl stop as soon as it reaches known posts"""
+        args = ["--download-archive", str(archive_path(self.download_dir))]
+        twitter = site_for_url(self.url) == "twitter"
+        key = "tweet_id" if twitter else "id"
+        # Continue below where a run cut off by its limit stopped (--range only counts matching files)
+        below = f"{key} < {self.cursor[0]}" if self.cursor is not None else None
+        if self.previous is None:
+            args.extend(["--abort", str(SYNC_ABORT_AFTER)])
+            if below:
+                args.extend(["--filter", below])
+        elif twitter:
+            # Timelines aren't strictly ordered (pinned tweets, retweets): filter but don't abort
+            condition = f"tweet_id > {self.previous}"
+            args.extend(["--abort", str(SYNC_ABORT_AFTER),
+                         "--filter", f"{below} and {condition}" if below else condition])
+        else:
+            # Stop at the mark, not at the first known files: posts a limited run didn't reach
+            # may sit between those and the mark
+            condition = f"(id > {self.previous} or abort())"
+            args.extend(["--filter", f"{below} and {condition}" if below else condition])
+        return args
+
+    def observe(self, filepath, metadata_path):
+        """Remember a file downloaded (or found) during this run"""
+        with self.lock:
+            self.files.append((filepath, metadata_path))
+
+    def observe_id(self, post_id):
+        """Remember the ID of a post seen without downloading it"""
+        if post_id is not None:
+            with self.lock:
+                self.ids.append(int(post_id))
+
+    def commit(self):
+        """Raise the mark if this run reached it (or the end), else move the cursor; return the mark"""
+        with self.lock:
+            files = list(self.files)
+            ids = list(self.ids)
+        limited = self.limit is not None and len(files) + len(ids) >= self.limit
+        ids += [i for i in (post_id_from_file(f, m) for f, m in files) if i is not None]
+        newest = max(ids + ([self.cursor[1]] if self.cursor is not None else []), default=None)
+        if limited:
+            # Raising the mark now would skip the posts below the cut-off for good
+            if ids:
+                self.state.set_cursor(self.url, min(ids), newest)
+            return self.previous
+        if newest is not None:
+            self.state.update(self.url, newest)
+        if self.cursor is not None:
+            self.state.clear_cursor(self.url)
+        return newest if newest is not None else self.previous
+
+def reset_upload_stats():
+    """Zero all upload_stats counters and phase timings"""
+    with stats_lock:
+        for key in upload_stats:
+            upload_stats[key] = 0
+    run_metrics.reset()
+
+def record_stat(key, amount=1, stats=None):
+    """Increment an upload_stats counter (and an optional per-query stats dict) from any thread"""
+    with stats_lock:
+        upload_stats[key] += amount
+        if stats is not None:
+            stats[key] = stats.get(key, 0) + amount
+
+def record_outcome(item, outcome, stats=None, **fields):
+    """Count a file as uploaded/skipped/failed/quarantined and add it to the run report"""
+    record_stat(outcome, stats=stats)
+    run_metrics.file_done(item, outcome, **fields)
+
+class RunMetrics:
+    """Latency histograms per phase plus an optional JSONL report of every file's outcome
+
+    Phases: gallery_dl, discovery, validate, hash, metadata, server_check, perceptual_hash,
+    upload_token, create_post and retry_wait (time spent backing off before a retry).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.report = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}  # phase -> [count, total seconds, cumulative bucket counts]
+            self.started = time.monotonic()
+
+    def observe(self, phase, seconds):
+        """Add one timing to a phase"""
+        with self.lock:
+            entry = self.phases.get(phase)
+            if entry is None:
+                entry = self.phases[phase] = [0, 0.0, [0] * len(LATENCY_BUCKETS)]
+            entry[0] += 1
+            entry[1] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry[2][i] += 1
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Time a with-block as one observation of a phase"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.monotonic() - start)
+
+    def summary(self):
+        """Return {phase: {'count', 'seconds', 'average'}}"""
+        with self.lock:
+            return {phase: {"count": count, "seconds": round(total, 3), "average": round(total / count, 4)}
+                    for phase, (count, total, _) in self.phases.items()}
+
+    def open_report(self, path):
+        """Append per-file outcomes to a JSONL file from now on"""
+        self.close_report()
+        self.report = open(path, 'a', encoding='utf-8')
+
+    def file_done(self, item, outcome, **fields):
+        """Write a file's outcome (and HTTP status, bytes, latency, reason) to the report"""
+        with self.lock:
+            if self.report is not None:
+                record = {"event": "file", "time": time.time(), "path": str(item), "outcome": outcome}
+                record.update((key, value) for key, value in fields.items() if value is not None)
+                self.report.write(json.dumps(record) + "\n")
+                self.report.flush()
+
+    def close_report(self, **fields):
+        """Write a final run record with totals and phase timings, then close the report"""
+        if self.report is None:
+            return
+        with stats_lock:
+            totals = dict(upload_stats)
+        record = {"event": "run", "time": time.time(), "elapsed": round(time.monotonic() - self.started, 3),
+                  "stats": totals, "phases": self.summary()}
+        record.update(fields)
+        with self.lock:
+            self.report.write(json.dumps(record) + "\n")
+            self.report.close()
+            self.report = None
+
+    def prometheus(self):
+        """Return counters, throughput and phase latency histograms in Prometheus text format"""
+        with stats_lock:
+            totals = dict(upload_stats)
+        elapsed = max(1e-9, time.monotonic() - self.started)
+        lines = ["# HELP fitchas_files_total Files by outcome.", "# TYPE fitchas_files_total counter"]
+        for outcome in ("uploaded", "skipped", "failed", "quarantined"):
+            lines.append(f'fitchas_files_total{{outcome="{outcome}"}} {totals[outcome]}')
+        lines += ["# HELP fitchas_retries_total Requests retried after 429/5xx or connection errors.",
+                  "# TYPE fitchas_retries_total counter",
+                  f"fitchas_retries_total {totals['retried']}",
+                  "# HELP fitchas_upload_bytes_total Bytes sent to /api/uploads.",
+                  "# TYPE fitchas_upload_bytes_total counter",
+                  f"fitchas_upload_bytes_total {totals['bytes']}",
+                  "# HELP fitchas_upload_bytes_per_second Average upload throughput of the run.",
+                  "# TYPE fitchas_upload_bytes_per_second gauge",
+                  f"fitchas_upload_bytes_per_second {totals['bytes'] / elapsed:.1f}",
+                  "# HELP fitchas_files_per_second Files uploaded per second in the run.",
+                  "# TYPE fitchas_files_per_second gauge",
+                  f"fitchas_files_per_second {totals['uploaded'] / elapsed:.3f}",
+                  "# HELP fitchas_phase_seconds Time spent per phase.",
+                  "# TYPE fitchas_phase_seconds histogram"]
+        with self.lock:
+            phases = {phase: (count, total, list(buckets)) for phase, (count, total, buckets) in self.phases.items()}
+        for phase, (count, total, buckets) in sorted(phases.items()):
+            for bound, cumulative in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f'fitchas_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'fitchas_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {count}')
+            lines.append(f'fitchas_phase_seconds_sum{{phase="{phase}"}} {total:.6f}')
+            lines.append(f'fitchas_phase_seconds_count{{phase="{phase}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the Prometheus text export atomically (for node_exporter's textfile collector)"""
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+run_metrics = RunMetrics()
+
+# Shared keep-alive session used for every Szurubooru API call
+_session = None
+_session_lock = threading.Lock()
+_http_settings = {"pool_size": HTTP_POOL_SIZE, "retries": HTTP_RETRIES}
+
+def _build_session(pool_size, retries):
+    """Create a requests.Session with a pooled, retrying adapter"""
+    # Only connections that couldn't be made are retried here; retries after a response or a
+    # read error (with their Retry-After waits) belong to adaptive_request, so the limiter sees them
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=HTTP_BACKOFF,
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    """Return the shared Szurubooru session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _build_session(_http_settings["pool_size"], _http_settings["retries"])
+        return _session
+
+def configure_http(pool_size=None, retries=None):
+    """Change pool size/retry policy; the session is rebuilt on next use"""
+    global _session
+    with _session_lock:
+        if pool_size is not None:
+            _http_settings["pool_size"] = max(1, int(pool_size))
+        if retries is not None:
+            _http_settings["retries"] = max(0, int(retries))
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def configure(**settings):
+    """Override configuration values, e.g. configure(szuru_url=..., szuru_token=...)"""
+    global _session
+    for key, value in settings.items():
+        name = key.upper()
+        if name not in CONFIG_KEYS:
+            raise ValueError(f"Unknown setting: {key}")
+        if value is None:
+            continue
+        if name in ("DEFAULT_UPLOAD_WORKERS", "PHASH_DISTANCE", "MAX_UPLOAD_SIZE", "QUEUE_LEASE"):
+            value = int(value)
+        elif name == "ADAPTIVE_MAX_RATE":
+            value = float(value)
+        elif name in ("STAGING_STORE", "GALLERY_DL_IN_PROCESS", "NEAR_DUPLICATES", "VALIDATE_MEDIA",
+                      "DOWNLOAD_ARCHIVE") \
+                and isinstance(value, str):
+            value = value.strip().lower() in ("1", "true", "yes", "on")
+        elif name == "UPLOAD_ORDER" and value not in UPLOAD_ORDERS:
+            raise ValueError(f"Unknown upload order: {value} (one of {', '.join(UPLOAD_ORDERS)})")
+        globals()[name] = value
+    # Rebuild credentials and drop connections made with the old ones
+    headers.clear()
+    headers.update(build_auth_headers(SZURU_USER, SZURU_TOKEN))
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def load_config(path=None):
+    """Load settings from a JSON config file and then the environment"""
+    path = Path(path or os.environ.get("FITCHAS_CONFIG") or CONFIG_FILE)
+    settings = {}
+    if path.exists():
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        settings.update({k.upper(): v for k, v in data.items() if k.upper() in CONFIG_KEYS})
+    # Environment variables win over the config file
+    for name in CONFIG_KEYS:
+        if os.environ.get(name):
+            settings[name] = os.environ[name]
+    configure(**settings)
+    return settings
+
+def api_request(method, endpoint, **kwargs):
+    """Send a request to the Szurubooru API through the shared session"""
+    kwargs.setdefault("timeout", API_TIMEOUTS.get(endpoint.split('/')[0], API_TIMEOUTS["default"]))
+    return get_session().request(method, f"{SZURU_URL}/api/{endpoint}", **kwargs)
+
+def connection_stats():
+    """Return request/connection counters of the shared session"""
+    stats = {"requests": 0, "connections": 0, "reused": 0}
+    with _session_lock:
+        session = _session
+    if session is None:
+        return stats
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+    stats["reused"] = max(0, stats["requests"] - stats["connections"])
+    return stats
+
+class RateLimiter:
+    """Token bucket that limits how many uploads may start per second"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate  # tokens per second, None/0 disables limiting
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available"""
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveLimiter:
+    """AIMD controller for how many uploads run at once and how fast they start
+
+    Fast successful responses raise concurrency (by one per window of
+    responses) and the start rate; 429/5xx, connection errors and latency far
+    above the best seen halve both and honor Retry-After.
+    """
+
+    def __init__(self, workers, max_workers=None, delay=0.5):
+        self.limit = float(max(1, workers))
+        self.max_workers = max(self.limit, max_workers or workers)
+        self.bucket = RateLimiter(1.0 / delay if delay and delay > 0 else None)
+        self.max_rate = max(ADAPTIVE_MAX_RATE, self.bucket.rate or 0)
+        self.active = 0
+        self.best = {}  # Lowest latency seen per endpoint
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self, paced=True):
+        """Block until a request may start
+
+        paced=False only waits for a free slot, not for the start rate: the
+        rate counts files, so a file's second request doesn't take a token.
+        """
+        with self.cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.cond.wait(pause)
+                elif self.active >= int(self.limit):
+                    self.cond.wait()
+                else:
+                    break
+            self.active += 1
+        if paced:
+            self.bucket.acquire()
+
+    def release(self, endpoint, status=None, latency=None, retry_after=None):
+        """Report how a request started with acquire() went (status None = no response)"""
+        with self.cond:
+            self.active -= 1
+            if status is None or status == 429 or status >= 500:
+                self._decrease(retry_after)
+            elif latency is not None:
+                best = self.best.get(endpoint)
+                if best is None or latency < best:
+                    self.best[endpoint] = best = latency
+                if latency > best * ADAPTIVE_LATENCY_FACTOR and latency > 0.5:
+                    self._decrease(None)
+                else:
+                    self._increase()
+            self.cond.notify_all()
+
+    def _increase(self):
+        self.limit = min(self.max_workers, self.limit + 1.0 / self.limit)
+        if self.bucket.rate:
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + ADAPTIVE_RATE_STEP)
+
+    def _decrease(self, retry_after):
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        # One burst of errors counts as a single congestion signal
+        if now - self.decreased_at < ADAPTIVE_COOLDOWN:
+            return
+        self.decreased_at = now
+        self.limit = max(1.0, self.limit / 2)
+        if self.bucket.rate:
+            self.bucket.rate = max(ADAPTIVE_RATE_STEP, self.bucket.rate / 2)
+
+def retry_after_seconds(response):
+    """Seconds from a Retry-After header (delta or HTTP date), or None"""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def request_not_sent(error):
+    """Whether a requests exception happened before the request reached the server"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # Refused/unreachable: requests wraps urllib3's NewConnectionError (a ConnectTimeoutError subclass)
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+def adaptive_request(method, endpoint, limiter=None, retries=TRANSIENT_RETRIES, idempotent=None, paced=True,
+                     **kwargs):
+    """Send an API request through a limiter, retrying 429/5xx and connection errors with jittered backoff
 
-# Track upload stats
-upload_stats = {"uploaded": 0, "failed": 0, "total": 0}
+    paced=False skips the limiter's start rate (see AdaptiveLimiter.acquire), e.g. for the post
+    created from a file that was already uploaded.
+
+    POST isn't idempotent (unless idempotent=True): it is only retried when it never reached the
+    server or the server turned it away (429/503). A read timeout or a connection dropped after
+    sending is raised at once, since the server may still act on the request.
+    Returns the last response; raises the last connection error when every attempt failed.
+    """
+    if idempotent is None:
+        idempotent = method != "POST"
+    data = kwargs.get("data")
+    for attempt in range(retries + 1):
+        if attempt:
+            record_stat('retried')
+            if hasattr(data, 'rewind'):
+                data.rewind()
+        if limiter is not None:
+            limiter.acquire(paced)
+        start = time.monotonic()
+        response = None
+        error = None
+        try:
+            response = api_request(method, endpoint, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        finally:
+            status = response.status_code if response is not None else None
+            retry_after = retry_after_seconds(response)
+            if limiter is not None:
+                # Compare uploads per MB so big files don't look like a slow server
+                latency = (time.monotonic() - start) / max(1.0, len(data) / 1048576 if data is not None else 1.0)
+                limiter.release(endpoint, status, latency, retry_after)
+        
+        if idempotent:
+            transient = error is not None or status == 429 or status >= 500
+        elif error is not None:
+            transient = request_not_sent(error)
+            if not transient:
+                raise error
+        else:
+            transient = status in (429, 503)
+        if not transient or attempt == retries:
+            break
+        with run_metrics.timed('retry_wait'):
+            time.sleep(retry_after or random.uniform(0, TRANSIENT_BACKOFF * 2 ** attempt))
+    if error is not None:
+        raise error
+    return response
 
-def setup_gallery_dl_config(check_twitter=False):
+def setup_gallery_dl_config(check_twitter=False, interactive=True):
     """Setup gallery-dl configuration with Rule34 API credentials"""
-    config_dir = Path.home() / ".config" / "gallery-dl"
-    if os.name == 'nt':  # Windows
-        config_dir = Path(os.environ.get('APPDATA', '')) / "gallery-dl"
-    
-    config_dir.mkdir(parents=True, exist_ok=True)
-    config_file = config_dir / "config.json"
+    config_file = gallery_dl_config_file()
+    config_file.parent.mkdir(parents=True, exist_ok=True)
     
     # Create or update config
     config = {}
@@ -77,7 +999,10 @@ def setup_gallery_dl_config(check_twitter=False):
             print("\n" + "!"*50)
             print("⚠️  WARNING: Twitter cookies not configured!")
             print("!"*50)
-            setup_twitter_cookies(config, config_file)
+            if interactive:
+                setup_twitter_cookies(config, config_file)
+            else:
+                print(f"Configure cookies in {config_file} to download from Twitter.")
         else:
             print("✓ Twitter configuration found")
     
@@ -162,6 +1087,252 @@ def setup_twitter_cookies(config, config_file):
         print("    You can configure this later by editing:")
         print(f"    {config_file}")
 
+def gallery_dl_in_process():
+    """Whether gallery-dl runs inside this process instead of as a subprocess"""
+    return GALLERY_DL_IN_PROCESS and gdl_job is not None
+
+def gallery_dl_config_file():
+    """Path of the user's gallery-dl config file"""
+    config_dir = Path.home() / ".config" / "gallery-dl"
+    if os.name == 'nt':  # Windows
+        config_dir = Path(os.environ.get('APPDATA', '')) / "gallery-dl"
+    return config_dir / "config.json"
+
+_gallery_dl_files = None
+_gallery_dl_files_lock = threading.Lock()
+_gallery_dl_find_lock = threading.Lock()  # gallery-dl's extractor lookup isn't thread-safe
+_gallery_dl_local = threading.local()  # .conf: config of the engine running in this thread
+_gallery_dl_scoped = False
+
+def _scoped_config_function(function):
+    """Wrap a gallery_dl.config function to default to the config of this thread's engine"""
+    position = list(inspect.signature(function).parameters).index("conf")
+    
+    @functools.wraps(function)
+    def scoped(*args, **kwargs):
+        conf = getattr(_gallery_dl_local, "conf", None)
+        if conf is not None and len(args) <= position and "conf" not in kwargs:
+            kwargs["conf"] = conf
+        return function(*args, **kwargs)
+    return scoped
+
+def scoped_gallery_dl_config():
+    """Make gallery-dl's config lookups use the running engine's config instead of the global one
+
+    gallery-dl modules read settings through gallery_dl.config.get/interpolate/...
+    with its global config dict as default. Those functions are replaced once by
+    wrappers that pass the config of the GalleryDlEngine running in the current
+    thread, so every section applies per run; other threads see gallery-dl's
+    normal behaviour.
+    """
+    global _gallery_dl_scoped
+    with _gallery_dl_files_lock:
+        if _gallery_dl_scoped:
+            return
+        for name in ["get", "interpolate", "interpolate_common", "accumulate", "set", "setdefault", "unset"]:
+            setattr(gdl_config, name, _scoped_config_function(getattr(gdl_config, name)))
+        getg = gdl_config.getg
+        gdl_config.getg = lambda key, default=None: (
+            _gallery_dl_local.conf.get(key, default) if getattr(_gallery_dl_local, "conf", None) is not None
+            else getg(key, default))
+        _gallery_dl_scoped = True
+
+def gallery_dl_user_config(reload=False):
+    """The user's gallery-dl config files, read once per process and never written"""
+    global _gallery_dl_files
+    with _gallery_dl_files_lock:
+        if _gallery_dl_files is None or reload:
+            conf = {}
+            gdl_config.load(conf=conf)
+            _gallery_dl_files = conf
+        return _gallery_dl_files
+
+def gallery_dl_overlay():
+    """In-memory gallery-dl config for one run: the user's config files plus our credentials"""
+    conf = json.loads(json.dumps(gallery_dl_user_config()))
+    extractors = conf.setdefault("extractor", {})
+    rule34 = extractors.setdefault("rule34", {})
+    # Same rule as setup_gallery_dl_config: real credentials in the user's config win
+    if rule34.get("api-key") in [None, RULE34_API_KEY]:
+        rule34["api-key"] = RULE34_API_KEY
+    if rule34.get("user-id") in [None, RULE34_USER_ID]:
+        rule34["user-id"] = RULE34_USER_ID
+    if TWITTER_COOKIES:
+        # A cookies.txt path, or the name of a browser to read the cookies from
+        cookies = TWITTER_COOKIES if os.path.exists(TWITTER_COOKIES) else [TWITTER_COOKIES]
+        extractors.setdefault("twitter", {})["cookies"] = cookies
+    return conf
+
+def check_gallery_dl_config(check_twitter=False, interactive=True):
+    """In-process counterpart of setup_gallery_dl_config: only warns, nothing is rewritten per run"""
+    if not check_twitter:
+        return
+    if gallery_dl_overlay()["extractor"].get("twitter"):
+        print("✓ Twitter configuration found")
+        return
+    config_file = gallery_dl_config_file()
+    print("\n" + "!"*50)
+    print("⚠️  WARNING: Twitter cookies not configured!")
+    print("!"*50)
+    if not interactive:
+        print(f"Configure cookies in {config_file} (or set TWITTER_COOKIES) to download from Twitter.")
+        return
+    # The user asked for this one, so it is saved to their gallery-dl config
+    config = {}
+    if config_file.exists():
+        with open(config_file, 'r') as f:
+            try:
+                config = json.load(f)
+            except ValueError:
+                config = {}
+    config_file.parent.mkdir(parents=True, exist_ok=True)
+    setup_twitter_cookies(config, config_file)
+    gallery_dl_user_config(reload=True)
+
+def apply_gallery_dl_args(conf, argv):
+    """Apply gallery-dl command line options to a config dict, the way gallery-dl's main() does"""
+    args = gdl_option.build_parser().parse_args(argv)
+    for path, key, value in args.options:
+        gdl_config.set(path, key, value, conf=conf)
+    if args.postprocessors:
+        gdl_config.set((), "postprocessors", args.postprocessors, conf=conf)
+    if args.abort:
+        gdl_config.set((), "skip", f"abort:{args.abort}", conf=conf)
+    return args
+
+class _FileOutput:
+    """gallery-dl output that hands each finished (or already present) file to a callback"""
+    
+    def __init__(self, engine, echo):
+        self.engine = engine
+        self.echo = echo
+    
+    def start(self, path):
+        self.engine.check_stopped()
+    
+    def skip(self, path):
+        # Same as the '# path' lines of the subprocess: existing files are reported too
+        if path and os.path.isfile(path):
+            self.success(path)
+    
+    def success(self, path):
+        if self.echo:
+            print(path)
+        self.engine.files.put(path)
+        self.engine.check_stopped()
+    
+    def progress(self, bytes_total, bytes_downloaded, bytes_per_second):
+        pass
+
+class GalleryDlEngine:
+    """Runs gallery-dl through its Python API on a thread of this process
+
+    Every run gets its own copy of the configuration (the user's gallery-dl
+    config files plus the Rule34 credentials and Twitter cookies set here),
+    so concurrent runs never share or rewrite ~/.config/gallery-dl/config.json.
+    gallery-dl reads all of it (extractor, downloader, output, postprocessor
+    sections) through scoped_gallery_dl_config() while the run's thread works.
+    Finished file paths are put on `files` (then None) as gallery-dl reports
+    them; wait() and terminate() mirror the subprocess.Popen methods the
+    callers use.
+    """
+    
+    def __init__(self, url, limit=None, download_dir=DOWNLOAD_DIR, write_metadata=True, extra_args=None,
+                 echo=False):
+        scoped_gallery_dl_config()
+        self.conf = gallery_dl_overlay()
+        self.download_dir = download_dir
+        self.index = None  # Compacted files, while running
+        cmd = build_gallery_dl_cmd(url, limit, download_dir, write_metadata, extra_args=extra_args)
+        self.args = apply_gallery_dl_args(self.conf, cmd[1:])
+        self.url = url
+        self.echo = echo
+        self.files = queue.Queue()
+        self.returncode = None
+        self._stopped = False
+        self._thread = None
+    
+    def extractor(self, url):
+        with _gallery_dl_find_lock:
+            extr = gdl_extractor.find(url)
+        if extr is None:
+            raise gdl_exception.NoExtractorError()
+        return extr
+    
+    def check_stopped(self):
+        if self._stopped:
+            raise gdl_exception.TerminateExtraction()
+    
+    def run(self):
+        """Download in the calling thread and return gallery-dl's exit status"""
+        if state_db_path(self.download_dir).exists():
+            self.index = UploadIndex(state_db_path(self.download_dir))
+        _gallery_dl_local.conf = self.conf
+        try:
+            self.returncode = _EngineDownloadJob(self.extractor(self.url), engine=self).run()
+        except gdl_exception.NoExtractorError:
+            print(f"gallery-dl: unsupported URL '{self.url}'", file=sys.stderr)
+            self.returncode = 64
+        except gdl_exception.TerminateExtraction:
+            self.returncode = 1
+        except Exception as e:
+            print(f"gallery-dl: {e}", file=sys.stderr)
+            self.returncode = 1
+        finally:
+            _gallery_dl_local.conf = None
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+            self.files.put(None)
+        return self.returncode
+    
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="gallery-dl", daemon=True)
+        self._thread.start()
+        return self
+    
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+        return self.returncode
+    
+    def terminate(self):
+        # Takes effect at the next file gallery-dl starts or finishes
+        self._stopped = True
+    
+    def list_files(self):
+        """Run gallery-dl's --dump-json job in this process, return (exit code, [(file_url, metadata)])"""
+        out = io.StringIO()
+        _gallery_dl_local.conf = self.conf
+        try:
+            data_job = gdl_job.DataJob(self.extractor(self.url), file=out)
+            data_job.run()
+        except gdl_exception.NoExtractorError:
+            return 64, []
+        finally:
+            _gallery_dl_local.conf = None
+        messages = json.loads(out.getvalue()) if out.getvalue().strip() else []
+        return (1 if data_job.exception else 0), messages
+
+if gdl_job is not None:
+    class _EngineDownloadJob(gdl_job.DownloadJob):
+        """gallery-dl DownloadJob that reports files to the engine and skips compacted ones"""
+        
+        def __init__(self, extr, parent=None, engine=None):
+            self.engine = engine or parent.engine
+            gdl_job.DownloadJob.__init__(self, extr, parent)
+            self.out = _FileOutput(self.engine, self.engine.echo)
+        
+        def initialize(self, kwdict=None):
+            gdl_job.DownloadJob.initialize(self, kwdict)
+            index = self.engine.index
+            if index is not None:
+                # Files deleted by compaction are on the server: skip them like files on disk,
+                # also when the download archive doesn't know them
+                pathfmt = self.pathfmt
+                exists = pathfmt.exists
+                pathfmt.exists = lambda: exists() or index.was_compacted(pathfmt.realpath)
+
 def print_progress_bar(current, total, bar_length=40):
     """Print a progress bar"""
     percent = float(current) / total
@@ -172,230 +1343,2330 @@ def print_progress_bar(current, total, bar_length=40):
     sys.stdout.write(f'\r[{arrow}{spaces}] {current}/{total} ({int(percent * 100)}%)')
     sys.stdout.flush()
 
-def get_file_token(filepath):
+class MultipartFileStream:
+    """multipart/form-data request body that streams a file in fixed-size chunks
+
+    Only one chunk is in memory at a time, so memory use per upload doesn't
+    depend on the file size.
+    """
+
+    def __init__(self, filepath, field="content", chunk_size=UPLOAD_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.boundary = uuid.uuid4().hex
+        filename = Path(filepath).name.replace('"', '%22')
+        mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        head = (f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f'Content-Type: {mime}\r\n\r\n').encode('utf-8')
+        tail = f'\r\n--{self.boundary}--\r\n'.encode('ascii')
+        self.head = head
+        self.tail = tail
+        self.file = open(filepath, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.length = len(head) + self.size + len(tail)
+        self.rewind()
+
+    def rewind(self):
+        """Start the body over, e.g. to send it again after a failed request"""
+        self.file.seek(0)
+        self.parts = [io.BytesIO(self.head), self.file, io.BytesIO(self.tail)]
+        self.sent = 0
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        """Return up to size bytes (at most chunk_size) of the encoded body"""
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        while self.parts:
+            data = self.parts[0].read(size)
+            if data:
+                self.sent += len(data)
+                return data
+            self.parts.pop(0)
+        return b''
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def get_file_token(filepath, metrics=None, limiter=None):
     """Upload file and get token from Szurubooru"""
+    start = time.monotonic()
     try:
-        with open(filepath, 'rb') as f:
-            files = {'content': f}
-            response = requests.post(
-                f"{SZURU_URL}/api/uploads",
-                headers=headers,
-                files=files,
-                timeout=60
-            )
+        with MultipartFileStream(filepath) as body:
+            # Sending a file twice only leaves an unused temporary token on the server
+            response = adaptive_request("POST", "uploads", limiter, idempotent=True, data=body,
+                                        headers={"Content-Type": body.content_type})
+            
+            # Time to token and transfer rate of this file
+            if metrics is not None:
+                metrics['bytes'] = body.size
+                metrics['seconds'] = time.monotonic() - start
+                metrics['status'] = response.status_code
             
             if response.status_code == 200:
                 return response.json()['token']
             else:
                 return None
     except Exception as e:
+        if metrics is not None:
+            metrics['error'] = str(e)
         return None
+    finally:
+        run_metrics.observe('upload_token', time.monotonic() - start)
 
-def create_post(token, tags, safety="safe", source=None):
-    """Create a post in Szurubooru"""
-    try:
-        data = {
-            "tags": tags,
-            "safety": safety,
-            "contentToken": token
-        }
+class TagCache:
+    """Client-side cache of Szurubooru tags and categories with batched tag creation"""
+
+    def __init__(self, ttl=TAG_CACHE_TTL):
+        self.ttl = ttl
+        self.tags = {}  # lowercase name -> (category, version)
+        self.categories = set()
+        self.default_category = None
+        self.loaded_at = None
+        self.available = False  # False until a full load succeeded
+        self.lock = threading.Lock()
+        self.created = 0
+        # One pool for the cache's lifetime; ensure() runs once per uploaded file
+        self.executor = ThreadPoolExecutor(max_workers=TAG_CREATE_WORKERS, thread_name_prefix="tags")
+
+    def refresh(self, force=False):
+        """(Re)load all tags and categories from the server once the TTL has passed"""
+        with self.lock:
+            if not force and self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl:
+                return
+            # Don't retry a failed load before the TTL passes
+            self.loaded_at = time.monotonic()
+            response = adaptive_request("GET", "tag-categories")
+            if response.status_code == 200:
+                results = response.json().get('results', [])
+                self.categories = {c['name'] for c in results}
+                self.default_category = next((c['name'] for c in results if c.get('default')), None)
+            
+            tags = {}
+            offset = 0
+            while True:
+                response = adaptive_request("GET", "tags/", params={
+                    "offset": offset,
+                    "limit": 100,
+                    "fields": "names,category,version"
+                })
+                if response.status_code != 200:
+                    return
+                page = response.json()
+                results = page.get('results', [])
+                for tag in results:
+                    for name in tag.get('names', []):
+                        tags[name.lower()] = (tag.get('category'), tag.get('version'))
+                offset += len(results)
+                if not results or offset >= page.get('total', 0):
+                    break
+            self.tags = tags
+            self.available = True
+
+    def szuru_category(self, booru_category):
+        """Map a booru tag category to an existing Szurubooru category (None = default)"""
+        category = TAG_CATEGORY_MAP.get(booru_category) if booru_category else None
+        return category if category in self.categories else None
+
+    def ensure(self, tag_categories):
+        """Create every tag in {tag: booru category} missing on the server, in one pass"""
+        try:
+            self.refresh()
+        except Exception:
+            pass
+        if not self.available:
+            return 0
         
-        if source:
-            data["source"] = source
+        create = {}
+        recategorize = {}
+        with self.lock:
+            for name, booru_category in tag_categories.items():
+                category = self.szuru_category(booru_category)
+                known = self.tags.get(name.lower())
+                if known is None:
+                    create[name] = category or self.default_category
+                    # Claim it so other workers don't create it too
+                    self.tags[name.lower()] = (create[name], None)
+                elif category and known[0] == self.default_category and known[1] is not None:
+                    # Auto-created earlier without its booru category
+                    recategorize[name] = (category, known[1])
+                    self.tags[name.lower()] = (category, None)
         
-        response = requests.post(
-            f"{SZURU_URL}/api/posts",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
+        if not create and not recategorize:
+            return 0
         
+        created = sum(self.executor.map(lambda item: self._create(*item), create.items()))
+        list(self.executor.map(lambda item: self._recategorize(item[0], *item[1]), recategorize.items()))
+        with self.lock:
+            self.created += created
+        return created
+
+    def _create(self, name, category):
+        data = {"names": [name]}
+        if category:
+            data["category"] = category
+        try:
+            response = api_request("POST", "tags", json=data)
+        except Exception:
+            return 0
         if response.status_code == 200:
-            return response.json()
-        else:
-            return None
-    except Exception as e:
-        return None
+            tag = response.json()
+            with self.lock:
+                self.tags[name.lower()] = (tag.get('category'), tag.get('version'))
+            return 1
+        # Already exists (created elsewhere) or invalid name: let post creation handle it
+        return 0
 
-def extract_twitter_tags(metadata):
-    """Extract tags from Twitter/X metadata including hashtags and username"""
-    tags = []
-    
-    try:
-        # Add username as a tag (remove @ symbol)
-        if 'author' in metadata and isinstance(metadata['author'], dict):
-            if 'name' in metadata['author'] and metadata['author']['name']:
-                username = str(metadata['author']['name']).strip()
-                if username:
-                    # Clean username and add it
-                    username_tag = username.lower().replace(' ', '_')
-                    tags.append(f"user_{username_tag}")
-        
-        # Add hashtags from the tweet text
-        if 'content' in metadata and metadata['content']:
-            content = str(metadata['content'])
-            # Find all hashtags in the content
-            hashtags = re.findall(r'#(\w+)', content)
-            for tag in hashtags:
-                tags.append(tag.lower())
-        
-        # Also check description field
-        if 'description' in metadata and metadata['description']:
-            description = str(metadata['description'])
-            hashtags = re.findall(r'#(\w+)', description)
-            for tag in hashtags:
-                tag_clean = tag.lower()
-                if tag_clean not in tags:
-                    tags.append(tag_clean)
-        
-        # Check for tweet text field (alternative field name)
-        if 'tweet' in metadata and isinstance(metadata['tweet'], dict):
-            if 'full_text' in metadata['tweet'] and metadata['tweet']['full_text']:
-                tweet_text = str(metadata['tweet']['full_text'])
-                hashtags = re.findall(r'#(\w+)', tweet_text)
-                for tag in hashtags:
-                    tag_clean = tag.lower()
-                    if tag_clean not in tags:
-                        tags.append(tag_clean)
-        
-        # Add a general twitter tag
-        tags.append('twitter')
-        
-    except Exception as e:
-        # Silent fail - just add twitter tag
-        if 'twitter' not in tags:
-            tags.append('twitter')
-    
-    return tags
+    def _recategorize(self, name, category, version):
+        try:
+            response = adaptive_request("PUT", f"tag/{quote(name, safe='')}",
+                                        json={"version": version, "category": category})
+            if response.status_code == 200:
+                with self.lock:
+                    self.tags[name.lower()] = (category, response.json().get('version'))
+        except Exception:
+            pass
 
-def upload_file(filepath, metadata_path, silent=False, is_twitter=False):
-    """Upload a single file to Szurubooru"""
-    filename = filepath.name
-    
-    # Read metadata if available
-    tags = []
-    source = None
-    safety = "safe"
-    
-    if metadata_path.exists():
+_tag_cache = None
+
+def get_tag_cache():
+    """Return the shared tag cache, creating it on first use"""
+    global _tag_cache
+    with _session_lock:
+        if _tag_cache is None:
+            _tag_cache = TagCache()
+        return _tag_cache
+
+def warm_index_from_server(index, page_size=100):
+    """Load the checksums of all posts already on Szurubooru into the index"""
+    offset = 0
+    added = 0
+    while True:
         try:
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-                
-                # Check if this is Twitter content
-                if is_twitter or 'twitter' in str(metadata_path) or metadata.get('subcategory') == 'tweets':
-                    # Extract Twitter-specific tags
-                    tags = extract_twitter_tags(metadata)
-                    
-                    # Get source URL from Twitter metadata
-                    if 'tweet_id' in metadata and 'author' in metadata:
-                        username = metadata['author'].get('name', '').strip()
-                        tweet_id = metadata['tweet_id']
-                        source = f"https://twitter.com/{username}/status/{tweet_id}"
-                    elif 'url' in metadata:
-                        source = metadata['url']
-                else:
-                    # Standard booru tag extraction
-                    if 'tags' in metadata:
-                        if isinstance(metadata['tags'], list):
-                            tags = metadata['tags']
-                        elif isinstance(metadata['tags'], str):
-                            tags = metadata['tags'].split()
-                    elif 'tag_string' in metadata:
-                        tags = metadata['tag_string'].split()
-                    
-                    # Get source URL
-                    if 'source' in metadata:
-                        source = metadata['source']
-                    elif 'file_url' in metadata:
-                        source = metadata['file_url']
-                    
-                    # Determine safety rating for booru content
-                    rating = metadata.get('rating', 's')
-                    if rating in ['e', 'explicit']:
-                        safety = "unsafe"
-                    elif rating in ['q', 'questionable']:
-                        safety = "sketchy"
+            response = adaptive_request("GET", "posts/", params={
+                "offset": offset,
+                "limit": page_size,
+                "fields": "id,checksum,checksumMD5"
+            })
         except Exception as e:
-            if not silent:
-                print(f"Error reading metadata: {e}")
-    
-    # Upload file
-    token = get_file_token(filepath)
-    
-    if not token:
-        upload_stats['failed'] += 1
-        if not silent:
-            print(f"\nFailed to upload: {filename}")
-        return False
-    
-    # Create post
-    post = create_post(token, tags, safety, source)
-    
-    if post:
-        upload_stats['uploaded'] += 1
-        return True
-    else:
-        upload_stats['failed'] += 1
-        if not silent:
-            print(f"\nFailed to create post: {filename}")
-        return False
+            print(f"\nError reading posts from server: {e}")
+            break
+        if response.status_code != 200:
+            print(f"\nError reading posts from server: HTTP {response.status_code}")
+            break
+        page = response.json()
+        results = page.get('results', [])
+        index.add_many(
+            (post['checksum'], post.get('checksumMD5'), post['id'])
+            for post in results if post.get('checksum')
+        )
+        added += len(results)
+        offset += len(results)
+        if not results or offset >= page.get('total', 0):
+            break
+    return added
+
+def find_posts_by_checksum(checksums):
+    """Look up posts by SHA1 content checksum in batches, return {checksum: post}"""
+    found = {}
+    checksums = list(checksums)
+    for start in range(0, len(checksums), CHECKSUM_BATCH):
+        batch = checksums[start:start + CHECKSUM_BATCH]
+        with run_metrics.timed('server_check'):
+            response = adaptive_request("GET", "posts/", params={
+                "query": "content-checksum:" + ",".join(batch),
+                "limit": len(batch),
+                "fields": "id,version,checksum,checksumMD5,tags"
+            })
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        for post in response.json().get('results', []):
+            found[post['checksum']] = post
+    return found
+
+def merge_post_tags(post, tags):
+    """Add tags missing from an existing post, return the number added"""
+    current = [tag['names'][0] for tag in post.get('tags', []) if tag.get('names')]
+    known = {name.lower() for tag in post.get('tags', []) for name in tag.get('names', [])}
+    missing = [tag for tag in dict.fromkeys(tags) if tag.lower() not in known]
+    if not missing:
+        return 0
+    response = adaptive_request("PUT", f"post/{post['id']}", json={
+        "version": post['version'],
+        "tags": current + missing
+    })
+    return len(missing) if response.status_code == 200 else 0
+
+def merge_metadata_tags(post, metadata_path, is_twitter=False, tag_cache=None):
+    """Add the tags of a file's sidecar to an existing post (counted as 'merged')"""
+    post_metadata = read_post_metadata(metadata_path, is_twitter)
+    tags = post_metadata['tags']
+    if not tags:
+        return
+    if tag_cache is not None:
+        tag_cache.ensure({tag: post_metadata['tag_categories'].get(tag) for tag in tags})
+    if merge_post_tags(post, tags):
+        record_stat('merged')
+
+class ServerDedup:
+    """Asks Szurubooru which local files it already has before they are uploaded
+
+    Posts found on the server are recorded in the upload index (so upload_file
+    skips them); checksums it doesn't have are remembered for the rest of the run.
+    Streamed files (check_streamed) are grouped: the files arriving within
+    SERVER_CHECK_WINDOW, up to CHECKSUM_BATCH of them, share one query.
+    """
+
+    def __init__(self, index, merge_tags=False, tag_cache=None):
+        self.index = index
+        self.merge_tags = merge_tags
+        self.tag_cache = tag_cache
+        self.missing = set()
+        self.group = None  # {'files', 'full', 'done'} of the streamed files collecting for the next query
+        self.lock = threading.Lock()
+
+    def check_streamed(self, entry):
+        """Check one (filepath, metadata_path, is_twitter) entry in a query shared with the files around it
+
+        Blocks for at most SERVER_CHECK_WINDOW plus the query.
+        """
+        try:
+            checksum, _ = self.index.checksums(entry[0])  # Hashed on the calling upload worker
+        except OSError:
+            return
+        with self.lock:
+            if checksum in self.missing:
+                return
+        if self.index.lookup(checksum) is not None:
+            return
+        with self.lock:
+            group = self.group
+            first = group is None
+            if first:
+                group = self.group = {"files": [], "full": threading.Event(), "done": threading.Event()}
+            group['files'].append(entry)
+            if len(group['files']) >= CHECKSUM_BATCH:
+                group['full'].set()
+                self.group = None
+        if not first:
+            group['done'].wait()
+            return
+        # The first file of a group waits for the others and sends the query for all of them
+        group['full'].wait(SERVER_CHECK_WINDOW)
+        with self.lock:
+            if self.group is group:
+                self.group = None
+        try:
+            self.check(group['files'])
+        finally:
+            group['done'].set()
+
+    def check(self, files):
+        """Check (filepath, metadata_path, is_twitter) entries in one go, return how many were found"""
+        pending = {}
+        for filepath, metadata_path, is_twitter in files:
+            try:
+                checksum, checksum_md5 = self.index.checksums(filepath)
+            except OSError:
+                continue
+            with self.lock:
+                if checksum in self.missing:
+                    continue
+            if self.index.lookup(checksum) is None:
+                pending.setdefault(checksum, (filepath, metadata_path, is_twitter, checksum_md5))
+        if not pending:
+            return 0
+        
+        try:
+            found = find_posts_by_checksum(pending)
+        except Exception:
+            # Not fatal: the files are simply uploaded
+            return 0
+        
+        with self.lock:
+            self.missing.update(checksum for checksum in pending if checksum not in found)
+        for checksum, post in found.items():
+            filepath, metadata_path, is_twitter, checksum_md5 = pending[checksum]
+            if self.merge_tags:
+                self._merge(post, metadata_path, is_twitter)
+            self.index.add(checksum, post.get('checksumMD5') or checksum_md5, filepath, post.get('id'))
+        return len(found)
+
+    def _merge(self, post, metadata_path, is_twitter):
+        try:
+            merge_metadata_tags(post, metadata_path, is_twitter, self.tag_cache)
+        except Exception:
+            pass
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II matrix, so dct(x) = D @ x @ D.T"""
+    k = numpy.arange(n)[:, None]
+    matrix = numpy.cos(numpy.pi * (2 * numpy.arange(n)[None, :] + 1) * k / (2 * n)) * numpy.sqrt(2 / n)
+    matrix[0] /= numpy.sqrt(2)
+    return matrix
+
+def _bits_to_int(bits):
+    return int.from_bytes(numpy.packbits(bits.ravel()).tobytes(), 'big')
+
+def image_hashes(path):
+    """Return (aHash, dHash, pHash) of an image as 64-bit ints, or None if it can't be decoded
+
+    Runs in the near-duplicate process pool, so it only takes and returns plain values.
+    """
+    try:
+        with Image.open(path) as image:
+            # JPEGs are decoded at a fraction of their size, which is all the hashes need
+            image.draft("L", (64, 64))
+            gray = image.convert("L")
+    except Exception:
+        return None
+    small = numpy.asarray(gray.resize((8, 8), Image.LANCZOS), dtype=numpy.float64)
+    wide = numpy.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=numpy.float64)
+    large = numpy.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=numpy.float64)
+    dct = _dct_matrix(32)
+    low = (dct @ large @ dct.T)[:8, :8]
+    return (_bits_to_int(small > small.mean()),
+            _bits_to_int(wide[:, 1:] > wide[:, :-1]),
+            _bits_to_int(low > numpy.median(low)))
+
+def _to_signed64(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _popcount(values):
+    """Number of set bits of each uint64"""
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(numpy.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+_POPCOUNT_TABLE = numpy.array([bin(n).count("1") for n in range(256)], dtype=numpy.uint8) \
+    if numpy is not None else None
+
+class PerceptualIndex:
+    """aHash/dHash/pHash of content on Szurubooru, in NumPy arrays for batched Hamming queries
+
+    Rows are kept in the state database (perceptual_hashes) and loaded into
+    memory once; a query compares against every known post in a few vector
+    operations. Files found to be near-duplicates are stored too, so later
+    runs answer them by checksum without decoding them again.
+    """
+
+    def __init__(self, db_path):
+        self.conn = connect_state_db(str(db_path))
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS perceptual_hashes ("
+                "checksum TEXT PRIMARY KEY, post_id INTEGER, ahash INTEGER, dhash INTEGER, phash INTEGER, "
+                "near_duplicate INTEGER)"
+            )
+            rows = self.conn.execute(
+                "SELECT checksum, post_id, ahash, dhash, phash, near_duplicate FROM perceptual_hashes"
+            ).fetchall()
+        self.known = {row[0]: (row[1], bool(row[5])) for row in rows}
+        posts = [row for row in rows if not row[5]]
+        # One contiguous row per hash kind (aHash, dHash, pHash); grown by doubling,
+        # so adding one post doesn't copy the whole index
+        capacity = max(1024, len(posts) * 2)
+        self.hashes = numpy.zeros((3, capacity), dtype=numpy.uint64)
+        self.post_ids = numpy.zeros(capacity, dtype=numpy.int64)
+        self.size = len(posts)
+        if posts:
+            self.hashes[:, :self.size] = numpy.array([row[2:5] for row in posts], dtype=numpy.int64).view(
+                numpy.uint64).T
+            self.post_ids[:self.size] = [row[1] or 0 for row in posts]
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, checksum):
+        """Return (post_id, near_duplicate) stored for a checksum, or None"""
+        with self.lock:
+            return self.known.get(checksum)
+
+    def add(self, checksum, post_id, hashes, near_duplicate=False):
+        """Remember a file's hashes; only posts (not near-duplicates) are matched against"""
+        with self.lock:
+            if checksum in self.known:
+                return
+            self.known[checksum] = (post_id, near_duplicate)
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO perceptual_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                    (checksum, post_id, *map(_to_signed64, hashes), int(near_duplicate))
+                )
+            if near_duplicate:
+                return
+            if self.size == len(self.post_ids):
+                self.hashes = numpy.concatenate([self.hashes, numpy.zeros_like(self.hashes)], axis=1)
+                self.post_ids = numpy.concatenate([self.post_ids, numpy.zeros_like(self.post_ids)])
+            self.hashes[:, self.size] = numpy.array(hashes, dtype=numpy.uint64)
+            self.post_ids[self.size] = post_id or 0
+            self.size += 1
+
+    def query(self, batch, max_distance=None):
+        """Return the closest post ID (or None) for each (aHash, dHash, pHash) in batch
+
+        A post matches when all three hashes are within max_distance bits.
+        """
+        if not batch:
+            return []
+        max_distance = PHASH_DISTANCE if max_distance is None else max_distance
+        with self.lock:
+            hashes = self.hashes[:, :self.size]
+            post_ids = self.post_ids[:self.size]
+        if not self.size:
+            return [None] * len(batch)
+        queries = numpy.array(batch, dtype=numpy.uint64)
+        results = []
+        # The pHash is scanned for every post (bounded to a few MB per step); the
+        # few candidates it leaves are then checked against aHash and dHash
+        step = max(1, (1 << 21) // hashes.shape[1])
+        for start in range(0, len(queries), step):
+            chunk = queries[start:start + step]
+            close = _popcount(chunk[:, 2, None] ^ hashes[2][None, :]) <= max_distance
+            for query, columns in zip(chunk, map(numpy.flatnonzero, close)):
+                best = None
+                if len(columns):
+                    distances = _popcount(query[:, None] ^ hashes[:, columns]).astype(numpy.int32)
+                    ok = (distances <= max_distance).all(axis=0)
+                    if ok.any():
+                        total = numpy.where(ok, distances.sum(axis=0), 1 << 20)
+                        best = int(post_ids[columns[total.argmin()]])
+                results.append(best)
+        return results
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class NearDuplicateFilter:
+    """Skips files that look like a post already on Szurubooru (resized, re-encoded, ...)
+
+    Perceptual hashes are computed in a process pool and matched against a
+    PerceptualIndex. Uploaded files (and exact duplicates found on the
+    server) are added to the index, so it grows as posts are made. Files of
+    the same run are matched against each other too: a file that looks like
+    one still being uploaded waits in match() until that one is posted, and
+    is only uploaded itself if the first one fails.
+
+    The index only knows posts made (or exact duplicates found) by this tool
+    for the download directory; posts made otherwise aren't matched.
+    """
+
+    def __init__(self, index, merge_tags=False, tag_cache=None, workers=PHASH_WORKERS):
+        self.index = index
+        self.merge_tags = merge_tags
+        self.tag_cache = tag_cache
+        self.hashes = PerceptualIndex(index.db_path)
+        # spawn: forking a process that runs upload threads isn't safe
+        self.pool = ProcessPoolExecutor(max_workers=max(1, workers),
+                                        mp_context=multiprocessing.get_context("spawn"))
+        self.pending = {}  # checksum -> hashes of files checked but not yet posted
+        self.posted = {}  # checksum of a pending file -> Event set once its upload is over
+        self.successors = {}  # checksum of a pending file whose upload failed -> checksum taking its place
+        self.followers = {}  # path -> (checksum of the pending file it looks like, its own checksum, hashes,
+        #                        metadata_path, is_twitter)
+        self.matches = {}  # path -> post ID of the post the file duplicates
+        self.lock = threading.Lock()
+
+    def check(self, files):
+        """Hash (filepath, metadata_path, is_twitter) entries in one go, return how many are near-duplicates"""
+        todo = []
+        found = 0
+        for filepath, metadata_path, is_twitter in files:
+            try:
+                checksum, _ = self.index.checksums(filepath)
+            except OSError:
+                continue
+            known = self.hashes.lookup(checksum)
+            if known is not None:
+                post_id, near_duplicate = known
+                if near_duplicate and self.index.lookup(checksum) is None:
+                    self._match(filepath, post_id)
+                    found += 1
+                continue
+            with self.lock:
+                if checksum in self.pending:
+                    continue
+            todo.append((filepath, metadata_path, is_twitter, checksum))
+        if not todo:
+            return found
+        
+        try:
+            with run_metrics.timed('perceptual_hash'):
+                hashes = list(self.pool.map(image_hashes, [str(entry[0]) for entry in todo]))
+        except Exception:
+            # Not fatal: the files are simply uploaded
+            return found
+        queries = [(entry, value) for entry, value in zip(todo, hashes) if value is not None]
+        for entry, value in queries:
+            filepath, metadata_path, is_twitter, checksum = entry
+            post_id = self.index.lookup(checksum)
+            if post_id is not None:
+                # Exact duplicate already on the server: only grows the index
+                self.hashes.add(checksum, post_id, value)
+        queries = [(entry, value) for entry, value in queries if self.index.lookup(entry[3]) is None]
+        for (entry, value), post_id in zip(queries, self.hashes.query([value for _, value in queries])):
+            filepath, metadata_path, is_twitter, checksum = entry
+            if post_id is None:
+                with self.lock:
+                    leader = self._pending_match(value)
+                    if leader is not None:
+                        # Same artwork as a file of this run that isn't posted yet
+                        self.followers[str(filepath)] = (leader, checksum, value, metadata_path, is_twitter)
+                        found += 1
+                    else:
+                        self._lead(checksum, value)
+                continue
+            self.hashes.add(checksum, post_id, value, near_duplicate=True)
+            self._match(filepath, post_id)
+            if self.merge_tags and post_id:
+                self._merge(post_id, metadata_path, is_twitter)
+            found += 1
+        return found
+
+    def match(self, filepath):
+        """Post ID a checked file is a near-duplicate of (0 if unknown), or None
+
+        For a file that looks like one of this run still being uploaded, waits for that upload.
+        """
+        with self.lock:
+            post_id = self.matches.get(str(filepath))
+            follow = self.followers.pop(str(filepath), None)
+        if post_id is not None or follow is None:
+            return post_id
+        leader, checksum, value, metadata_path, is_twitter = follow
+        while True:
+            self.posted[leader].wait()
+            with self.lock:
+                known = self.hashes.lookup(leader)
+                if known is not None:
+                    break
+                # The first copy wasn't posted: the first file waiting for it takes its place
+                successor = self.successors.setdefault(leader, checksum)
+                if successor == checksum:
+                    self._lead(checksum, value)
+                    return None
+                leader = successor
+        post_id = known[0]
+        self.hashes.add(checksum, post_id, value, near_duplicate=True)
+        self._match(filepath, post_id)
+        if self.merge_tags and post_id:
+            self._merge(post_id, metadata_path, is_twitter)
+        return post_id or 0
+
+    def done(self, filepath):
+        """Call when a file's upload is over: a posted file (or one found on the server) joins the index
+
+        Files of this run that wait in match() for it go on.
+        """
+        try:
+            checksum, _ = self.index.checksums(filepath)
+        except OSError:
+            return
+        post_id = self.index.lookup(checksum)
+        with self.lock:
+            value = self.pending.pop(checksum, None)
+        if value is not None and post_id is not None:
+            self.hashes.add(checksum, post_id, value)
+        with self.lock:
+            posted = self.posted.get(checksum)
+        if posted is not None:
+            posted.set()
+
+    def _lead(self, checksum, value):
+        # Called with self.lock held
+        self.pending[checksum] = value
+        self.posted.setdefault(checksum, threading.Event())
+
+    def _pending_match(self, value):
+        """Checksum of a pending file whose hashes are all within PHASH_DISTANCE of value, or None"""
+        for checksum, other in self.pending.items():
+            if all(bin(a ^ b).count("1") <= PHASH_DISTANCE for a, b in zip(value, other)):
+                return checksum
+        return None
+
+    def _match(self, filepath, post_id):
+        with self.lock:
+            self.matches[str(filepath)] = post_id or 0
+
+    def _merge(self, post_id, metadata_path, is_twitter):
+        try:
+            response = adaptive_request("GET", f"post/{post_id}")
+            if response.status_code == 200:
+                merge_metadata_tags(response.json(), metadata_path, is_twitter, self.tag_cache)
+        except Exception:
+            pass
+
+    def close(self, wait=True):
+        # Nothing waits for an upload that won't happen anymore
+        with self.lock:
+            for posted in self.posted.values():
+                posted.set()
+        self.pool.shutdown(wait=wait)
+        self.hashes.close()
+
+def open_near_duplicate_filter(index, merge_tags=False, tag_cache=None):
+    """Return a NearDuplicateFilter when NEAR_DUPLICATES is on (it needs the index, NumPy and Pillow)"""
+    if not NEAR_DUPLICATES or index is None:
+        return None
+    if numpy is None or Image is None:
+        print("Near-duplicate filter needs NumPy and Pillow (pip install numpy pillow); skipping it")
+        return None
+    return NearDuplicateFilter(index, merge_tags, tag_cache)
+
+def create_post(token, tags, safety="safe", source=None, content_url=None, limiter=None, metrics=None,
+                checksum=None, filepath=None):
+    """Create a post in Szurubooru from an upload token or a URL the server fetches itself
+
+    After a timeout the post is looked up by the content's SHA1 (checksum, or hashed from
+    filepath) before it is sent again; without either the post counts as failed.
+    """
+    start = time.monotonic()
+    try:
+        data = {
+            "tags": tags,
+            "safety": safety
+        }
+        
+        if token:
+            data["contentToken"] = token
+        else:
+            data["contentUrl"] = content_url
+        
+        if source:
+            data["source"] = source
+        
+        try:
+            response = adaptive_request("POST", "posts", limiter, paced=not token, json=data)
+        except (requests.ConnectionError, requests.Timeout):
+            # The server may have created the post after we stopped waiting
+            if checksum is None and filepath is not None:
+                checksum = file_checksums(filepath)[0]
+            if checksum is None:
+                raise
+            existing = find_posts_by_checksum([checksum]).get(checksum)
+            if existing is not None:
+                return existing
+            response = adaptive_request("POST", "posts", limiter, paced=not token, json=data)
+        if metrics is not None:
+            metrics['post_status'] = response.status_code
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            return None
+    except Exception as e:
+        if metrics is not None:
+            metrics['error'] = str(e)
+        return None
+    finally:
+        run_metrics.observe('create_post', time.monotonic() - start)
+
+HASHTAG_RE = re.compile(r'#(\w+)')
+
+def extract_twitter_tags(metadata):
+    """Extract tags from Twitter/X metadata including hashtags and username"""
+    tags = []
+    
+    # Add username as a tag (remove @ symbol)
+    author = metadata.get('author')
+    if isinstance(author, dict) and author.get('name'):
+        username = str(author['name']).strip()
+        if username:
+            tags.append(f"user_{username.lower().replace(' ', '_')}")
+    
+    # Hashtags from the tweet text, description and full_text (alternative field name)
+    texts = [metadata.get('content'), metadata.get('description')]
+    if isinstance(metadata.get('tweet'), dict):
+        texts.append(metadata['tweet'].get('full_text'))
+    for text in texts:
+        if text:
+            tags.extend(tag.lower() for tag in HASHTAG_RE.findall(str(text)))
+    
+    # Add a general twitter tag
+    tags.append('twitter')
+    # Drop duplicates, keeping the first occurrence
+    return list(dict.fromkeys(tags))
+
+def extract_tag_categories(metadata):
+    """Return {tag: booru category} from gallery-dl booru metadata"""
+    # gallery-dl writes 'tags_<category>' (Gelbooru/Rule34 with the 'tags' option),
+    # 'tag_string_<category>' (Danbooru) or a dict of lists in 'tags' (e621)
+    categories = {}
+    for key, value in metadata.items():
+        if key.startswith('tags_'):
+            category = key[len('tags_'):]
+        elif key.startswith('tag_string_'):
+            category = key[len('tag_string_'):]
+        else:
+            continue
+        names = value.split() if isinstance(value, str) else value if isinstance(value, list) else []
+        for name in names:
+            categories[name] = category
+    if isinstance(metadata.get('tags'), dict):
+        for category, names in metadata['tags'].items():
+            if isinstance(names, list):
+                for name in names:
+                    categories[name] = category
+    return categories
+
+def load_json(data):
+    """Parse JSON bytes, with orjson when it is installed"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+# Booru rating -> Szurubooru safety (anything else is "safe")
+RATING_SAFETY = {"e": "unsafe", "explicit": "unsafe", "q": "sketchy", "questionable": "sketchy"}
+
+def _twitter_post(metadata, post):
+    post['tags'] = extract_twitter_tags(metadata)
+    if 'tweet_id' in metadata and isinstance(metadata.get('author'), dict):
+        username = str(metadata['author'].get('name', '')).strip()
+        post['source'] = f"https://twitter.com/{username}/status/{metadata['tweet_id']}"
+    elif 'url' in metadata:
+        post['source'] = metadata['url']
+
+def _booru_common(metadata, post):
+    post['tag_categories'] = extract_tag_categories(metadata)
+    if 'source' in metadata:
+        post['source'] = metadata['source']
+    elif 'file_url' in metadata:
+        post['source'] = metadata['file_url']
+    post['safety'] = RATING_SAFETY.get(metadata.get('rating', 's'), "safe")
+
+def _booru_post(metadata, post):
+    # Gelbooru, Rule34, Safebooru: space-separated string (or a list)
+    tags = metadata.get('tags')
+    post['tags'] = tags.split() if isinstance(tags, str) else list(tags) if isinstance(tags, list) else []
+    _booru_common(metadata, post)
+
+def _danbooru_post(metadata, post):
+    post['tags'] = metadata['tag_string'].split()
+    _booru_common(metadata, post)
+
+def _e621_post(metadata, post):
+    # Tags grouped by category
+    post['tags'] = [tag for names in metadata['tags'].values() if isinstance(names, list) for tag in names]
+    _booru_common(metadata, post)
+
+# Metadata layouts -> function filling a post dict from gallery-dl metadata
+METADATA_EXTRACTORS = {
+    "twitter": _twitter_post,
+    "danbooru": _danbooru_post,
+    "e621": _e621_post,
+    "booru": _booru_post
+}
+
+def metadata_kind(metadata, is_twitter=False):
+    """Return the METADATA_EXTRACTORS key for a metadata dict"""
+    if is_twitter or metadata.get('subcategory') == 'tweets' or metadata.get('category') == 'twitter':
+        return "twitter"
+    tags = metadata.get('tags')
+    if isinstance(tags, dict):
+        return "e621"
+    if tags is None and 'tag_string' in metadata:
+        return "danbooru"
+    return "booru"
+
+def read_post_metadata(metadata_path, is_twitter=False, silent=True):
+    """Read tags, source, safety and tag categories from a gallery-dl .json sidecar"""
+    try:
+        with run_metrics.timed('metadata'), open(metadata_path, 'rb') as f:
+            metadata = load_json(f.read())
+    except FileNotFoundError:
+        return parse_post_metadata({})
+    except Exception as e:
+        if not silent:
+            print(f"Error reading metadata: {e}")
+        return parse_post_metadata({})
+    
+    return parse_post_metadata(metadata, is_twitter or 'twitter' in str(metadata_path), silent)
+
+def parse_post_metadata(metadata, is_twitter=False, silent=True):
+    """Get tags, source, safety and tag categories from gallery-dl metadata"""
+    post = {"tags": [], "source": None, "safety": "safe", "tag_categories": {}}
+    
+    try:
+        METADATA_EXTRACTORS[metadata_kind(metadata, is_twitter)](metadata, post)
+    except Exception as e:
+        if not silent:
+            print(f"Error reading metadata: {e}")
+    
+    return post
+
+def request_upload_token(filepath, limiter=None, journal=None, stats=None, metrics=None):
+    """Upload a file's content, recording transfer metrics, and return the token"""
+    metrics = {} if metrics is None else metrics
+    token = get_file_token(filepath, metrics, limiter)
+    if 'bytes' in metrics:
+        record_stat('upload_requests', stats=stats)
+        record_stat('bytes', metrics['bytes'], stats=stats)
+        record_stat('upload_seconds', metrics['seconds'], stats=stats)
+    if token and journal is not None:
+        journal.record(filepath, 'token', token=token, bytes=metrics.get('bytes'),
+                       seconds=round(metrics.get('seconds', 0), 3))
+    return token
+
+def upload_file(filepath, metadata_path, silent=False, is_twitter=False, index=None, limiter=None,
+                journal=None, stats=None, tag_cache=None, post_metadata=None):
+    """Upload a single file to Szurubooru"""
+    filename = filepath.name
+    start = time.monotonic()
+    metrics = {}
+    
+    def done(outcome, reason=None):
+        record_outcome(filepath, outcome, stats, reason=reason or metrics.get('error'),
+                       status=metrics.get('post_status', metrics.get('status')), bytes=metrics.get('bytes'),
+                       seconds=round(time.monotonic() - start, 3))
+    
+    # Already posted by an earlier (interrupted) run of this job
+    if journal is not None and journal.state(filepath) == 'posted':
+        done('skipped', "posted by an earlier run")
+        return True
+    
+    # Skip content that is already on the server without any network traffic
+    checksum = checksum_md5 = None
+    if index is not None:
+        try:
+            checksum, checksum_md5 = index.checksums(filepath)
+            if index.lookup(checksum) is not None:
+                done('skipped', "already on the server")
+                return True
+        except Exception as e:
+            if not silent:
+                print(f"\nError checking upload index: {e}")
+    
+    # Read metadata if available (unless it was parsed ahead of time)
+    if post_metadata is None:
+        post_metadata = read_post_metadata(metadata_path, is_twitter, silent)
+    tags = post_metadata['tags']
+    source = post_metadata['source']
+    safety = post_metadata['safety']
+    
+    # Reuse a token from an interrupted run instead of uploading the file again
+    token = journal.usable_token(filepath) if journal is not None else None
+    reused_token = token is not None
+    
+    # Upload file
+    if not token:
+        token = request_upload_token(filepath, limiter, journal, stats, metrics)
+    
+    if not token:
+        done('failed', metrics.get('error') or "upload failed")
+        if journal is not None:
+            journal.record(filepath, 'failed', reason="upload failed")
+        if not silent:
+            print(f"\nFailed to upload: {filename}")
+        return False
+    
+    # Make sure the tags exist with their booru categories
+    if tag_cache is not None and tags:
+        tag_cache.ensure({tag: post_metadata['tag_categories'].get(tag) for tag in tags})
+    
+    # Create post
+    post = create_post(token, tags, safety, source, limiter=limiter, metrics=metrics, checksum=checksum,
+                       filepath=filepath)
+    
+    if not post and reused_token:
+        # The server may have discarded the old upload; upload once more
+        token = request_upload_token(filepath, limiter, journal, stats, metrics)
+        if token:
+            post = create_post(token, tags, safety, source, limiter=limiter, metrics=metrics, checksum=checksum,
+                               filepath=filepath)
+    
+    if post:
+        done('uploaded')
+        if index is not None and checksum:
+            index.add(checksum, checksum_md5, filepath, post.get('id'))
+        if journal is not None:
+            journal.record(filepath, 'posted', post_id=post.get('id'))
+        return True
+    else:
+        done('failed', metrics.get('error') or "post creation failed")
+        if journal is not None:
+            journal.record(filepath, 'failed', reason="post creation failed")
+        if not silent:
+            print(f"\nFailed to create post: {filename}")
+        return False
+
+def remote_file_md5(metadata):
+    """Return the MD5 a booru reports for a file (e621 nests it under 'file'), or None"""
+    md5 = metadata.get('md5')
+    if not md5 and isinstance(metadata.get('file'), dict):
+        md5 = metadata['file'].get('md5')
+    return md5.lower() if isinstance(md5, str) and len(md5) == 32 else None
+
+def fetch_and_upload(file_url, metadata, silent=False, index=None, limiter=None, stats=None, tag_cache=None):
+    """Download one remote file to a temporary directory and upload it the normal way"""
+    name = Path(urlparse(file_url).path).name or "file"
+    with tempfile.TemporaryDirectory(prefix="fitchas-") as tmp:
+        filepath = Path(tmp) / name
+        try:
+            with requests.get(file_url, stream=True, timeout=API_TIMEOUTS['uploads']) as response:
+                response.raise_for_status()
+                with open(filepath, 'wb') as f:
+                    for chunk in response.iter_content(UPLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+        except Exception as e:
+            record_outcome(file_url, 'failed', stats, reason=f"download failed: {e}")
+            if not silent:
+                print(f"\nFailed to download {file_url}: {e}")
+            return False
+        # The server may have finished a remote post that timed out on our side
+        checksum, checksum_md5 = file_checksums(filepath)
+        try:
+            existing = find_posts_by_checksum([checksum]).get(checksum)
+        except Exception:
+            existing = None
+        if existing is not None:
+            record_outcome(file_url, 'skipped', stats, reason="already on the server")
+            if index is not None:
+                index.add(checksum, checksum_md5, file_url, existing.get('id'))
+            return True
+        metadata_path = filepath.with_suffix(filepath.suffix + '.json')
+        with open(metadata_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+        return upload_file(filepath, metadata_path, silent=silent, index=index, limiter=limiter, stats=stats,
+                           tag_cache=tag_cache)
+
+def post_remote_file(file_url, metadata, silent=False, index=None, limiter=None, stats=None, tag_cache=None):
+    """Create a post that Szurubooru fetches from the booru itself, uploading locally if it refuses"""
+    # Boorus report the MD5 of each file, so known content is skipped without fetching it
+    checksum_md5 = remote_file_md5(metadata)
+    if index is not None and checksum_md5 and index.lookup_md5(checksum_md5) is not None:
+        record_outcome(file_url, 'skipped', stats, reason="already on the server")
+        return True
+    
+    post_metadata = parse_post_metadata(metadata, silent=silent)
+    tags = post_metadata['tags']
+    
+    if tag_cache is not None and tags:
+        tag_cache.ensure({tag: post_metadata['tag_categories'].get(tag) for tag in tags})
+    
+    start = time.monotonic()
+    metrics = {}
+    post = create_post(None, tags, post_metadata['safety'], post_metadata['source'], content_url=file_url,
+                       limiter=limiter, metrics=metrics)
+    
+    if post:
+        record_outcome(file_url, 'uploaded', stats, status=metrics.get('post_status'),
+                       seconds=round(time.monotonic() - start, 3))
+        if index is not None and post.get('checksum'):
+            index.add(post['checksum'], post.get('checksumMD5') or checksum_md5, file_url, post.get('id'))
+        return True
+    
+    # The server can't or won't fetch the URL: fall back to download + upload
+    if not silent:
+        print(f"\nServer could not fetch {file_url}, uploading it instead")
+    return fetch_and_upload(file_url, metadata, silent, index, limiter, stats, tag_cache)
+
+class FileManifest:
+    """On-disk manifest of downloaded files that only rescans directories whose mtime changed"""
+
+    def __init__(self, db_path):
+        self.conn = connect_state_db(db_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest_dirs ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest_files ("
+            "dir TEXT, name TEXT, size INTEGER, mtime REAL, has_sidecar INTEGER, "
+            "PRIMARY KEY (dir, name))"
+        )
+        self.conn.commit()
+        self.rescanned = 0  # Directories listed during the last scan
+
+    def _list_dir(self, path):
+        """List a directory with os.scandir: (subdirs, [(name, size, mtime, has_sidecar)])"""
+        subdirs = []
+        media = []
+        sidecars = set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.name.endswith('.json'):
+                    sidecars.add(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    media.append((entry.name, st.st_size, st.st_mtime))
+        files = [(name, size, mtime, name + '.json' in sidecars) for name, size, mtime in media]
+        return sorted(subdirs), sorted(files)
+
+    def scan(self, directory):
+        """Yield (filepath, metadata_path, is_twitter, size, mtime, has_sidecar) for every media file"""
+        root = os.path.abspath(directory)
+        if not os.path.isdir(root):
+            return
+        self.rescanned = 0
+        seen = set()
+        stack = [root]
+        try:
+            while stack:
+                path = stack.pop()
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add(path)
+                
+                row = self.conn.execute(
+                    "SELECT mtime_ns, subdirs FROM manifest_dirs WHERE path = ?", (path,)
+                ).fetchone()
+                if row and row[0] == mtime_ns:
+                    # Unchanged since the last scan: no need to list it again
+                    subdirs = json.loads(row[1])
+                    files = self.conn.execute(
+                        "SELECT name, size, mtime, has_sidecar FROM manifest_files WHERE dir = ? ORDER BY name",
+                        (path,)
+                    ).fetchall()
+                else:
+                    try:
+                        subdirs, files = self._list_dir(path)
+                    except OSError:
+                        continue
+                    self.rescanned += 1
+                    self.conn.execute("DELETE FROM manifest_files WHERE dir = ?", (path,))
+                    self.conn.executemany(
+                        "INSERT INTO manifest_files VALUES (?, ?, ?, ?, ?)",
+                        [(path, name, size, mtime, int(has_sidecar)) for name, size, mtime, has_sidecar in files]
+                    )
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO manifest_dirs VALUES (?, ?, ?)",
+                        (path, mtime_ns, json.dumps(subdirs))
+                    )
+                    # Don't hold a write lock while the caller works on the yielded files
+                    self.conn.commit()
+                
+                stack.extend(os.path.join(path, name) for name in reversed(subdirs))
+                
+                # Check if this is Twitter content based on path
+                is_twitter = 'twitter' in path.lower() or 'tweets' in path.lower()
+                for name, size, mtime, has_sidecar in files:
+                    filepath = Path(path, name)
+                    yield (filepath, Path(path, name + '.json'), is_twitter, size, mtime, bool(has_sidecar))
+            
+            # Forget directories that were removed since the last scan
+            prefix = os.path.join(root, '')
+            for (path,) in self.conn.execute(
+                "SELECT path FROM manifest_dirs WHERE path = ? OR substr(path, 1, ?) = ?",
+                (root, len(prefix), prefix)
+            ).fetchall():
+                if path not in seen:
+                    self.conn.execute("DELETE FROM manifest_dirs WHERE path = ?", (path,))
+                    self.conn.execute("DELETE FROM manifest_files WHERE dir = ?", (path,))
+        finally:
+            self.conn.commit()
+
+    def count(self, directory):
+        """Bring the manifest up to date and return the number of media files"""
+        with run_metrics.timed('discovery'):
+            return sum(1 for _ in self.scan(directory))
+
+    def close(self):
+        self.conn.close()
+
+def iter_files_to_upload(directory, manifest=None):
+    """Lazily yield (filepath, metadata_path, is_twitter) for every file that needs to be uploaded"""
+    own_manifest = manifest is None
+    if own_manifest:
+        if not os.path.isdir(directory):
+            return
+        manifest = FileManifest(state_db_path(directory))
+    try:
+        for filepath, metadata_path, is_twitter, size, mtime, has_sidecar in manifest.scan(directory):
+            yield filepath, metadata_path, is_twitter
+    finally:
+        if own_manifest:
+            manifest.close()
+
+UPLOAD_ORDERS = {
+    "walk": "directory order",
+    "smallest": "smallest first",  # Quick progress: many files done early
+    "largest": "largest first",  # Keeps the connections busy with long transfers
+    "interleave": "interleaved by directory",  # One file of each query in turn
+}
+
+def entry_nbytes(entry):
+    """Approximate memory of one (filepath, metadata_path, is_twitter) entry, as held by the walk order"""
+    filepath, metadata_path, _ = entry
+    return sys.getsizeof(entry) + sum(sys.getsizeof(path) + sys.getsizeof(str(path))
+                                      for path in (filepath, metadata_path))
+
+class FileRecords:
+    """Compact store of files to upload: a few bytes per file in flat arrays instead of Path tuples
+
+    Directories are kept once; names are UTF-8 in one buffer. Iterating
+    yields (filepath, metadata_path, is_twitter) like iter_files_to_upload.
+    """
+
+    __slots__ = ("dirs", "dir_ids", "twitter_dirs", "names", "name_ends", "sizes", "_dir_index")
+
+    def __init__(self):
+        self.dirs = []
+        self._dir_index = {}
+        self.twitter_dirs = array.array('B')
+        self.dir_ids = array.array('I')
+        self.names = bytearray()
+        self.name_ends = array.array('Q')
+        self.sizes = array.array('q')
+
+    def append(self, filepath, is_twitter, size):
+        directory, name = os.path.split(str(filepath))
+        dir_id = self._dir_index.get(directory)
+        if dir_id is None:
+            dir_id = self._dir_index[directory] = len(self.dirs)
+            self.dirs.append(directory)
+            self.twitter_dirs.append(bool(is_twitter))
+        self.dir_ids.append(dir_id)
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.name_ends.append(len(self.names))
+        self.sizes.append(size)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, i):
+        start = self.name_ends[i - 1] if i else 0
+        name = self.names[start:self.name_ends[i]].decode('utf-8', 'surrogateescape')
+        dir_id = self.dir_ids[i]
+        directory = self.dirs[dir_id]
+        return Path(directory, name), Path(directory, name + '.json'), bool(self.twitter_dirs[dir_id])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def nbytes(self):
+        """Approximate memory used by the store"""
+        arrays = (self.dir_ids, self.twitter_dirs, self.name_ends, self.sizes)
+        return (sum(a.buffer_info()[1] * a.itemsize for a in arrays) + len(self.names)
+                + sum(sys.getsizeof(d) for d in self.dirs) + sys.getsizeof(self._dir_index))
+
+    def bytes_per_item(self):
+        return self.nbytes() / len(self) if len(self) else 0
+
+    def order(self, policy="walk"):
+        """Indices of the files in the order of an UPLOAD_ORDERS policy"""
+        if policy not in UPLOAD_ORDERS:
+            raise ValueError(f"Unknown upload order: {policy}")
+        n = len(self)
+        if policy == "walk":
+            return range(n)
+        if numpy is not None:
+            if policy == "interleave":
+                dir_ids = numpy.frombuffer(self.dir_ids, dtype=numpy.uint32)
+                # Position of each file within its directory, then take position 0 of every directory, 1, ...
+                by_dir = numpy.argsort(dir_ids, kind='stable')
+                counts = numpy.bincount(dir_ids)
+                rank = numpy.empty(n, dtype=numpy.int64)
+                rank[by_dir] = numpy.arange(n) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                return numpy.lexsort((dir_ids, rank))
+            sizes = numpy.frombuffer(self.sizes, dtype=numpy.int64)
+            return numpy.argsort(sizes if policy == "smallest" else -sizes, kind='stable')
+        if policy == "interleave":
+            buckets = collections.defaultdict(lambda: array.array('L'))
+            for i, dir_id in enumerate(self.dir_ids):
+                buckets[dir_id].append(i)
+            order = array.array('L')
+            buckets = list(buckets.values())
+            rank = 0
+            while buckets:
+                order.extend(bucket[rank] for bucket in buckets)
+                rank += 1
+                buckets = [bucket for bucket in buckets if len(bucket) > rank]
+            return order
+        return array.array('L', sorted(range(n), key=self.sizes.__getitem__, reverse=policy == "largest"))
+
+    def ordered(self, policy="walk"):
+        """Yield (filepath, metadata_path, is_twitter) in the order of a policy"""
+        for i in self.order(policy):
+            yield self[int(i)]
+
+def collect_files_to_upload(directory, manifest=None):
+    """Collect all files that need to be uploaded into a FileRecords store"""
+    records = FileRecords()
+    own_manifest = manifest is None
+    if own_manifest:
+        if not os.path.isdir(directory):
+            return records
+        manifest = FileManifest(state_db_path(directory))
+    try:
+        with run_metrics.timed('discovery'):
+            for filepath, metadata_path, is_twitter, size, mtime, has_sidecar in manifest.scan(directory):
+                records.append(filepath, is_twitter, size)
+    finally:
+        if own_manifest:
+            manifest.close()
+    return records
+
+def quarantine_path(download_dir):
+    """Path of the quarantine report kept next to the download directory"""
+    path = Path(download_dir).resolve()
+    return path.parent / f"{path.name}.quarantine.jsonl"
+
+# Leading bytes of the formats Szurubooru accepts -> (format, offset of the signature)
+MEDIA_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg", 0),
+    (b"\x89PNG\r\n\x1a\n", "png", 0),
+    (b"GIF87a", "gif", 0),
+    (b"GIF89a", "gif", 0),
+    (b"BM", "bmp", 0),
+    (b"\x1a\x45\xdf\xa3", "webm", 0),
+    (b"FWS", "swf", 0),
+    (b"CWS", "swf", 0),
+    (b"ZWS", "swf", 0),
+    (b"ftyp", "iso", 4),  # MP4, MOV, AVIF, HEIF
+]
+
+def media_format(head):
+    """Return the media format of a file from its first bytes, or None"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    for signature, name, offset in MEDIA_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return name
+    return None
+
+def _iso_boxes_complete(f, size):
+    """Walk the top-level boxes of an MP4/MOV/AVIF file; True if they fill the file and one holds the index"""
+    offset = 0
+    boxes = set()
+    while offset < size:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            return False
+        length = int.from_bytes(header[:4], 'big')
+        kind = header[4:8]
+        if length == 1 and len(header) == 16:
+            length = int.from_bytes(header[8:16], 'big')
+        elif length == 0:
+            length = size - offset  # Box runs to the end of the file
+        if length < 8 or offset + length > size:
+            return False
+        boxes.add(kind)
+        offset += length
+    # Videos need their 'moov' index, images (AVIF/HEIF) their 'meta' box
+    return bool(boxes & {b"moov", b"meta"})
+
+def _jpeg_has_end(f, size, chunk_size=1024 * 1024):
+    """Whether a JPEG has an end marker after its first scan, wherever it is
+
+    Motion photos (an MP4 appended), appended ICC profiles and other trailing
+    data push the marker away from the end of the file. Segments before the scan
+    are skipped by their lengths (EXIF thumbnails have end markers of their own);
+    inside the scan 0xFF is always escaped, so the first FFD9 ends the image.
+    """
+    offset = 2
+    while True:
+        f.seek(offset)
+        marker = f.read(4)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return False
+        if marker[1] == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        if marker[1] in (0x01, 0xD8) or 0xD0 <= marker[1] <= 0xD7:
+            offset += 2
+            continue
+        if len(marker) < 4:
+            return False
+        offset += 2 + int.from_bytes(marker[2:4], 'big')
+        if marker[1] == 0xDA:  # Start of scan
+            break
+    f.seek(offset)
+    previous = b""
+    while offset < size:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        if b"\xff\xd9" in previous + chunk:
+            return True
+        previous = chunk[-1:]
+        offset += len(chunk)
+    return False
+
+def _png_has_end(f, size):
+    """Whether the chunks of a PNG run up to an IEND chunk (data may follow it)"""
+    offset = 8
+    while offset + 8 <= size:
+        f.seek(offset)
+        header = f.read(8)
+        if header[4:8] == b"IEND":
+            return True
+        offset += 12 + int.from_bytes(header[:4], 'big')
+    return False
+
+def _bmp_complete(head, size):
+    """Whether a BMP is as long as its header says (file size, or pixel data offset + image size)"""
+    declared = int.from_bytes(head[2:6], 'little')
+    if declared:
+        return declared <= size
+    # Some writers leave the file size at 0: work it out for uncompressed bitmaps
+    offset = int.from_bytes(head[10:14], 'little')
+    width = int.from_bytes(head[18:22], 'little', signed=True)
+    height = int.from_bytes(head[22:26], 'little', signed=True)
+    bits = int.from_bytes(head[28:30], 'little')
+    image_size = int.from_bytes(head[34:38], 'little')
+    if not image_size and int.from_bytes(head[30:34], 'little') == 0:
+        image_size = (bits * abs(width) + 31) // 32 * 4 * abs(height)
+    return offset + image_size <= size
+
+def _ebml_vint(data, offset):
+    """Read an EBML variable-length size at offset: (value, length), value None if unknown, (None, 0) if invalid"""
+    if offset >= len(data) or not data[offset]:
+        return None, 0
+    length = 9 - data[offset].bit_length()
+    if offset + length > len(data):
+        return None, 0
+    value = int.from_bytes(data[offset:offset + length], 'big') & ((1 << (7 * length)) - 1)
+    return (None if value == (1 << (7 * length)) - 1 else value), length
+
+def _webm_complete(f, size):
+    """Whether the Segment after the EBML header of a WebM/MKV is as long as it says (unknown sizes pass)"""
+    f.seek(0)
+    head = f.read(4096)
+    header_size, length = _ebml_vint(head, 4)
+    if not length or header_size is None:
+        return False
+    offset = 4 + length + header_size
+    if head[offset:offset + 4] != b"\x18\x53\x80\x67":
+        return False
+    segment_size, length = _ebml_vint(head, offset + 4)
+    if not length:
+        return False
+    return segment_size is None or offset + 4 + length + segment_size <= size
+
+def validate_media(path, max_size=0):
+    """Return why a file can't be uploaded (incomplete, not media, truncated, too large), or None if it looks fine
+
+    Only the first and last bytes are read (plus box headers for MP4/MOV, and
+    the segments of JPEGs/PNGs with data after their end marker), so it is
+    cheap enough to run on every file; it runs in a process pool for
+    large batches, so it only takes and returns plain values. WebM/MKV only get
+    their Segment size checked (live recordings leave it unknown) and compressed
+    SWFs only their magic bytes.
+    """
+    if path.endswith(".part"):
+        return "incomplete download (.part)"
+    try:
+        size = os.path.getsize(path)
+        if size == 0:
+            return "empty file"
+        if max_size and size > max_size:
+            return f"larger than {max_size} bytes"
+        with open(path, 'rb') as f:
+            head = f.read(64)
+            kind = media_format(head)
+            if kind is None:
+                if head.lstrip(b"\xef\xbb\xbf \t\r\n")[:1] == b"<":
+                    return "HTML/XML page, not media"
+                return "unsupported format"
+            f.seek(max(0, size - 1024))
+            tail = f.read()
+            if kind == "jpeg" and b"\xff\xd9" not in tail and not _jpeg_has_end(f, size):
+                return "truncated jpeg (no end marker)"
+            if kind == "png" and b"IEND" not in tail[-12:] and not _png_has_end(f, size):
+                return "truncated png (no IEND chunk)"
+            if kind == "gif" and not tail.rstrip(b"\x00").endswith(b"\x3b"):
+                return "truncated gif (no trailer)"
+            if kind == "bmp" and not _bmp_complete(head, size):
+                return "truncated bmp"
+            if kind == "webp" and int.from_bytes(head[4:8], 'little') + 8 > size:
+                return "truncated webp"
+            if kind == "iso" and not _iso_boxes_complete(f, size):
+                return "truncated or damaged mp4/mov container"
+            if kind == "webm" and not _webm_complete(f, size):
+                return "truncated or damaged webm container"
+            if head[:3] == b"FWS" and int.from_bytes(head[4:8], 'little') > size:
+                return "truncated swf"
+    except OSError as e:
+        return f"unreadable: {e}"
+    return None
+
+class MediaValidator:
+    """Keeps broken files out of the upload queue and lists them in a quarantine report
+
+    Batches are checked ahead of time in a process pool; streamed files are
+    checked inline (the check only reads a few KB). Quarantined files stay
+    where they are; the JSONL report next to the download directory says why.
+    """
+
+    def __init__(self, download_dir, workers=VALIDATE_WORKERS):
+        self.path = quarantine_path(download_dir)
+        self.workers = max(1, workers)
+        self.pool = None
+        self.count = 0
+        self.verdicts = {}  # path -> reason (None = fine) of batch-checked files not uploaded yet
+        self.lock = threading.Lock()
+
+    def check(self, files):
+        """Validate (filepath, metadata_path, is_twitter) entries in one go, return the ones that may be uploaded"""
+        if not files:
+            return []
+        paths = [str(entry[0]) for entry in files]
+        try:
+            if len(files) > 1:
+                with self.lock:
+                    if self.pool is None:
+                        # spawn: forking a process that runs upload threads isn't safe
+                        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                        mp_context=multiprocessing.get_context("spawn"))
+                with run_metrics.timed('validate'):
+                    reasons = list(self.pool.map(validate_media, paths, [MAX_UPLOAD_SIZE] * len(paths),
+                                                 chunksize=16))
+            else:
+                with run_metrics.timed('validate'):
+                    reasons = [validate_media(paths[0], MAX_UPLOAD_SIZE)]
+        except Exception:
+            # Not fatal: the files are checked again one by one
+            return list(files)
+        with self.lock:
+            self.verdicts.update(zip(paths, reasons))
+        return [entry for entry, reason in zip(files, reasons) if reason is None]
+
+    def verdict(self, filepath):
+        """Why a file can't be uploaded, or None (from check() if it was in a batch)"""
+        with self.lock:
+            reason = self.verdicts.pop(str(filepath), False)
+        if reason is False:
+            with run_metrics.timed('validate'):
+                reason = validate_media(str(filepath), MAX_UPLOAD_SIZE)
+        return reason
+
+    def quarantine(self, filepath, reason, stats=None):
+        record_outcome(filepath, 'quarantined', stats, reason=reason)
+        try:
+            size = os.path.getsize(filepath)
+        except OSError:
+            size = None
+        with self.lock:
+            self.count += 1
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"time": time.time(), "path": str(filepath), "reason": reason,
+                                    "size": size}) + "\n")
+
+    def close(self, wait=True):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=wait)
+                self.pool = None
+
+def open_media_validator(download_dir):
+    """Return a MediaValidator for a download directory when VALIDATE_MEDIA is on"""
+    return MediaValidator(download_dir) if VALIDATE_MEDIA else None
+
+def store_path(download_dir):
+    """Path of the content-addressed store kept next to the download directory"""
+    path = Path(download_dir).resolve()
+    return path.parent / f"{path.name}.store"
+
+FICLONE = 0x40049409  # Linux ioctl that makes a copy-on-write clone (btrfs, XFS, ...)
+
+def link_or_clone(src, dst):
+    """Create dst as a hardlink to src, or a reflink where hardlinks aren't possible; return True on success"""
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        pass
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as source, open(dst, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(dst)
+        return False
+
+class StagingStore:
+    """Content-addressed store: every file is kept once, by SHA1, and query directories link to it
+
+    The same image downloaded by several queries then takes disk space only once.
+    """
+
+    def __init__(self, download_dir, index):
+        self.root = store_path(download_dir)
+        self.index = index
+        self.lock = threading.Lock()
+        self.saved = 0  # Bytes no longer stored twice
+
+    def object_path(self, checksum, suffix):
+        return self.root / checksum[:2] / f"{checksum}{suffix.lower()}"
+
+    def adopt(self, filepath):
+        """Add a file to the store; a copy of content already stored becomes a link to it"""
+        checksum, _ = self.index.checksums(filepath)
+        target = self.object_path(checksum, filepath.suffix)
+        with self.lock:
+            if not target.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                link_or_clone(filepath, target)
+                return False
+            if os.path.samefile(target, filepath):
+                return False
+            # Replace the duplicate atomically with a link to the stored copy
+            tmp = filepath.with_name(f".{filepath.name}.{uuid.uuid4().hex[:8]}.tmp")
+            if not link_or_clone(target, tmp):
+                return False
+            size = filepath.stat().st_size
+            os.replace(tmp, filepath)
+            self.saved += size
+            return True
+
+def open_staging_store(download_dir, index):
+    """Return the StagingStore of a download directory when STAGING_STORE is on (it needs the index)"""
+    return StagingStore(download_dir, index) if STAGING_STORE and index is not None else None
+
+def compact_download_dir(download_dir, older_than_days=0):
+    """Delete media (and sidecars) whose post has been on the server for older_than_days
+
+    A compact record (checksum, post ID, size, tags/source/safety) is kept in the state
+    database. Only runs once downloads are recorded in the gallery-dl archive, which keeps
+    the deleted files from being downloaded again. Returns (files removed, bytes freed).
+    """
+    if not os.path.isdir(download_dir):
+        return 0, 0
+    if not archive_path(download_dir).exists():
+        print(f"Not compacting {download_dir}: there is no download archive yet, so gallery-dl run as a "
+              f"subprocess would download deleted files again. Enable DOWNLOAD_ARCHIVE (--compact-after does "
+              f"for its job) and download first.")
+        return 0, 0
+    cutoff = time.time() - older_than_days * 86400
+    index = UploadIndex(state_db_path(download_dir))
+    manifest = FileManifest(state_db_path(download_dir))
+    removed = freed = 0
+    
+    def expired(checksum):
+        confirmed = index.confirmed(checksum)
+        return confirmed is not None and (confirmed[1] or 0) <= cutoff
+    
+    try:
+        for filepath, metadata_path, is_twitter in list(iter_files_to_upload(download_dir, manifest)):
+            try:
+                checksum, _ = index.checksums(filepath)
+                if not expired(checksum):
+                    continue
+                st = filepath.stat()
+                index.add_compacted(filepath, checksum, index.confirmed(checksum)[0], st.st_size,
+                                    read_post_metadata(metadata_path, is_twitter))
+                filepath.unlink()
+            except OSError:
+                continue
+            with contextlib.suppress(OSError):
+                metadata_path.unlink()
+            removed += 1
+            # Space only comes back with the last link
+            if st.st_nlink == 1:
+                freed += st.st_size
+        
+        # Stored copies no query directory links to any more
+        store = store_path(download_dir)
+        if store.is_dir():
+            for obj in store.glob("*/*"):
+                st = obj.stat()
+                if st.st_nlink == 1 and expired(obj.name.split('.')[0]):
+                    obj.unlink()
+                    freed += st.st_size
+                    with contextlib.suppress(OSError):
+                        obj.parent.rmdir()
+    finally:
+        manifest.close()
+        index.close()
+    return removed, freed
+
+def chain_future(source, target):
+    """Complete the target future with the outcome of source once source is done"""
+    def copy(done):
+        if done.cancelled():
+            target.cancel()
+        elif done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(done.result())
+    source.add_done_callback(copy)
+
+class UploadPipeline:
+    """Bounded worker pool that uploads files concurrently
+
+    The pool has room for ADAPTIVE_GROWTH times the requested workers; an
+    AdaptiveLimiter decides how many of them upload at any moment.
+    """
+
+    def __init__(self, workers=DEFAULT_UPLOAD_WORKERS, delay=0.5, silent=True, on_done=None,
+                 sidecar_wait=0, index=None, journal=None, tag_cache=None, server_check=False, merge_tags=False,
+                 store=None, validator=None):
+        self.workers = max(1, int(workers))
+        self.sidecar_wait = sidecar_wait
+        self.index = index
+        self.journal = journal
+        self.tag_cache = tag_cache
+        self.store = store
+        self.validator = validator
+        # Ask the server for content it already has (needs the index to remember the answers)
+        self.dedup = ServerDedup(index, merge_tags, tag_cache) if server_check and index is not None else None
+        # Skip files that only differ from an existing post in size or encoding (NEAR_DUPLICATES)
+        self.near_dups = open_near_duplicate_filter(index, merge_tags, tag_cache)
+        # The delay is only the starting rate (0.5s between uploads = 2 uploads/s);
+        # server responses move it and the concurrency up or down from there
+        self.max_workers = self.workers * ADAPTIVE_GROWTH
+        self.limiter = AdaptiveLimiter(self.workers, self.max_workers, delay)
+        self.silent = silent
+        self.on_done = on_done
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="upload")
+        # Sidecars are parsed as files are queued, so uploads never wait on the disk for them
+        self.metadata_pool = ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix="metadata")
+        # Every worker needs its own keep-alive connection
+        if _http_settings["pool_size"] < self.max_workers:
+            configure_http(pool_size=self.max_workers)
+        # Keep only a few queued tasks per worker so huge batches don't pile up in memory
+        self.slots = threading.BoundedSemaphore(self.max_workers * 2)
+        self.completed = 0
+        self.lock = threading.Lock()
+        # Files whose sidecar is still being written wait here instead of on an upload worker
+        self.parked = {}  # number -> (metadata_path, deadline, finished, start, future)
+        self.parked_count = 0
+        self.parked_cond = threading.Condition()
+        self.watcher = None
+        self.closing = False
+
+    def submit(self, filepath, metadata_path, is_twitter=False, stats=None, sidecar_wait=None, finished=None):
+        """Queue a file for upload, blocking while the queue is full, and return a future of the upload
+
+        sidecar_wait overrides the pipeline's wait for the .json sidecar (0 for jobs without metadata).
+        A file whose sidecar isn't there yet is parked until it appears, the wait runs out or
+        `finished` (an Event set once the download writing it is over) is set; no upload worker
+        waits for it.
+        """
+        if sidecar_wait is None:
+            sidecar_wait = self.sidecar_wait
+        if not sidecar_wait or os.path.exists(metadata_path):
+            post_metadata = self.metadata_pool.submit(read_post_metadata, metadata_path, is_twitter)
+            return self._submit(self._upload, filepath, stats, metadata_path, is_twitter, post_metadata)
+        
+        # Parked files take a queue slot only when they start, so the download keeps streaming
+        future = Future()
+        
+        def start():
+            try:
+                post_metadata = self.metadata_pool.submit(read_post_metadata, metadata_path, is_twitter)
+                chain_future(self._submit(self._upload, filepath, stats, metadata_path, is_twitter,
+                                          post_metadata), future)
+            except Exception as e:
+                future.set_exception(e)
+        
+        with self.parked_cond:
+            self.parked_count += 1
+            self.parked[self.parked_count] = (metadata_path, time.monotonic() + sidecar_wait, finished, start,
+                                              future)
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch_sidecars, name="sidecars", daemon=True)
+                self.watcher.start()
+            self.parked_cond.notify_all()
+        return future
+
+    def submit_window(self, files, stats=None):
+        """Queue a window of (filepath, metadata_path, is_twitter) files, blocking while the queue is full
+
+        The files come from a finished download, so their sidecars aren't waited for.
+        The tags missing for the whole window are created in one pass before
+        its uploads start, from the same parsed sidecars the uploads use.
+        """
+        pending = [(entry, self.metadata_pool.submit(read_post_metadata, entry[1], entry[2])) for entry in files]
+        if self.tag_cache is not None and pending:
+            tag_categories = {}
+            for _, post_metadata in pending:
+                post_metadata = post_metadata.result()
+                for tag in post_metadata['tags']:
+                    if tag_categories.get(tag) is None:
+                        tag_categories[tag] = post_metadata['tag_categories'].get(tag)
+            self.tag_cache.ensure(tag_categories)
+        for (filepath, metadata_path, is_twitter), post_metadata in pending:
+            self._submit(self._upload, filepath, stats, metadata_path, is_twitter, post_metadata)
+
+    def submit_remote(self, file_url, metadata, stats=None):
+        """Queue a post the server creates from a remote file URL, blocking while the queue is full"""
+        return self._submit(self._post_remote, file_url, stats, metadata)
+
+    def _submit(self, func, item, stats, *args):
+        self.slots.acquire()
+        try:
+            return self.executor.submit(self._run, func, item, stats, *args)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def check_server(self, files):
+        """Validate a batch of files and ask the server about them before submitting them (answers are cached)"""
+        if self.validator is not None:
+            files = self.validator.check(files)
+        if self.dedup is not None:
+            self.dedup.check(files)
+        if self.near_dups is not None:
+            self.near_dups.check(files)
+
+    def _watch_sidecars(self, interval=0.1):
+        """Start parked files once their sidecar exists, their wait is over or their download has finished"""
+        while True:
+            with self.parked_cond:
+                while not self.parked and not self.closing:
+                    self.parked_cond.wait()
+                if not self.parked:
+                    return
+                parked = list(self.parked.items())
+            now = time.monotonic()
+            ready = [number for number, (metadata_path, deadline, finished, _, _) in parked
+                     if now >= deadline or (finished is not None and finished.is_set())
+                     or os.path.exists(metadata_path)]
+            with self.parked_cond:
+                # close() may have dropped some of them meanwhile
+                starts = [self.parked.pop(number)[3] for number in ready if number in self.parked]
+            for start in starts:
+                start()
+            if len(ready) < len(parked):
+                time.sleep(interval)
+
+    def _upload(self, filepath, stats, metadata_path, is_twitter, post_metadata):
+        # Broken files never reach the server
+        if self.validator is not None:
+            reason = self.validator.verdict(filepath)
+            if reason is not None:
+                self.validator.quarantine(filepath, reason, stats)
+                return True
+        post_metadata = post_metadata.result()
+        if self.store is not None:
+            try:
+                self.store.adopt(filepath)
+            except OSError:
+                pass
+        # Streamed files arrive one at a time and share a query with the files around them;
+        # files checked in a batch are answered from the cache
+        if self.dedup is not None:
+            self.dedup.check_streamed((filepath, metadata_path, is_twitter))
+        if self.near_dups is not None:
+            self.near_dups.check([(filepath, metadata_path, is_twitter)])
+            post_id = self.near_dups.match(filepath)
+            if post_id is not None:
+                record_outcome(filepath, 'skipped', stats, reason=f"near-duplicate of post {post_id}")
+                return True
+        try:
+            return upload_file(filepath, metadata_path, silent=self.silent, is_twitter=is_twitter,
+                               index=self.index, limiter=self.limiter, journal=self.journal, stats=stats,
+                               tag_cache=self.tag_cache, post_metadata=post_metadata)
+        finally:
+            if self.near_dups is not None:
+                self.near_dups.done(filepath)
+
+    def _post_remote(self, file_url, stats, metadata):
+        return post_remote_file(file_url, metadata, silent=self.silent, index=self.index, limiter=self.limiter,
+                                stats=stats, tag_cache=self.tag_cache)
+
+    def _run(self, func, item, stats, *args):
+        try:
+            return func(item, stats, *args)
+        except Exception as e:
+            record_outcome(item, 'failed', stats, reason=str(e))
+            if not self.silent:
+                print(f"\nFailed to upload {item}: {e}")
+            return False
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.completed += 1
+                if self.on_done:
+                    self.on_done(self.completed)
+
+    def close(self, wait=True, cancel=False):
+        """Wait for queued uploads (or drop the ones not started with cancel=True) and stop the workers"""
+        with self.parked_cond:
+            self.closing = True
+            dropped = [] if wait and not cancel else list(self.parked.values())
+            if dropped:
+                self.parked.clear()
+            self.parked_cond.notify_all()
+        for _, _, _, _, future in dropped:
+            future.cancel()
+        if self.watcher is not None and wait:
+            # Parked files go to the workers before they stop
+            self.watcher.join()
+        self.executor.shutdown(wait=wait, cancel_futures=cancel)
+        self.metadata_pool.shutdown(wait=wait)
+        if self.near_dups is not None:
+            self.near_dups.close(wait=wait)
+        if self.validator is not None:
+            self.validator.close(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On Ctrl-C don't wait for the whole queue to drain
+        self.close(wait=exc_type is None)
+
+def print_upload_summary(title):
+    """Print final upload stats"""
+    print("\n\n" + "="*50)
+    print(title)
+    print(f"  Uploaded: {upload_stats['uploaded']}")
+    print(f"  Failed: {upload_stats['failed']}")
+    print(f"  Skipped (already uploaded): {upload_stats['skipped']}")
+    if upload_stats['quarantined']:
+        print(f"  Quarantined (broken or unsupported, see the .quarantine.jsonl report): "
+              f"{upload_stats['quarantined']}")
+    print(f"  Total: {upload_stats['total']}")
+    if upload_stats['merged']:
+        print(f"  Tags merged into existing posts: {upload_stats['merged']}")
+    if upload_stats['retried']:
+        print(f"  Retried after 429/5xx or connection errors: {upload_stats['retried']}")
+    if upload_stats['upload_seconds']:
+        # Rate of a single upload (parallel uploads add up to more)
+        rate = upload_stats['bytes'] / upload_stats['upload_seconds'] / 1048576
+        print(f"  Sent: {upload_stats['bytes'] / 1048576:.1f} MB ({rate:.2f} MB/s per upload, "
+              f"{upload_stats['upload_seconds'] / max(1, upload_stats['upload_requests']):.2f}s "
+              f"average time to token)")
+    conn = connection_stats()
+    print(f"  Connections: {conn['connections']} opened for {conn['requests']} requests ({conn['reused']} reused)")
+    phases = run_metrics.summary()
+    if phases:
+        # Where the time went: gallery_dl = network to the booru, upload_token/create_post = server,
+        # hash/metadata/discovery = local disk
+        print("  Time per phase: " + ", ".join(
+            f"{phase} {entry['seconds']:.1f}s (avg {entry['average']:.3f}s)" for phase, entry in phases.items()))
+    print("="*50)
+
+def open_upload_index(download_dir, warm=False):
+    """Open the dedup index for a download directory, optionally syncing it with the server"""
+    index = UploadIndex(state_db_path(download_dir))
+    if warm:
+        print("\nSyncing upload index with posts on the server...")
+        checked = warm_index_from_server(index)
+        print(f"  {checked} posts checked, {index.count()} checksums known")
+    return index
+
+def upload_all_files(directory, delay=0.5, workers=DEFAULT_UPLOAD_WORKERS, use_index=True, warm_index=False,
+                     journal=None, use_tag_cache=True, server_check=True, merge_tags=False):
+    """Upload all downloaded files using a pool of upload workers"""
+    print("\n" + "="*50)
+    print("Starting batch upload process...")
+    print("="*50)
+    
+    # Directories unchanged since the download's scan aren't listed again
+    streaming = UPLOAD_ORDER == "walk"
+    if streaming:
+        # Uploads start while the directory is scanned; the total grows as files are found
+        entries = iter_files_to_upload(directory)
+        print(f"\nUploading files as they are found ({max(1, int(workers))} workers, {UPLOAD_ORDERS['walk']})\n")
+    else:
+        # Sorting needs every file first: one scan into a compact store
+        records = collect_files_to_upload(directory)
+        if not records:
+            print("\nNo files found to upload!")
+            return
+        print(f"\nFound {len(records)} files to upload ({max(1, int(workers))} workers, "
+              f"{UPLOAD_ORDERS[UPLOAD_ORDER]}, {records.bytes_per_item():.0f} bytes per queued file)\n")
+        record_stat('total', len(records))
+        entries = records.ordered(UPLOAD_ORDER)
+
+    index = open_upload_index(directory, warm_index) if use_index else None
+    
+    # Missing tags are created per window of CHECKSUM_BATCH files, just before their uploads
+    tag_cache = get_tag_cache() if use_tag_cache else None
+    tags_created = tag_cache.created if tag_cache is not None else 0
+    queued_bytes = 0  # Walk order: memory of the entries, reported per file at the end
+    
+    # Upload files in parallel (silent mode - no individual error messages)
+    try:
+        with UploadPipeline(workers, delay, silent=True, index=index, journal=journal, tag_cache=tag_cache,
+                            server_check=server_check, merge_tags=merge_tags,
+                            store=open_staging_store(directory, index), validator=open_media_validator(directory),
+                            on_done=lambda done: print_progress_bar(done, upload_stats['total'])) as pipeline:
+            batch = []
+            for entry in entries:
+                if streaming:
+                    record_stat('total')
+                    queued_bytes += entry_nbytes(entry)
+                batch.append(entry)
+                if len(batch) >= CHECKSUM_BATCH:
+                    pipeline.check_server(batch)
+                    pipeline.submit_window(batch)
+                    batch = []
+            pipeline.check_server(batch)
+            pipeline.submit_window(batch)
+    finally:
+        if index is not None:
+            index.close()
+    if upload_stats['total'] == 0:
+        print("No files found to upload!")
+        return
+    if streaming:
+        # No store: at most one window of entries is held at a time
+        print(f"\n{UPLOAD_ORDERS['walk'].capitalize()}: {queued_bytes / upload_stats['total']:.0f} bytes "
+              f"per queued file, at most {CHECKSUM_BATCH} queued")
+    if tag_cache is not None:
+        print(f"\n{tag_cache.created - tags_created} tags created")
+
+    # Print final stats
+    print_upload_summary("Upload complete!")
+
+def queue_path(download_dir):
+    """Path of the shared upload queue kept next to the download directory"""
+    path = Path(download_dir).resolve()
+    return path.parent / f"{path.name}.queue.sqlite"
+
+def worker_state_db_path(download_dir):
+    """Host-local state database of a queue worker (SQLite's WAL mode doesn't work across hosts)"""
+    path = Path(download_dir).resolve()
+    digest = hashlib.sha1(str(path).encode('utf-8')).hexdigest()[:12]
+    return Path.home() / ".cache" / "fitchas" / f"{path.name}-{digest}.sqlite"
+
+class WorkQueue:
+    """Upload queue in SQLite on the shared volume, worked off by processes on several hosts
+
+    Workers lease files for QUEUE_LEASE seconds and their heartbeat keeps
+    extending the leases; files of a worker that stops heartbeating are leased
+    again by the others. File contents (SHA1) are claimed as well, so the same
+    image under two paths is uploaded once. Paths are stored relative to the
+    download directory, which may be mounted elsewhere on each host. The
+    database uses a rollback journal and takes the write lock up front (BEGIN
+    IMMEDIATE): that works over NFS, WAL mode does not.
+    """
+
+    def __init__(self, path, worker_id=None):
+        self.path = str(path)
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.lock = threading.Lock()
+        with self.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "path TEXT PRIMARY KEY, metadata_path TEXT, is_twitter INTEGER, state TEXT, owner TEXT, "
+                "lease_until REAL, attempts INTEGER, checksum TEXT, outcome TEXT, updated_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_until)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS contents (checksum TEXT PRIMARY KEY, path TEXT, owner TEXT, state TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat REAL, stats TEXT)"
+            )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Write transaction holding the database lock from the start, so claims never race"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def enqueue(self, files):
+        """Add (path, metadata_path, is_twitter) entries, return how many were new"""
+        added = 0
+        now = time.time()
+        with self.transaction() as conn:
+            for path, metadata_path, is_twitter in files:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO items VALUES (?, ?, ?, 'pending', NULL, 0, 0, NULL, NULL, ?)",
+                    (str(path), str(metadata_path), int(bool(is_twitter)), now)
+                )
+                added += cursor.rowcount
+        return added
+
+    def retry_failed(self):
+        """Put failed files back into the queue, return how many"""
+        with self.transaction() as conn:
+            return conn.execute(
+                "UPDATE items SET state = 'pending', owner = NULL, lease_until = 0, attempts = 0 "
+                "WHERE state = 'failed'"
+            ).rowcount
+
+    def claim(self, limit):
+        """Lease up to limit files (pending, or leased by a worker that stopped heartbeating)"""
+        now = time.time()
+        claimed = []
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT path, metadata_path, is_twitter, attempts FROM items "
+                "WHERE state IN ('pending', 'leased') AND lease_until <= ? ORDER BY lease_until, rowid LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            for path, metadata_path, is_twitter, attempts in rows:
+                if attempts >= QUEUE_MAX_ATTEMPTS:
+                    # Every worker that leased it died; don't let it take down the rest too
+                    conn.execute("UPDATE items SET state = 'failed', owner = NULL, outcome = 'too many attempts', "
+                                 "updated_at = ? WHERE path = ?", (now, path))
+                    continue
+                conn.execute(
+                    "UPDATE items SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE path = ?", (self.worker_id, now + QUEUE_LEASE, now, path)
+                )
+                claimed.append((path, metadata_path, bool(is_twitter)))
+        return claimed
+
+    def claim_content(self, path, checksum):
+        """Claim a leased file's content: 'claimed', 'done' (already handled) or 'busy' (being uploaded)"""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT path, owner, state FROM contents WHERE checksum = ?", (checksum,)).fetchone()
+            if row is not None and not (row[0] == str(path) and row[1] == self.worker_id):
+                _, owner, state = row
+                if state == 'done':
+                    return 'done'
+                if owner == self.worker_id:
+                    return 'busy'
+                # Also for the same path: a worker whose lease ran out may still be uploading it
+                heartbeat = conn.execute("SELECT heartbeat FROM workers WHERE worker_id = ?", (owner,)).fetchone()
+                if heartbeat is not None and heartbeat[0] > now - QUEUE_LEASE:
+                    return 'busy'
+            # New content, or its owner is gone
+            conn.execute("INSERT OR REPLACE INTO contents VALUES (?, ?, ?, 'claimed')",
+                         (checksum, str(path), self.worker_id))
+            conn.execute("UPDATE items SET checksum = ? WHERE path = ? AND owner = ?",
+                         (checksum, str(path), self.worker_id))
+        return 'claimed'
+
+    def defer(self, path, seconds):
+        """Give a leased file back to the queue to be leased again after some seconds"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE items SET state = 'pending', owner = NULL, lease_until = ?, attempts = attempts - 1 "
+                "WHERE path = ? AND owner = ?", (time.time() + seconds, str(path), self.worker_id)
+            )
+
+    def finish(self, path, outcome):
+        """Record a leased file's outcome; failed files stay failed until retry_failed()"""
+        state = 'failed' if outcome == 'failed' else 'done'
+        with self.transaction() as conn:
+            # If our lease ran out meanwhile, the worker that took the file over finds its content done
+            conn.execute("UPDATE items SET state = ?, owner = NULL, outcome = ?, updated_at = ? "
+                         "WHERE path = ? AND owner = ?", (state, outcome, time.time(), str(path), self.worker_id))
+            if state == 'done':
+                conn.execute("UPDATE contents SET state = 'done' WHERE path = ? AND owner = ?",
+                             (str(path), self.worker_id))
+            else:
+                conn.execute("DELETE FROM contents WHERE path = ? AND owner = ?", (str(path), self.worker_id))
+
+    def heartbeat(self, stats):
+        """Extend this worker's leases and publish its upload_stats"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("UPDATE items SET lease_until = ? WHERE owner = ? AND state = 'leased'",
+                         (now + QUEUE_LEASE, self.worker_id))
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?)",
+                         (self.worker_id, now, json.dumps(stats)))
+
+    def release(self, stats):
+        """Give back all files and contents held by this worker and publish its final upload_stats (on shutdown)
+
+        The worker is recorded as stopped rather than heartbeating, so nothing of it looks alive any more.
+        """
+        with self.transaction() as conn:
+            conn.execute("UPDATE items SET state = 'pending', owner = NULL, lease_until = 0, "
+                         "attempts = attempts - 1 WHERE owner = ? AND state = 'leased'", (self.worker_id,))
+            # Contents claimed for uploads that never finished; done ones stay done
+            conn.execute("DELETE FROM contents WHERE owner = ? AND state = 'claimed'", (self.worker_id,))
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, 0, ?)", (self.worker_id, json.dumps(stats)))
+
+    def remaining(self):
+        """Number of files pending or leased by any worker"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM items WHERE state IN ('pending', 'leased')"
+            ).fetchone()[0]
+
+    def status(self):
+        """File counts per state, workers and their upload_stats added up"""
+        now = time.time()
+        with self.lock:
+            states = dict(self.conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+            workers = self.conn.execute("SELECT worker_id, heartbeat, stats FROM workers").fetchall()
+        totals = {}
+        for _, _, stats in workers:
+            for key, value in json.loads(stats).items():
+                totals[key] = totals.get(key, 0) + value
+        return {
+            "files": {state: states.get(state, 0) for state in ("pending", "leased", "done", "failed")},
+            "workers": len(workers),
+            "live_workers": sorted(worker for worker, heartbeat, _ in workers if heartbeat > now - QUEUE_LEASE),
+            "upload_stats": totals,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def enqueue_uploads(download_dir=DOWNLOAD_DIR, retry_failed=True):
+    """Add every file of a download directory to its shared upload queue, return (new files, files left)
+
+    Files are added (and so leased) in UPLOAD_ORDER.
+    """
+    root = Path(download_dir).resolve()
+    work_queue = WorkQueue(queue_path(download_dir))
+    try:
+        added = 0
+        batch = []
+        if UPLOAD_ORDER == "walk":
+            entries = iter_files_to_upload(download_dir)
+        else:
+            entries = collect_files_to_upload(download_dir).ordered(UPLOAD_ORDER)
+        for filepath, metadata_path, is_twitter in entries:
+            batch.append((Path(filepath).resolve().relative_to(root),
+                          Path(metadata_path).resolve().relative_to(root), is_twitter))
+            if len(batch) >= 1000:
+                added += work_queue.enqueue(batch)
+                batch = []
+        added += work_queue.enqueue(batch)
+        if retry_failed:
+            work_queue.retry_failed()
+        return added, work_queue.remaining()
+    finally:
+        work_queue.close()
+
+def run_upload_worker(download_dir=DOWNLOAD_DIR, workers=DEFAULT_UPLOAD_WORKERS, delay=0.5, use_tag_cache=True,
+                      server_check=True, merge_tags=False, silent=False):
+    """Upload files from the shared queue of a download directory until none are left
+
+    Start one on every host that mounts the download directory (see enqueue_uploads).
+    Returns this worker's outcome counts; WorkQueue.status() adds up all workers.
+    """
+    reset_upload_stats()
+    root = Path(download_dir).resolve()
+    work_queue = WorkQueue(queue_path(download_dir))
+    local_db = worker_state_db_path(download_dir)
+    local_db.parent.mkdir(parents=True, exist_ok=True)
+    index = UploadIndex(local_db)
+    if not silent:
+        print(f"Upload worker {work_queue.worker_id}: {work_queue.remaining()} files in the queue")
+    stopped = threading.Event()
+
+    def snapshot():
+        with stats_lock:
+            return dict(upload_stats)
 
-def collect_files_to_upload(directory):
-    """Collect all files that need to be uploaded"""
-    files_to_upload = []
-    
-    if os.path.exists(directory):
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                # Skip metadata files
-                if filename.endswith('.json'):
+    def publish():
+        work_queue.heartbeat(snapshot())
+
+    def beat():
+        while not stopped.wait(QUEUE_LEASE / 3):
+            try:
+                publish()
+            except sqlite3.Error:
+                # Shared volume briefly unavailable; the lease still has two thirds left
+                pass
+
+    def finisher(path, stats):
+        def finish(future):
+            if future.cancelled():
+                return
+            outcome = next((key for key in ("uploaded", "skipped", "quarantined") if stats.get(key)), "failed")
+            work_queue.finish(path, outcome)
+        return finish
+
+    publish()
+    beater = threading.Thread(target=beat, name="heartbeat", daemon=True)
+    beater.start()
+    pipeline = UploadPipeline(workers, delay, silent=True, index=index,
+                              tag_cache=get_tag_cache() if use_tag_cache else None,
+                              server_check=server_check, merge_tags=merge_tags,
+                              validator=open_media_validator(download_dir),
+                              on_done=None if silent else lambda done: print(f"\r  {done} files done", end=""))
+    completed = False
+    try:
+        while True:
+            entries = work_queue.claim(pipeline.max_workers * 2)
+            if not entries:
+                # Files leased by other workers come back if one of them dies
+                if not work_queue.remaining():
+                    break
+                time.sleep(QUEUE_POLL)
+                continue
+            files = [(root / path, root / metadata_path, is_twitter) for path, metadata_path, is_twitter in entries]
+            pipeline.check_server(files)
+            for path, (filepath, metadata_path, is_twitter) in zip((entry[0] for entry in entries), files):
+                try:
+                    claim = work_queue.claim_content(path, index.checksums(filepath)[0])
+                except OSError:
+                    claim = 'claimed'  # Missing file: the pipeline reports it as failed
+                if claim == 'busy':
+                    # Another worker is uploading the same content under another path
+                    work_queue.defer(path, QUEUE_LEASE / 3)
                     continue
-                
-                filepath = Path(root) / filename
-                metadata_path = filepath.with_suffix(filepath.suffix + '.json')
-                
-                # Check if this is Twitter content based on path
-                is_twitter = 'twitter' in root.lower() or 'tweets' in root.lower()
-                
-                files_to_upload.append((filepath, metadata_path, is_twitter))
-    
-    return files_to_upload
+                record_stat('total')
+                stats = {}
+                if claim == 'done':
+                    record_outcome(filepath, 'skipped', stats, reason="same content handled by another worker")
+                    work_queue.finish(path, 'skipped')
+                    continue
+                future = pipeline.submit(filepath, metadata_path, is_twitter, stats=stats)
+                future.add_done_callback(finisher(path, stats))
+        completed = True
+    except KeyboardInterrupt:
+        if not silent:
+            print("\n\nInterrupted by user! Finishing the uploads in progress...")
+    finally:
+        try:
+            # Unless the queue ran dry, drop queued uploads but let running ones finish and record
+            # their outcome
+            pipeline.close(cancel=not completed)
+        finally:
+            stopped.set()
+            beater.join()
+            # Then give back the files this worker never got to (nothing of ours is in flight any more)
+            with contextlib.suppress(sqlite3.Error):
+                work_queue.release(snapshot())
+            index.close()
+            work_queue.close()
+    if not silent:
+        print_upload_summary("Upload worker done!")
+    with stats_lock:
+        return dict(upload_stats)
 
-def upload_all_files(directory, delay=0.5):
-    """Upload all downloaded files with delay between uploads"""
-    print("\n" + "="*50)
-    print("Starting batch upload process...")
-    print("="*50)
-    
-    # Collect all files
-    files_to_upload = collect_files_to_upload(directory)
-    upload_stats['total'] = len(files_to_upload)
-    
-    if upload_stats['total'] == 0:
-        print("\nNo files found to upload!")
-        return
-    
-    print(f"\nFound {upload_stats['total']} files to upload\n")
-    
-    # Upload each file with delay (silent mode - no individual error messages)
-    for i, (filepath, metadata_path, is_twitter) in enumerate(files_to_upload):
-        upload_file(filepath, metadata_path, silent=True, is_twitter=is_twitter)
-        
-        # Update progress bar
-        print_progress_bar(i + 1, upload_stats['total'])
-        
-        # Add delay between uploads (except after the last one)
-        if i < len(files_to_upload) - 1:
-            time.sleep(delay)
-    
-    # Print final stats
-    print("\n\n" + "="*50)
-    print("Upload complete!")
-    print(f"  Uploaded: {upload_stats['uploaded']}")
-    print(f"  Failed: {upload_stats['failed']}")
-    print(f"  Total: {upload_stats['total']}")
-    print("="*50)
+def print_queue_status(download_dir=DOWNLOAD_DIR, as_json=False):
+    """Print the shared upload queue of a download directory with the counts of all workers added up"""
+    work_queue = WorkQueue(queue_path(download_dir))
+    try:
+        status = work_queue.status()
+    finally:
+        work_queue.close()
+    if as_json:
+        print(json.dumps(status, indent=2))
+        return status
+    files = status['files']
+    totals = status['upload_stats']
+    print(f"Queue {queue_path(download_dir)}")
+    print(f"  Files: {files['pending']} pending, {files['leased']} leased, {files['done']} done, "
+          f"{files['failed']} failed")
+    print(f"  Workers: {len(status['live_workers'])} live of {status['workers']}")
+    print(f"  Uploaded: {totals.get('uploaded', 0)}, skipped: {totals.get('skipped', 0)}, "
+          f"failed: {totals.get('failed', 0)}, quarantined: {totals.get('quarantined', 0)}, "
+          f"sent: {totals.get('bytes', 0) / 1048576:.1f} MB")
+    return status
 
 def build_url_from_tags(tags, site="rule34"):
     """Build a booru URL from tags"""
@@ -434,88 +3705,602 @@ def build_twitter_url(search_query):
     else:
         return f"https://twitter.com/{query}"
 
-def download_from_booru(url, limit=None, download_dir=DOWNLOAD_DIR, write_metadata=True):
-    """Download images using gallery-dl - OPTIMIZED VERSION"""
+def build_gallery_dl_cmd(url, limit=None, download_dir=DOWNLOAD_DIR, write_metadata=True, use_module=False,
+                         extra_args=None):
+    """Build the gallery-dl command line"""
+    # Use the gallery-dl executable, or the Python module if it's not in PATH
+    if use_module:
+        cmd = [sys.executable, "-m", "gallery_dl", "--destination", download_dir]
+    else:
+        cmd = ["gallery-dl", "--destination", download_dir]
+    
+    # Add metadata flag if enabled
+    if write_metadata:
+        cmd.append("--write-metadata")
+        # Rule34/Gelbooru only report tags by category (tags_<category>, see extract_tag_categories) with their
+        # 'tags' option; in-process runs apply it to the run's own config like every other option here
+        cmd.extend(["-o", "extractor.rule34.tags=true", "-o", "extractor.gelbooru.tags=true"])
+    
+    if limit:
+        cmd.extend(["--range", f"1-{limit}"])
+    
+    if extra_args:
+        cmd.extend(extra_args)
+    
+    # Files deleted after upload (compaction, staging) must not be downloaded again: record every
+    # download in the archive, and files already on disk too as gallery-dl skips them
+    if download_archive_enabled() and "--download-archive" not in cmd:
+        cmd.extend(["--download-archive", str(archive_path(download_dir)), "-o", "archive-event=file,skip"])
+    
+    cmd.append(url)
+    return cmd
+
+def run_gallery_dl(url, limit, download_dir, write_metadata, extra_args=None, output=None):
+    """Run gallery-dl to completion and return its exit code"""
+    if gallery_dl_in_process():
+        engine = GalleryDlEngine(url, limit, download_dir, write_metadata, extra_args, echo=output is None)
+        with run_metrics.timed('gallery_dl'):
+            return engine.run()
+    cmd = build_gallery_dl_cmd(url, limit, download_dir, write_metadata, extra_args=extra_args)
+    with run_metrics.timed('gallery_dl'):
+        try:
+            return subprocess.run(cmd, check=False, stdout=output).returncode
+        except FileNotFoundError:
+            # gallery-dl not in PATH, try module approach
+            print("Gallery-dl executable not found, trying Python module...")
+            cmd = build_gallery_dl_cmd(url, limit, download_dir, write_metadata, use_module=True,
+                                       extra_args=extra_args)
+            return subprocess.run(cmd, check=False, stdout=output).returncode
+
+def prepare_download(url, download_dir, write_metadata, interactive=True):
+    """Reset stats, setup gallery-dl config and create the download directory"""
     print(f"Downloading from: {url}")
     print(f"Download directory: {download_dir}")
     print(f"Metadata: {'Enabled' if write_metadata else 'Disabled'}")
     
-    # Reset stats
-    upload_stats['uploaded'] = 0
-    upload_stats['failed'] = 0
-    upload_stats['total'] = 0
+    reset_upload_stats()
     
     # Check if this is a Twitter URL
     is_twitter = 'twitter.com' in url.lower() or 'x.com' in url.lower()
     
     # Setup gallery-dl config (check Twitter config if needed)
-    setup_gallery_dl_config(check_twitter=is_twitter)
+    if gallery_dl_in_process():
+        check_gallery_dl_config(check_twitter=is_twitter, interactive=interactive)
+    else:
+        setup_gallery_dl_config(check_twitter=is_twitter, interactive=interactive)
     
     # Create download directory
     os.makedirs(download_dir, exist_ok=True)
-    
-    # Build gallery-dl command - try direct executable first
-    cmd = ["gallery-dl", "--destination", download_dir]
-    
-    # Add metadata flag if enabled
-    if write_metadata:
-        cmd.append("--write-metadata")
-    
-    if limit:
-        cmd.extend(["--range", f"1-{limit}"])
-    
-    cmd.append(url)
+
+def download_from_booru(url, limit=None, download_dir=DOWNLOAD_DIR, write_metadata=True, interactive=True,
+                        output=None, extra_args=None, on_file=None):
+    """Download images using gallery-dl - OPTIMIZED VERSION"""
+    prepare_download(url, download_dir, write_metadata, interactive)
     
     try:
         print("\nStarting download...")
         
-        # Run with live output for better performance
-        # gallery-dl handles its own progress display
-        result = subprocess.run(cmd, check=False)
+        if on_file is not None:
+            # Read the file list gallery-dl prints so the caller sees every file
+            def echo(filepath, metadata_path):
+                print(filepath)
+                on_file(filepath, metadata_path)
+            process = start_gallery_dl(url, limit, download_dir, write_metadata, extra_args)
+            returncode = stream_gallery_dl_files(process, echo)
+        else:
+            # Run with live output for better performance
+            # gallery-dl handles its own progress display
+            returncode = run_gallery_dl(url, limit, download_dir, write_metadata, extra_args, output)
         
-        if result.returncode == 0:
-            # Count files only once after download completes
-            file_count = len(collect_files_to_upload(download_dir))
+        if returncode == 0:
+            # Count files only once after download completes (this also builds the
+            # manifest the upload phase reuses)
+            manifest = FileManifest(state_db_path(download_dir))
+            try:
+                file_count = manifest.count(download_dir)
+            finally:
+                manifest.close()
             print(f"\nDownload complete! ({file_count} files total)\n")
             return True
         else:
-            print(f"Error: gallery-dl exited with code {result.returncode}")
+            print(f"Error: gallery-dl exited with code {returncode}")
             return False
             
     except KeyboardInterrupt:
         print("\n\nInterrupted by user!")
         return False
-    except FileNotFoundError:
-        # gallery-dl not in PATH, try module approach
-        print("Gallery-dl executable not found, trying Python module...")
-        cmd = [sys.executable, "-m", "gallery_dl", "--destination", download_dir]
-        
-        if write_metadata:
-            cmd.append("--write-metadata")
-        
-        if limit:
-            cmd.extend(["--range", f"1-{limit}"])
-        
-        cmd.append(url)
-        
+    except Exception as e:
+        print(f"\nError during download: {e}")
+        return False
+
+def parse_gallery_dl_line(line):
+    """Return the file path from a gallery-dl output line, or None"""
+    # When stdout is a pipe gallery-dl prints one path per line,
+    # prefixed with '# ' when the file already existed and was skipped
+    line = line.rstrip('\r\n')
+    if line.startswith('# '):
+        line = line[2:]
+    if not line or line.endswith('.json') or not os.path.isfile(line):
+        return None
+    return Path(line)
+
+def start_gallery_dl(url, limit, download_dir, write_metadata, extra_args=None):
+    """Start gallery-dl in the background with its file list piped to us"""
+    if gallery_dl_in_process():
+        return GalleryDlEngine(url, limit, download_dir, write_metadata, extra_args).start()
+    for use_module in (False, True):
+        cmd = build_gallery_dl_cmd(url, limit, download_dir, write_metadata, use_module=use_module,
+                                   extra_args=extra_args)
         try:
-            result = subprocess.run(cmd, check=False)
-            
-            if result.returncode == 0:
-                file_count = len(collect_files_to_upload(download_dir))
-                print(f"\nDownload complete! ({file_count} files total)\n")
-                return True
-            else:
-                print(f"Error: gallery-dl exited with code {result.returncode}")
-                return False
-        except Exception as e:
-            print(f"\nError during download: {e}")
-            return False
+            return subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True,
+                                    encoding='utf-8', errors='replace', bufsize=1)
+        except FileNotFoundError:
+            if use_module:
+                raise
+            print("Gallery-dl executable not found, trying Python module...")
+
+def _pump_lines(stream, out_queue):
+    """Copy lines from a stream into a queue, followed by None"""
+    try:
+        for line in stream:
+            out_queue.put(line)
+    finally:
+        out_queue.put(None)
+
+def stream_gallery_dl_files(process, on_file):
+    """Call on_file(filepath, metadata_path) for each file gallery-dl reports, return its exit code"""
+    if isinstance(process, GalleryDlEngine):
+        # In-process runs hand over the finished paths directly
+        lines, parse = process.files, Path
+    else:
+        # Read gallery-dl's output on a separate thread so a full upload queue
+        # never blocks the download itself
+        lines, parse = queue.Queue(), parse_gallery_dl_line
+        reader = threading.Thread(target=_pump_lines, args=(process.stdout, lines), daemon=True)
+        reader.start()
+    
+    # gallery-dl reports each path once the file has been written
+    with run_metrics.timed('gallery_dl'):
+        for line in iter(lines.get, None):
+            filepath = parse(line)
+            if filepath is not None:
+                on_file(filepath, filepath.with_suffix(filepath.suffix + '.json'))
+        return process.wait()
+
+def download_and_upload(url, limit=None, download_dir=DOWNLOAD_DIR, write_metadata=True,
+                        workers=DEFAULT_UPLOAD_WORKERS, delay=0.5, use_index=True, warm_index=False,
+                        journal=None, interactive=True, sync_state=None, use_tag_cache=True, server_check=True,
+                        merge_tags=False):
+    """Download with gallery-dl and upload each file as soon as it is complete"""
+    prepare_download(url, download_dir, write_metadata, interactive)
+    
+    print("\n" + "="*50)
+    print("Starting download + upload pipeline...")
+    print("="*50 + "\n")
+    
+    is_twitter = 'twitter.com' in url.lower() or 'x.com' in url.lower()
+    
+    def show_progress(done):
+        print_progress_bar(done, max(done, upload_stats['total']))
+    
+    # Sync mode only fetches posts newer than the last run
+    tracker = SyncTracker(sync_state, url, download_dir, limit) if sync_state is not None else None
+    
+    try:
+        process = start_gallery_dl(url, limit, download_dir, write_metadata,
+                                   tracker.gallery_dl_args() if tracker else None)
     except Exception as e:
         print(f"\nError during download: {e}")
         return False
+    
+    index = open_upload_index(download_dir, warm_index) if use_index else None
+    pipeline = UploadPipeline(workers, delay, silent=True, on_done=show_progress,
+                              sidecar_wait=SIDECAR_WAIT if write_metadata else 0, index=index,
+                              journal=journal, tag_cache=get_tag_cache() if use_tag_cache else None,
+                              server_check=server_check, merge_tags=merge_tags,
+                              store=open_staging_store(download_dir, index),
+                              validator=open_media_validator(download_dir))
+    finished = threading.Event()  # Set once gallery-dl is done: missing sidecars won't appear anymore
+    
+    def on_file(filepath, metadata_path):
+        if tracker is not None:
+            tracker.observe(filepath, metadata_path)
+        record_stat('total')
+        pipeline.submit(filepath, metadata_path, is_twitter or 'twitter' in str(filepath).lower(),
+                        finished=finished)
+    
+    try:
+        returncode = stream_gallery_dl_files(process, on_file)
+        finished.set()
+        if returncode == 0 and tracker is not None:
+            tracker.commit()
+        if returncode == 0 and journal is not None:
+            journal.write('download_done')
+        pipeline.close()
+    except KeyboardInterrupt:
+        process.terminate()
+        pipeline.close(wait=False)
+        print("\n\nInterrupted by user!")
+        return False
+    finally:
+        if index is not None:
+            index.close()
+    
+    if returncode != 0:
+        print(f"\n\nError: gallery-dl exited with code {returncode}")
+    print_upload_summary("Download + upload complete!")
+    return returncode == 0
+
+def list_remote_files(url, limit=None, extra_args=None):
+    """Ask gallery-dl for the file URLs and metadata of a query without downloading anything
+
+    Returns (exit code, [(file_url, metadata)]).
+    """
+    if gallery_dl_in_process():
+        engine = GalleryDlEngine(url, limit, DOWNLOAD_DIR, False, extra_args)
+        with run_metrics.timed('gallery_dl'):
+            returncode, messages = engine.list_files()
+        return returncode, remote_file_messages(messages)
+    
+    args = ["--dump-json"] + list(extra_args or [])
+    for use_module in (False, True):
+        cmd = build_gallery_dl_cmd(url, limit, DOWNLOAD_DIR, False, use_module=use_module, extra_args=args)
+        try:
+            with run_metrics.timed('gallery_dl'):
+                result = subprocess.run(cmd, check=False, stdout=subprocess.PIPE, text=True,
+                                        encoding='utf-8', errors='replace')
+            break
+        except FileNotFoundError:
+            if use_module:
+                raise
+            print("Gallery-dl executable not found, trying Python module...")
+    
+    try:
+        messages = json.loads(result.stdout) if result.stdout.strip() else []
+    except ValueError:
+        return result.returncode or 1, []
+    return result.returncode, remote_file_messages(messages)
+
+def remote_file_messages(messages):
+    """[(file_url, metadata)] from gallery-dl's --dump-json messages"""
+    # Each message is [type, ...]; type 3 is a file: [3, url, metadata]
+    return [(message[1], message[2]) for message in messages
+            if isinstance(message, list) and len(message) >= 3 and message[0] == 3]
+
+def remote_upload(url, limit=None, workers=DEFAULT_UPLOAD_WORKERS, delay=0.5, use_index=True, warm_index=False,
+                  download_dir=DOWNLOAD_DIR, sync_state=None, use_tag_cache=True):
+    """Create posts straight from the booru's file URLs without storing the media locally"""
+    print(f"Fetching file list from: {url}")
+    
+    tracker = SyncTracker(sync_state, url, download_dir, limit) if sync_state is not None else None
+    # The download archive only applies to real downloads; the ID filter still works
+    extra_args = tracker.gallery_dl_args() if tracker else []
+    if "--download-archive" in extra_args:
+        position = extra_args.index("--download-archive")
+        del extra_args[position:position + 2]
+    
+    try:
+        returncode, files = list_remote_files(url, limit, extra_args)
+    except Exception as e:
+        print(f"\nError listing files: {e}")
+        return False
+    
+    if returncode != 0:
+        print(f"Error: gallery-dl exited with code {returncode}")
+        return False
+    
+    with stats_lock:
+        upload_stats['total'] = len(files)
+    if not files:
+        print("\nNo files found to upload!")
+        return True
+    
+    print(f"\nFound {len(files)} files, creating posts from their URLs ({max(1, int(workers))} workers)\n")
+    
+    index = open_upload_index(download_dir, warm_index) if use_index else None
+    total = len(files)
+    try:
+        with UploadPipeline(workers, delay, silent=True, index=index,
+                            tag_cache=get_tag_cache() if use_tag_cache else None,
+                            on_done=lambda done: print_progress_bar(done, total)) as pipeline:
+            for file_url, metadata in files:
+                if tracker is not None:
+                    tracker.observe_id(metadata.get('id'))
+                pipeline.submit_remote(file_url, metadata)
+        if tracker is not None:
+            tracker.commit()
+    finally:
+        if index is not None:
+            index.close()
+    
+    print_upload_summary("Remote upload complete!")
+    return True
+
+# Domains used to tell which site a URL belongs to (for per-site limits)
+SITE_DOMAINS = [
+    ("rule34", "rule34.xxx"),
+    ("danbooru", "donmai.us"),
+    ("gelbooru", "gelbooru.com"),
+    ("e621", "e621.net"),
+    ("safebooru", "safebooru.org"),
+    ("twitter", "twitter.com"),
+    ("twitter", "x.com")
+]
+
+def site_for_url(url):
+    """Return the site name of a booru/Twitter URL"""
+    host = urlparse(url).netloc.lower()
+    for site, domain in SITE_DOMAINS:
+        if host == domain or host.endswith("." + domain):
+            return site
+    return host or "unknown"
+
+def parse_query_line(line):
+    """Parse a query list line into {'query', 'site', 'url'}, or None for blanks/comments
+
+    Accepted forms: a full URL, 'twitter: @user', '<site>: tags' or just tags (Rule34).
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if '://' in line:
+        url = line
+    else:
+        prefix, sep, rest = line.partition(':')
+        prefix = prefix.strip().lower()
+        if sep and prefix == "twitter":
+            url = build_twitter_url(rest)
+        elif sep and prefix in ("rule34", "danbooru", "gelbooru", "e621", "safebooru"):
+            url = build_url_from_tags(rest.strip(), prefix)
+        else:
+            url = build_url_from_tags(line)
+    return {"query": line, "site": site_for_url(url), "url": url}
+
+def load_query_file(path):
+    """Read a query list file, one query per line"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [entry for entry in map(parse_query_line, f) if entry]
+
+class SiteScheduler:
+    """Queue of queries that only hands out a query once its site has a free slot
+
+    Download threads take their next query here, so queries for a site that
+    already has per_site downloads running wait in the queue instead of
+    holding a thread another site could use. Higher priorities go first,
+    equal ones in the order they were put.
+    """
+    
+    def __init__(self, per_site=BATCH_PER_SITE):
+        self.per_site = max(1, per_site)
+        self.pending = []  # Sorted [(-priority, sequence, site, item)]
+        self.running = collections.Counter()
+        self.sequence = 0
+        self.closed = False
+        self.condition = threading.Condition()
+    
+    def put(self, item, site, priority=0):
+        with self.condition:
+            self.sequence += 1
+            bisect.insort(self.pending, (-priority, self.sequence, site, item))
+            self.condition.notify_all()
+    
+    def take(self):
+        """Wait for a query whose site has a free slot and return (site, item); None once closed and empty"""
+        with self.condition:
+            while True:
+                for position, (_, _, site, item) in enumerate(self.pending):
+                    if self.running[site] < self.per_site:
+                        del self.pending[position]
+                        self.running[site] += 1
+                        return site, item
+                if self.closed and not self.pending:
+                    return None
+                self.condition.wait()
+    
+    def done(self, site):
+        """Give back the slot of a query taken for this site"""
+        with self.condition:
+            self.running[site] -= 1
+            self.condition.notify_all()
+    
+    def close(self):
+        """Let take() return None once every queued query has been handed out"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class QueryRunner:
+    """Runs queries (one gallery-dl run each) against a shared upload pipeline
+
+    Used by batch mode and the daemon. Queries are put on the scheduler and
+    run by the threads calling work(); at most per_site of them download
+    from the same site at once.
+    """
+    
+    def __init__(self, pipeline, download_dir=DOWNLOAD_DIR, limit=None, write_metadata=True, sync_state=None,
+                 per_site=BATCH_PER_SITE):
+        self.pipeline = pipeline
+        self.download_dir = download_dir
+        self.limit = limit
+        self.write_metadata = write_metadata
+        self.sync_state = sync_state
+        self.scheduler = SiteScheduler(per_site)
+        self.processes = set()
+        self.lock = threading.Lock()
+    
+    def work(self, handle):
+        """Call handle(item, release) for each query the scheduler hands this thread until it is closed
+
+        release() gives the site's slot back; it is called at the latest when handle returns.
+        """
+        while (taken := self.scheduler.take()) is not None:
+            site, item = taken
+            released = []
+            
+            def release():
+                if not released:
+                    released.append(True)
+                    self.scheduler.done(site)
+            try:
+                handle(item, release)
+            finally:
+                release()
+    
+    def run(self, entry, limit=None, write_metadata=None, sync=True, release=None):
+        """Download and upload one {'query', 'site', 'url'} entry, return its report
+
+        limit and write_metadata default to the runner's; sync=False ignores the sync state.
+        release() is called once the download is done, before waiting for the uploads.
+        """
+        limit = self.limit if limit is None else limit
+        write_metadata = self.write_metadata if write_metadata is None else write_metadata
+        pipeline = self.pipeline
+        stats = {"downloaded": 0, "uploaded": 0, "failed": 0, "skipped": 0, "quarantined": 0, "total": 0,
+                 "bytes": 0}
+        report = {"query": entry['query'], "site": entry['site'], "url": entry['url'], "error": None}
+        futures = []
+        start = time.monotonic()
+        tracker = SyncTracker(self.sync_state, entry['url'], self.download_dir, limit) \
+            if sync and self.sync_state is not None else None
+        finished = threading.Event()  # Set once gallery-dl is done: missing sidecars won't appear anymore
+        
+        def on_file(filepath, metadata_path):
+            if tracker is not None:
+                tracker.observe(filepath, metadata_path)
+            try:
+                size = filepath.stat().st_size
+            except OSError:
+                size = 0
+            with stats_lock:
+                stats['downloaded'] += 1
+                stats['bytes'] += size
+            if pipeline is not None:
+                record_stat('total', stats=stats)
+                is_twitter = entry['site'] == "twitter" or 'twitter' in str(filepath).lower()
+                futures.append(pipeline.submit(filepath, metadata_path, is_twitter, stats=stats,
+                                               sidecar_wait=SIDECAR_WAIT if write_metadata else 0,
+                                               finished=finished))
+        
+        try:
+            process = start_gallery_dl(entry['url'], limit, self.download_dir, write_metadata,
+                                       tracker.gallery_dl_args() if tracker else None)
+            with self.lock:
+                self.processes.add(process)
+            report['exit_code'] = stream_gallery_dl_files(process, on_file)
+            with self.lock:
+                self.processes.discard(process)
+            if report['exit_code'] == 0 and tracker is not None:
+                report['high_water'] = tracker.commit()
+        except Exception as e:
+            report['exit_code'] = None
+            report['error'] = str(e)
+        finished.set()
+        if release is not None:
+            release()
+        report['download_seconds'] = round(time.monotonic() - start, 3)
+        
+        # The query is done once all of its uploads are
+        for future in futures:
+            future.result()
+        elapsed = time.monotonic() - start
+        report.update(stats)
+        report['elapsed'] = round(elapsed, 3)
+        report['files_per_sec'] = round(stats['downloaded'] / elapsed, 3) if elapsed else 0.0
+        report['mb_per_sec'] = round(stats['bytes'] / 1048576 / elapsed, 3) if elapsed else 0.0
+        if report['exit_code'] not in (0, None) and not report['error']:
+            report['error'] = f"gallery-dl exited with code {report['exit_code']}"
+        
+        status = "✓" if not report['error'] else "✗"
+        print(f"{status} {entry['query']}: {stats['downloaded']} downloaded, {stats['uploaded']} uploaded, "
+              f"{stats['skipped']} skipped, {stats['failed']} failed ({report['files_per_sec']} files/s)")
+        return report
+    
+    def terminate(self):
+        """Stop all running gallery-dl downloads"""
+        with self.lock:
+            for process in self.processes:
+                process.terminate()
+
+def run_batch(queries, download_dir=DOWNLOAD_DIR, limit=None, write_metadata=True, should_upload=True,
+              workers=DEFAULT_UPLOAD_WORKERS, delay=0.5, per_site=BATCH_PER_SITE,
+              max_downloads=BATCH_DOWNLOADS, use_index=True, warm_index=False, sync=False, use_tag_cache=True,
+              server_check=True, merge_tags=False):
+    """Run many queries with parallel gallery-dl processes feeding one shared upload pipeline"""
+    print("\n" + "="*50)
+    print(f"Batch: {len(queries)} queries, {max_downloads} parallel downloads ({per_site} per site)")
+    print("="*50 + "\n")
+    
+    reset_upload_stats()
+    if gallery_dl_in_process():
+        check_gallery_dl_config(check_twitter=any(q['site'] == "twitter" for q in queries), interactive=False)
+    else:
+        setup_gallery_dl_config(check_twitter=any(q['site'] == "twitter" for q in queries), interactive=False)
+    os.makedirs(download_dir, exist_ok=True)
+    
+    index = open_upload_index(download_dir, warm_index) if should_upload and use_index else None
+    sync_state = SyncState(state_db_path(download_dir)) if sync else None
+    pipeline = UploadPipeline(workers, delay, silent=True, index=index,
+                              sidecar_wait=SIDECAR_WAIT if write_metadata else 0,
+                              tag_cache=get_tag_cache() if use_tag_cache else None,
+                              server_check=server_check, merge_tags=merge_tags,
+                              store=open_staging_store(download_dir, index),
+                              validator=open_media_validator(download_dir)) if should_upload else None
+    
+    runner = QueryRunner(pipeline, download_dir, limit, write_metadata, sync_state, per_site)
+    for position, query in enumerate(queries):
+        runner.scheduler.put(position, query['site'])
+    runner.scheduler.close()
+    reports = [None] * len(queries)
+    
+    def run_query(position, release):
+        reports[position] = runner.run(queries[position], release=release)
+    
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_downloads), thread_name_prefix="query") as executor:
+            threads = [executor.submit(runner.work, run_query) for _ in range(max(1, max_downloads))]
+            for thread in threads:
+                thread.result()
+        if pipeline is not None:
+            pipeline.close()
+    except KeyboardInterrupt:
+        runner.terminate()
+        if pipeline is not None:
+            pipeline.close(wait=False)
+        print("\n\nInterrupted by user!")
+        raise
+    finally:
+        if index is not None:
+            index.close()
+        if sync_state is not None:
+            sync_state.close()
+    
+    print_batch_report(reports, time.monotonic() - start)
+    return reports
+
+def print_batch_report(reports, elapsed):
+    """Print a per-query table and the batch totals"""
+    print("\n" + "="*50)
+    print("Batch complete!")
+    print("="*50)
+    print(f"{'Query':<30} {'Down':>6} {'Up':>6} {'Skip':>6} {'Fail':>6} {'Files/s':>8}")
+    for report in reports:
+        query = report['query'] if len(report['query']) <= 30 else report['query'][:27] + "..."
+        print(f"{query:<30} {report['downloaded']:>6} {report['uploaded']:>6} {report['skipped']:>6} "
+              f"{report['failed']:>6} {report['files_per_sec']:>8}")
+    downloaded = sum(report['downloaded'] for report in reports)
+    total_bytes = sum(report['bytes'] for report in reports)
+    print("-"*50)
+    print(f"  Downloaded: {downloaded} ({total_bytes / 1048576:.1f} MB)")
+    print(f"  Uploaded: {upload_stats['uploaded']}")
+    print(f"  Failed: {upload_stats['failed']}")
+    print(f"  Skipped (already uploaded): {upload_stats['skipped']}")
+    if elapsed:
+        print(f"  Throughput: {downloaded / elapsed:.2f} files/s, {total_bytes / 1048576 / elapsed:.2f} MB/s")
+    print("="*50)
 
-def main():
+def interactive_main():
+    """Ask for every job setting with prompts and run the job"""
     print("Booru/Twitter to Szurubooru Uploader (Batch Upload)")
     print("="*50)
     
@@ -591,19 +4376,697 @@ def main():
     metadata_input = input("Download metadata JSON files? (y/n, default: y): ").strip().lower()
     write_metadata = metadata_input != 'n'
     
+    # Ask about incremental sync
+    sync_input = input("Only download posts newer than the last run of this search? (y/n, default: n): ").strip().lower()
+    sync = sync_input == 'y'
+    
     # Ask about upload
     upload_input = input("Upload to Szurubooru after download? (y/n, default: y): ").strip().lower()
     should_upload = upload_input != 'n'
     
-    # Download all files first
-    if download_from_booru(url, limit, download_dir, write_metadata):
+    # Ask about upload concurrency
+    workers = DEFAULT_UPLOAD_WORKERS
+    warm_index = False
+    stream = False
+    remote = False
+    if should_upload:
+        workers_input = input(f"Number of parallel uploads? (press Enter for {DEFAULT_UPLOAD_WORKERS}): ").strip()
+        workers = int(workers_input) if workers_input.isdigit() and int(workers_input) > 0 else DEFAULT_UPLOAD_WORKERS
+        warm_input = input("Check which posts are already on the server before uploading? (y/n, default: n): ").strip().lower()
+        warm_index = warm_input == 'y'
+        stream_input = input("Upload files while they are downloading? (y/n, default: y): ").strip().lower()
+        stream = stream_input != 'n'
+        if site_for_url(url) != "twitter":
+            remote_input = input("Let Szurubooru fetch files from the booru instead of downloading them? "
+                                 "(y/n, default: n): ").strip().lower()
+            remote = remote_input == 'y'
+    
+    run_download_job(url, limit, download_dir, write_metadata, should_upload,
+                     workers=workers, stream=stream, warm_index=warm_index, sync=sync, remote=remote)
+
+def run_download_job(url, limit=None, download_dir=DOWNLOAD_DIR, write_metadata=True, should_upload=True,
+                     workers=DEFAULT_UPLOAD_WORKERS, stream=True, warm_index=False, journal=None,
+                     delay=0.5, use_index=True, interactive=True, output=None, sync=False, use_tag_cache=True,
+                     remote=False, server_check=True, merge_tags=False):
+    """Download and upload one job, recording its progress in the job journal"""
+    reset_upload_stats()
+    if journal is None:
+        journal = JobJournal(journal_path(download_dir))
+        journal.start_job(url=url, limit=limit, download_dir=str(download_dir), write_metadata=write_metadata,
+                          should_upload=should_upload, workers=workers, stream=stream, delay=delay, sync=sync,
+                          remote=remote, server_check=server_check, merge_tags=merge_tags, use_index=use_index,
+                          use_tag_cache=use_tag_cache, warm_index=warm_index)
+    os.makedirs(download_dir, exist_ok=True)
+    sync_state = SyncState(state_db_path(download_dir)) if sync else None
+    try:
+        if should_upload and remote and site_for_url(url) != "twitter":
+            # Nothing is stored locally; the index makes a rerun skip what was already posted
+            if not remote_upload(url, limit, workers=workers, delay=delay, use_index=use_index,
+                                 warm_index=warm_index, download_dir=download_dir, sync_state=sync_state,
+                                 use_tag_cache=use_tag_cache):
+                print("\nRemote upload failed.")
+                return False
+            return True
+        
+        if should_upload and stream:
+            if not download_and_upload(url, limit, download_dir, write_metadata, workers=workers, delay=delay,
+                                       use_index=use_index, warm_index=warm_index, journal=journal,
+                                       interactive=interactive, sync_state=sync_state,
+                                       use_tag_cache=use_tag_cache, server_check=server_check,
+                                       merge_tags=merge_tags):
+                print("\nDownload failed.")
+                return False
+            return True
+        
+        # Download all files first (a resumed job skips a download that already finished)
+        if not (journal.job or {}).get('download_done'):
+            tracker = SyncTracker(sync_state, url, download_dir, limit) if sync_state is not None else None
+            if not download_from_booru(url, limit, download_dir, write_metadata, interactive, output,
+                                       extra_args=tracker.gallery_dl_args() if tracker else None,
+                                       on_file=tracker.observe if tracker else None):
+                print("\nDownload failed.")
+                return False
+            if tracker is not None:
+                tracker.commit()
+            journal.write('download_done')
+        
         if should_upload:
-            # Then upload them all with 0.5 second delay
-            upload_all_files(download_dir, delay=0.5)
+            # Then upload them all, starting at most 1/delay uploads per second
+            upload_all_files(download_dir, delay=delay, workers=workers, use_index=use_index,
+                             warm_index=warm_index, journal=journal, use_tag_cache=use_tag_cache,
+                             server_check=server_check, merge_tags=merge_tags)
         else:
             print("\nDownload complete! Skipping upload.")
+        return True
+    finally:
+        journal.close()
+        if sync_state is not None:
+            sync_state.close()
+
+def resume_job(download_dir=DOWNLOAD_DIR, interactive=True, output=None):
+    """Continue the last job recorded in the journal of a download directory"""
+    journal = JobJournal(journal_path(download_dir), resume=True)
+    job = journal.job
+    if job is None:
+        journal.close()
+        print(f"No job to resume for {download_dir}")
+        return False
+    
+    counts = journal.summary()
+    print("Resuming job:")
+    print(f"  URL: {job['url']}")
+    print(f"  Posted: {counts.get('posted', 0)}, pending tokens: {counts.get('token', 0)}, "
+          f"failed: {counts.get('failed', 0)}")
+    return run_download_job(job['url'], job.get('limit'), job.get('download_dir', download_dir),
+                            job.get('write_metadata', True), job.get('should_upload', True),
+                            workers=job.get('workers', DEFAULT_UPLOAD_WORKERS), stream=job.get('stream', True),
+                            journal=journal, delay=job.get('delay', 0.5), interactive=interactive,
+                            output=output, sync=job.get('sync', False), remote=job.get('remote', False),
+                            server_check=job.get('server_check', True), merge_tags=job.get('merge_tags', False),
+                            use_index=job.get('use_index', True), use_tag_cache=job.get('use_tag_cache', True),
+                            warm_index=job.get('warm_index', False))
+
+@dataclass
+class JobSpec:
+    """Everything needed to run one download/upload job without prompts"""
+    url: str = None  # Full booru/Twitter URL (otherwise built from tags/twitter)
+    tags: str = None  # Space-separated booru tags
+    site: str = "rule34"  # rule34, danbooru, gelbooru, e621 or safebooru
+    twitter: str = None  # @username, #hashtag or Twitter URL
+    limit: int = None
+    download_dir: str = None  # Defaults to DOWNLOAD_DIR
+    write_metadata: bool = True
+    upload: bool = True
+    workers: int = None  # Defaults to DEFAULT_UPLOAD_WORKERS
+    delay: float = 0.5  # Starting seconds between upload starts, adapted to the server (0 = no limit)
+    stream: bool = True  # Upload while downloading
+    use_index: bool = True
+    warm_index: bool = False
+    use_tag_cache: bool = True  # Pre-create missing tags with their booru categories
+    server_check: bool = True  # Ask the server for content it already has before uploading
+    merge_tags: bool = False  # Add our tags to posts the server already has
+    compact_after: float = None  # Delete media this many days after their post is confirmed (None = keep)
+    resume: bool = False  # Continue the last job of download_dir instead
+    batch: str = None  # Query list file; runs every query in it instead
+    sync: bool = False  # Only fetch posts newer than the last run of the same query
+    remote: bool = False  # Let Szurubooru fetch booru files itself instead of downloading them
+    per_site: int = None  # Batch mode: parallel downloads per site (default BATCH_PER_SITE)
+    parallel_downloads: int = None  # Batch mode: parallel downloads overall (default BATCH_DOWNLOADS)
+    quiet: bool = True  # Suppress progress output
+    report: str = None  # JSONL file that gets every file's outcome and a final run record
+    metrics: str = None  # Prometheus text file written when the job ends
+
+    def resolve_url(self):
+        """Return the URL this job downloads from"""
+        if self.url:
+            return self.url
+        if self.twitter:
+            return build_twitter_url(self.twitter)
+        if self.tags:
+            return build_url_from_tags(self.tags, self.site)
+        return None
+
+@dataclass
+class JobResult:
+    """Outcome of run_job()"""
+    ok: bool
+    url: str = None
+    download_dir: str = None
+    uploaded: int = 0
+    failed: int = 0
+    skipped: int = 0
+    quarantined: int = 0  # Broken/unsupported files kept out of the upload queue
+    total: int = 0
+    bytes: int = 0  # Bytes sent to /api/uploads
+    elapsed: float = 0.0
+    error: str = None
+    connections: dict = field(default_factory=dict)
+    queries: list = field(default_factory=list)  # Per-query reports in batch mode
+    phases: dict = field(default_factory=dict)  # Time spent per phase (see RunMetrics)
+
+    def to_dict(self):
+        return asdict(self)
+
+def run_job(spec):
+    """Run a job non-interactively and return a JobResult
+
+    Stats are kept in module globals, so run one job per process at a time
+    (use a process pool to run many jobs in parallel).
+    """
+    download_dir = spec.download_dir or DOWNLOAD_DIR
+    url = spec.resolve_url()
+    result = JobResult(ok=False, url=url, download_dir=str(download_dir))
+    if not url and not spec.resume and not spec.batch:
+        result.error = "No URL, tags, Twitter query or batch file given"
+        return result
+    
+    start = time.monotonic()
+    if spec.report:
+        run_metrics.open_report(spec.report)
+    with contextlib.ExitStack() as stack:
+        if spec.compact_after is not None:
+            # Compacted files are only safe to delete if gallery-dl remembers it downloaded them;
+            # the next job in this process gets the configured setting back
+            stack.callback(configure, download_archive=DOWNLOAD_ARCHIVE)
+            configure(download_archive=True)
+        output = None
+        if spec.quiet:
+            output = stack.enter_context(open(os.devnull, 'w'))
+            stack.enter_context(contextlib.redirect_stdout(output))
+        try:
+            if spec.batch:
+                result.queries = run_batch(load_query_file(spec.batch), download_dir, spec.limit,
+                                           spec.write_metadata, spec.upload,
+                                           workers=spec.workers or DEFAULT_UPLOAD_WORKERS, delay=spec.delay,
+                                           per_site=spec.per_site or BATCH_PER_SITE,
+                                           max_downloads=spec.parallel_downloads or BATCH_DOWNLOADS,
+                                           use_index=spec.use_index, warm_index=spec.warm_index, sync=spec.sync,
+                                           use_tag_cache=spec.use_tag_cache, server_check=spec.server_check,
+                                           merge_tags=spec.merge_tags)
+                result.ok = not any(report['error'] for report in result.queries)
+            elif spec.resume:
+                result.ok = resume_job(download_dir, interactive=False, output=output)
+            else:
+                result.ok = run_download_job(url, spec.limit, download_dir, spec.write_metadata, spec.upload,
+                                             workers=spec.workers or DEFAULT_UPLOAD_WORKERS, stream=spec.stream,
+                                             warm_index=spec.warm_index, delay=spec.delay,
+                                             use_index=spec.use_index, interactive=False, output=output,
+                                             sync=spec.sync, use_tag_cache=spec.use_tag_cache,
+                                             remote=spec.remote, server_check=spec.server_check,
+                                             merge_tags=spec.merge_tags)
+            if spec.compact_after is not None:
+                removed, freed = compact_download_dir(download_dir, spec.compact_after)
+                print(f"\nCompacted {removed} uploaded files ({freed / 1048576:.1f} MB freed)")
+        except Exception as e:
+            result.error = str(e)
+    
+    result.elapsed = time.monotonic() - start
+    with stats_lock:
+        result.uploaded = upload_stats['uploaded']
+        result.failed = upload_stats['failed']
+        result.skipped = upload_stats['skipped']
+        result.quarantined = upload_stats['quarantined']
+        result.total = upload_stats['total']
+        result.bytes = upload_stats['bytes']
+    result.connections = connection_stats()
+    result.phases = run_metrics.summary()
+    if not result.ok and not result.error:
+        result.error = "Download failed"
+    if spec.report:
+        run_metrics.close_report(ok=result.ok, url=url, error=result.error)
+    if spec.metrics:
+        run_metrics.write_prometheus(spec.metrics)
+    return result
+
+class MirrorDaemon:
+    """Resident job runner: a priority queue of queries feeding one warm upload pipeline
+
+    The HTTP session, tag cache, upload index and sync state stay open
+    between jobs, so a job only pays for its own download and uploads.
+    Jobs with a higher priority start first; equal priorities run in
+    submission order.
+    """
+    
+    def __init__(self, download_dir=DOWNLOAD_DIR, limit=None, write_metadata=True, upload=True,
+                 workers=DEFAULT_UPLOAD_WORKERS, delay=0.5, per_site=BATCH_PER_SITE, max_downloads=BATCH_DOWNLOADS,
+                 use_index=True, warm_index=False, sync=False, use_tag_cache=True, server_check=True,
+                 merge_tags=False):
+        reset_upload_stats()
+        os.makedirs(download_dir, exist_ok=True)
+        self.sync = sync
+        self.index = open_upload_index(download_dir, warm_index) if upload and use_index else None
+        self.sync_state = SyncState(state_db_path(download_dir))
+        self.pipeline = UploadPipeline(workers, delay, silent=True, index=self.index, sidecar_wait=SIDECAR_WAIT,
+                                       on_done=self._upload_done,
+                                       tag_cache=get_tag_cache() if use_tag_cache else None,
+                                       server_check=server_check, merge_tags=merge_tags,
+                                       store=open_staging_store(download_dir, self.index),
+                                       validator=open_media_validator(download_dir)) if upload else None
+        self.runner = QueryRunner(self.pipeline, download_dir, limit, write_metadata, self.sync_state, per_site)
+        self.jobs = collections.OrderedDict()  # job id -> job record, oldest first
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        self.recent = collections.deque()  # Finish times of uploads in the last DAEMON_RATE_WINDOW seconds
+        self.started = time.monotonic()
+        self.threads = [threading.Thread(target=self._work, name=f"daemon-{n}", daemon=True)
+                        for n in range(max(1, max_downloads))]
+        for thread in self.threads:
+            thread.start()
+    
+    def submit(self, params):
+        """Queue a job from {'url'|'tags'|'twitter', 'site', 'limit', 'metadata', 'sync', 'priority'}"""
+        return self.submit_all([params])[0]
+    
+    def submit_all(self, entries):
+        """Queue several jobs, or none of them if one is invalid"""
+        jobs = [self._new_job(params) for params in entries]
+        for job in jobs:
+            with self.lock:
+                self.counter += 1
+                job['id'] = self.counter
+                self.jobs[job['id']] = job
+                self.counts['queued'] += 1
+                self._prune()
+            self.runner.scheduler.put(job['id'], job['site'], job['priority'])
+        return [dict(job) for job in jobs]
+    
+    def _new_job(self, params):
+        """Validate a job request, raising ValueError/TypeError, and return the job to queue"""
+        if not isinstance(params, dict):
+            raise TypeError("A job must be a JSON object")
+        for key in ('metadata', 'sync'):
+            if key in params and not isinstance(params[key], bool):
+                raise TypeError(f"'{key}' must be true or false")
+        spec = JobSpec(url=params.get('url'), tags=params.get('tags'), site=params.get('site') or "rule34",
+                       twitter=params.get('twitter'))
+        url = spec.resolve_url()
+        if not url:
+            raise ValueError("No url, tags or twitter query given")
+        limit = params.get('limit')
+        return {
+            "query": spec.tags or spec.twitter or url, "site": site_for_url(url), "url": url,
+            "limit": int(limit) if limit is not None else None,
+            "metadata": params.get('metadata', True),
+            "sync": params.get('sync', self.sync),
+            "priority": int(params.get('priority', 0)),
+            "state": "queued", "submitted": time.time(), "report": None
+        }
+    
+    def job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+    
+    def list_jobs(self, state=None):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values() if state is None or job['state'] == state]
+    
+    def status(self):
+        """Queue depth, job counts and throughput (overall and over the last DAEMON_RATE_WINDOW seconds)"""
+        now = time.monotonic()
+        with stats_lock:
+            totals = dict(upload_stats)
+        with self.lock:
+            self._trim(now)
+            recent = len(self.recent)
+            counts = dict(self.counts)
+        uptime = now - self.started
+        return {
+            "queue_depth": counts['queued'], "jobs": counts, "uptime": round(uptime, 1),
+            "uploaded": totals['uploaded'], "skipped": totals['skipped'], "failed": totals['failed'],
+            "quarantined": totals['quarantined'],
+            "bytes": totals['bytes'],
+            "files_per_sec": round(totals['uploaded'] / uptime, 3) if uptime else 0.0,
+            "recent_files_per_sec": round(recent / min(DAEMON_RATE_WINDOW, max(uptime, 1e-9)), 3),
+            "mb_per_sec": round(totals['bytes'] / 1048576 / uptime, 3) if uptime else 0.0,
+            "connections": connection_stats(),
+        }
+    
+    def prometheus(self):
+        """run_metrics in Prometheus text format plus the queue gauges"""
+        status = self.status()
+        lines = [run_metrics.prometheus().rstrip("\n"),
+                 "# HELP fitchas_daemon_jobs Daemon jobs by state.", "# TYPE fitchas_daemon_jobs gauge"]
+        for state, count in status['jobs'].items():
+            lines.append(f'fitchas_daemon_jobs{{state="{state}"}} {count}')
+        lines += ["# HELP fitchas_daemon_recent_files_per_second Files finished per second recently.",
+                  "# TYPE fitchas_daemon_recent_files_per_second gauge",
+                  f"fitchas_daemon_recent_files_per_second {status['recent_files_per_sec']}"]
+        return "\n".join(lines) + "\n"
+    
+    def _upload_done(self, completed):
+        now = time.monotonic()
+        with self.lock:
+            self.recent.append(now)
+            self._trim(now)
+    
+    def _trim(self, now):
+        while self.recent and self.recent[0] < now - DAEMON_RATE_WINDOW:
+            self.recent.popleft()
+    
+    def _prune(self):
+        # Forget the oldest finished jobs; queued and running ones are always kept
+        finished = len(self.jobs) - self.counts['queued'] - self.counts['running']
+        for job_id in list(self.jobs):
+            if finished <= DAEMON_KEEP_JOBS:
+                break
+            if self.jobs[job_id]['state'] in ("done", "failed"):
+                del self.jobs[job_id]
+                finished -= 1
+    
+    def _work(self):
+        self.runner.work(self._run_job)
+    
+    def _run_job(self, job_id, release):
+        with self.lock:
+            job = self.jobs[job_id]
+            job['state'] = "running"
+            job['started'] = time.time()
+            self.counts['queued'] -= 1
+            self.counts['running'] += 1
+        try:
+            report = self.runner.run(job, job['limit'], job['metadata'], job['sync'], release)
+        except Exception as e:
+            report = {"error": str(e)}
+        with self.lock:
+            job['report'] = report
+            job['state'] = "failed" if report['error'] else "done"
+            job['finished'] = time.time()
+            self.counts['running'] -= 1
+            self.counts[job['state']] += 1
+    
+    def close(self, wait=True):
+        """Stop taking jobs; with wait=False running downloads are stopped too"""
+        if not wait:
+            self.runner.terminate()
+        # Queued jobs still run before the threads exit
+        self.runner.scheduler.close()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        if self.pipeline is not None:
+            self.pipeline.close(wait=wait)
+        if self.index is not None:
+            self.index.close()
+        self.sync_state.close()
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """JSON control endpoint of a MirrorDaemon
+
+    GET  /status       queue depth, job counts and throughput
+    GET  /metrics      Prometheus text format
+    GET  /jobs         all known jobs (?state=queued|running|done|failed)
+    GET  /jobs/<id>    one job and its report
+    POST /jobs         submit a job object, or a list of them
+    POST /shutdown     finish the queue and exit
+    """
+    
+    protocol_version = "HTTP/1.1"
+    
+    def do_GET(self):
+        daemon = self.server.mirror_daemon
+        path = urlparse(self.path)
+        if path.path == "/status":
+            self._reply(200, daemon.status())
+        elif path.path == "/metrics":
+            self._reply(200, daemon.prometheus(), content_type="text/plain; version=0.0.4")
+        elif path.path == "/jobs":
+            state = dict(part.partition("=")[::2] for part in path.query.split("&") if part).get("state")
+            self._reply(200, daemon.list_jobs(state))
+        elif path.path.startswith("/jobs/") and path.path[6:].isdigit():
+            job = daemon.job(int(path.path[6:]))
+            self._reply(200 if job else 404, job or {"error": "No such job"})
+        else:
+            self._reply(404, {"error": "Not found"})
+    
+    def do_POST(self):
+        daemon = self.server.mirror_daemon
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path == "/jobs":
+            try:
+                params = json.loads(body or b"{}")
+                if isinstance(params, list):
+                    # All entries are checked before any is queued, so a bad one doesn't leave half a batch
+                    self._reply(202, daemon.submit_all(params))
+                else:
+                    self._reply(202, daemon.submit(params))
+            except (ValueError, TypeError, AttributeError) as e:
+                self._reply(400, {"error": str(e)})
+        elif self.path == "/shutdown":
+            self._reply(202, {"ok": True})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        else:
+            self._reply(404, {"error": "Not found"})
+    
+    def _reply(self, status, payload, content_type="application/json"):
+        body = (payload if isinstance(payload, str) else json.dumps(payload)).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+    
+    def log_message(self, format, *args):
+        pass
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+def make_daemon_server(daemon, address=DAEMON_ADDRESS):
+    """Bind the control endpoint: 'host:port' for HTTP, or a path for a Unix socket"""
+    if "/" in address or address.endswith(".sock"):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(address)
+        server = UnixHTTPServer(address, DaemonRequestHandler)
     else:
-        print("\nDownload failed.")
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), DaemonRequestHandler)
+    server.mirror_daemon = daemon
+    return server
+
+def run_daemon(address=DAEMON_ADDRESS, **settings):
+    """Run a MirrorDaemon with its control endpoint until Ctrl-C or POST /shutdown"""
+    if not gallery_dl_in_process():
+        setup_gallery_dl_config(interactive=False)
+    daemon = MirrorDaemon(**settings)
+    server = make_daemon_server(daemon, address)
+    print(f"Daemon listening on {address} (POST /jobs, GET /status, GET /metrics)")
+    try:
+        server.serve_forever()
+        daemon.close()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted by user!")
+        daemon.close(wait=False)
+    finally:
+        server.server_close()
+        if isinstance(server.server_address, str):
+            with contextlib.suppress(OSError):
+                os.unlink(server.server_address)
+    print_upload_summary("Daemon stopped")
+    return 0
+
+def build_arg_parser():
+    """Build the command line parser"""
+    parser = argparse.ArgumentParser(
+        description="Download from booru sites/Twitter with gallery-dl and upload to Szurubooru. "
+                    "Runs interactively when no arguments are given."
+    )
+    source = parser.add_argument_group("source")
+    source.add_argument("--url", help="full booru or Twitter URL")
+    source.add_argument("--tags", help="space-separated booru tags")
+    source.add_argument("--site", default="rule34",
+                        choices=["rule34", "danbooru", "gelbooru", "e621", "safebooru"],
+                        help="booru site used with --tags (default: rule34)")
+    source.add_argument("--twitter", metavar="QUERY", help="Twitter @username, #hashtag or URL")
+    source.add_argument("--limit", type=int, help="maximum number of files to download (per query in batch mode)")
+    source.add_argument("--batch", metavar="FILE",
+                        help="query list file: one URL, '<site>: tags' or 'twitter: @user' per line")
+    
+    job = parser.add_argument_group("job")
+    job.add_argument("--download-dir", help=f"download directory (default: {DOWNLOAD_DIR})")
+    job.add_argument("--no-metadata", action="store_true", help="don't write .json metadata files")
+    job.add_argument("--no-upload", action="store_true", help="only download")
+    job.add_argument("--workers", type=int,
+                     help=f"parallel uploads to start with, grows up to {ADAPTIVE_GROWTH}x while the server keeps up "
+                          f"(default: {DEFAULT_UPLOAD_WORKERS})")
+    job.add_argument("--delay", type=float, default=0.5,
+                     help="seconds between upload starts to begin with, adapted to server responses; "
+                          "0 for no limit (default: 0.5)")
+    job.add_argument("--no-stream", action="store_true", help="finish the download before uploading")
+    job.add_argument("--no-index", action="store_true", help="don't skip files found in the upload index")
+    job.add_argument("--no-tag-cache", action="store_true",
+                     help="don't pre-create missing tags (Szurubooru creates them without categories)")
+    job.add_argument("--no-server-check", action="store_true",
+                     help="don't ask the server which files it already has before uploading them")
+    job.add_argument("--merge-tags", action="store_true",
+                     help="add the tags of files already on the server to their existing posts")
+    job.add_argument("--store", action="store_true",
+                     help="keep each file once by content in <download dir>.store, hardlinked into query directories")
+    job.add_argument("--near-duplicates", action="store_true",
+                     help="skip files that look like an existing post (resized/re-encoded; with --merge-tags their "
+                          "tags are added to it); only posts this tool made for the download directory are "
+                          "known; needs numpy and Pillow")
+    job.add_argument("--phash-distance", type=int, metavar="BITS",
+                     help=f"max differing bits per perceptual hash for a near-duplicate (default: {PHASH_DISTANCE})")
+    job.add_argument("--no-validate", action="store_true",
+                     help="upload files without checking them first (broken files are quarantined by default)")
+    job.add_argument("--max-size", type=int, metavar="BYTES",
+                     help="quarantine files larger than this instead of uploading them")
+    job.add_argument("--order", choices=list(UPLOAD_ORDERS),
+                     help="order of uploads from a finished download (--no-stream, --enqueue): "
+                          "smallest/largest file first or interleaved by directory (default: walk)")
+    job.add_argument("--compact-after", type=float, metavar="DAYS",
+                     help="after the job, delete media whose post has been on the server for DAYS days "
+                          "(0 = right away), keeping only a metadata record")
+    job.add_argument("--warm-index", action="store_true",
+                     help="load checksums of posts already on the server before uploading")
+    job.add_argument("--resume", action="store_true", help="continue the last job of the download directory")
+    job.add_argument("--sync", action="store_true",
+                     help="incremental mode: stop at posts already seen by an earlier run of the same query")
+    job.add_argument("--remote", action="store_true",
+                     help="create booru posts from their file URLs (the server downloads them); "
+                          "falls back to download + upload when the server refuses")
+    job.add_argument("--parallel-downloads", type=int,
+                     help=f"batch/daemon mode: gallery-dl downloads at once (default: {BATCH_DOWNLOADS})")
+    job.add_argument("--per-site", type=int,
+                     help=f"batch/daemon mode: gallery-dl downloads per site (default: {BATCH_PER_SITE})")
+    job.add_argument("--daemon", nargs="?", const=DAEMON_ADDRESS, metavar="ADDRESS",
+                     help="stay resident and take jobs over HTTP on host:port, or a Unix socket path "
+                          f"(default: {DAEMON_ADDRESS}); see DaemonRequestHandler for the endpoints")
+    job.add_argument("--enqueue", action="store_true",
+                     help="add the files of the download directory to its shared upload queue "
+                          "(<download dir>.queue.sqlite) for --worker processes")
+    job.add_argument("--worker", action="store_true",
+                     help="upload files from the shared queue until it is empty; run one per host")
+    job.add_argument("--queue-status", action="store_true",
+                     help="show the shared upload queue and the upload counts of all workers")
+    
+    config = parser.add_argument_group("configuration")
+    config.add_argument("--config", help=f"JSON config file (default: {CONFIG_FILE})")
+    config.add_argument("--szuru-url", help="Szurubooru URL")
+    config.add_argument("--szuru-user", help="Szurubooru username")
+    config.add_argument("--szuru-token", help="Szurubooru API token")
+    config.add_argument("--twitter-cookies", metavar="FILE|BROWSER",
+                        help="cookies.txt file or browser to take Twitter cookies from")
+    config.add_argument("--subprocess", action="store_true",
+                        help="run gallery-dl as a separate process instead of through its Python API")
+    
+    output = parser.add_argument_group("output")
+    output.add_argument("--json", action="store_true", help="print the job result as JSON")
+    output.add_argument("--quiet", action="store_true", help="no progress output")
+    output.add_argument("--report", metavar="FILE",
+                        help="append a JSONL record per file (outcome, HTTP status, bytes, latency) and a run summary")
+    output.add_argument("--metrics", metavar="FILE",
+                        help="write throughput and per-phase latency histograms in Prometheus text format")
+    return parser
+
+def main(argv=None):
+    """Command line entry point; falls back to interactive prompts without arguments"""
+    argv = sys.argv[1:] if argv is None else argv
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    load_config(args.config)
+    configure(szuru_url=args.szuru_url, szuru_user=args.szuru_user, szuru_token=args.szuru_token,
+              staging_store=args.store or None, twitter_cookies=args.twitter_cookies,
+              near_duplicates=args.near_duplicates or None, phash_distance=args.phash_distance,
+              validate_media=False if args.no_validate else None, max_upload_size=args.max_size,
+              gallery_dl_in_process=False if args.subprocess else None, upload_order=args.order)
+    
+    if args.enqueue or args.worker or args.queue_status:
+        download_dir = args.download_dir or DOWNLOAD_DIR
+        if args.enqueue:
+            added, remaining = enqueue_uploads(download_dir)
+            if not (args.quiet or args.json):
+                print(f"{added} files added to {queue_path(download_dir)}, {remaining} waiting for upload")
+        if args.worker:
+            stats = run_upload_worker(download_dir, workers=args.workers or DEFAULT_UPLOAD_WORKERS,
+                                      delay=args.delay, use_tag_cache=not args.no_tag_cache,
+                                      server_check=not args.no_server_check, merge_tags=args.merge_tags,
+                                      silent=args.quiet or args.json)
+            if args.json:
+                print(json.dumps(stats, indent=2))
+            return 0 if stats['failed'] == 0 else 1
+        if args.queue_status:
+            print_queue_status(download_dir, as_json=args.json)
+        return 0
+    
+    if args.daemon:
+        return run_daemon(args.daemon, download_dir=args.download_dir or DOWNLOAD_DIR, limit=args.limit,
+                          write_metadata=not args.no_metadata, upload=not args.no_upload,
+                          workers=args.workers or DEFAULT_UPLOAD_WORKERS, delay=args.delay,
+                          per_site=args.per_site or BATCH_PER_SITE,
+                          max_downloads=args.parallel_downloads or BATCH_DOWNLOADS,
+                          use_index=not args.no_index, warm_index=args.warm_index, sync=args.sync,
+                          use_tag_cache=not args.no_tag_cache, server_check=not args.no_server_check,
+                          merge_tags=args.merge_tags)
+    
+    # Without a source, ask for everything (only when someone is there to answer)
+    if not (args.url or args.tags or args.twitter or args.resume or args.batch):
+        if args.json or args.quiet or not sys.stdin.isatty():
+            parser.error("one of --url, --tags, --twitter, --batch or --resume is required")
+        interactive_main()
+        return 0
+    
+    spec = JobSpec(
+        url=args.url,
+        tags=args.tags,
+        site=args.site,
+        twitter=args.twitter,
+        limit=args.limit,
+        download_dir=args.download_dir,
+        write_metadata=not args.no_metadata,
+        upload=not args.no_upload,
+        workers=args.workers,
+        delay=args.delay,
+        stream=not args.no_stream,
+        use_index=not args.no_index,
+        warm_index=args.warm_index,
+        use_tag_cache=not args.no_tag_cache,
+        server_check=not args.no_server_check,
+        merge_tags=args.merge_tags,
+        compact_after=args.compact_after,
+        resume=args.resume,
+        batch=args.batch,
+        sync=args.sync,
+        remote=args.remote,
+        per_site=args.per_site,
+        parallel_downloads=args.parallel_downloads,
+        quiet=args.quiet or args.json,
+        report=args.report,
+        metrics=args.metrics
+    )
+    result = run_job(spec)
+    if args.json:
+        print(json.dumps(result.to_dict(), indent=2))
+    elif result.error:
+        print(f"\nError: {result.error}")
+    return 0 if result.ok else 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())